@@ -0,0 +1,612 @@
+import argparse
+import concurrent.futures
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import sys
+from typing import Callable, Iterator, List, NamedTuple, Tuple
+
+import structlog
+from fhir.resources.R4B.bundle import Bundle
+from fhir.resources.R4B.documentreference import DocumentReference
+
+from ahd2fhir import config
+from ahd2fhir.logging_setup import setup_logging
+from ahd2fhir.utils.ahd_client import (
+    build_pipeline_analysis_cache,
+    build_session,
+    get_pipeline,
+    get_pooled_averbis_client,
+)
+from ahd2fhir.utils.analysis_archive import build_analysis_archive
+from ahd2fhir.utils.bulk_analysis import build_operation_outcome
+from ahd2fhir.utils.fhir_response import serialize_resource
+from ahd2fhir.utils.output_validation import build_output_validator
+from ahd2fhir.utils.replay import replay_archive_record, replay_document
+from ahd2fhir.utils.resource_decoder import decode_resource, loads
+from ahd2fhir.utils.resource_handler import ResourceHandler, TransientError
+from ahd2fhir.utils.text_chunking import build_text_chunker
+
+CHECKPOINT_FILENAME = ".ahd2fhir-checkpoint"
+OUTPUT_FORMATS = ["bundles", "resources"]
+
+log = structlog.get_logger()
+
+# created once per worker process by init_worker
+resource_handler: ResourceHandler | None = None
+
+
+class Chunk(NamedTuple):
+    """
+    A range of lines of an input file processed as a single unit of work
+    """
+
+    input_path: str
+    index: int
+    byte_offset: int
+    first_line: int
+    line_count: int
+
+    def key(self) -> str:
+        return f"{self.input_path}:{self.byte_offset}:{self.line_count}"
+
+    def output_filename(self) -> str:
+        # tells apart input files with the same name in different directories
+        path_hash = hashlib.sha256(self.input_path.encode("utf8")).hexdigest()[:8]
+        return (
+            f"{pathlib.Path(self.input_path).stem}-{path_hash}.{self.index:05d}.ndjson"
+        )
+
+
+# processes a single input line, returning its serialized results
+# and whether processing it failed
+LineProcessor = Callable[[int, bytes, str], Tuple[List[bytes], bool]]
+
+
+class ChunkResult(NamedTuple):
+    chunk: Chunk
+    lines: int
+    failed_lines: int
+
+
+def find_input_files(paths: List[str], pattern: str = "*.ndjson") -> List[pathlib.Path]:
+    """
+    Returns the given files and all files matching the pattern below the given
+    directories
+    """
+    input_files = []
+    for path in map(pathlib.Path, paths):
+        if path.is_dir():
+            input_files.extend(sorted(path.rglob(pattern)))
+        elif path.is_file():
+            input_files.append(path)
+        else:
+            raise FileNotFoundError(f"Input {path} does not exist")
+    return input_files
+
+
+def split_into_chunks(path: pathlib.Path, chunk_size: int) -> Iterator[Chunk]:
+    """
+    Split a file into chunks of `chunk_size` lines without parsing them
+    """
+    input_path = str(path.resolve())
+    index = 0
+    chunk_offset = 0
+    chunk_lines = 0
+    offset = 0
+    with open(path, "rb") as file:
+        for line in file:
+            offset = offset + len(line)
+            chunk_lines = chunk_lines + 1
+            if chunk_lines == chunk_size:
+                yield Chunk(
+                    input_path, index, chunk_offset, index * chunk_size + 1, chunk_lines
+                )
+                index = index + 1
+                chunk_offset = offset
+                chunk_lines = 0
+
+    if chunk_lines > 0:
+        yield Chunk(
+            input_path, index, chunk_offset, index * chunk_size + 1, chunk_lines
+        )
+
+
+def read_chunk(chunk: Chunk) -> List[bytes]:
+    with open(chunk.input_path, "rb") as file:
+        file.seek(chunk.byte_offset)
+        return [file.readline() for _ in range(chunk.line_count)]
+
+
+class CheckpointMismatchError(Exception):
+    pass
+
+
+class Checkpoint:
+    """
+    Append-only record of the chunks whose output was completely written.
+    The outputs are named by chunk index, so a checkpoint can only be resumed
+    with the chunk size it was written with.
+    """
+
+    def __init__(self, path: pathlib.Path, chunk_size: int):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.completed: set[str] = set()
+        if path.exists():
+            with open(path) as file:
+                for line in file:
+                    # the last line may be incomplete after a crash
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+
+                    if record.get("chunk_size") != chunk_size:
+                        raise CheckpointMismatchError(
+                            f"Checkpoint {path} was written with a chunk size of "
+                            + f"{record.get('chunk_size')}, not {chunk_size}. "
+                            + "Resume with the same chunk size or use a new "
+                            + "output directory."
+                        )
+                    self.completed.add(record["chunk"])
+
+    def is_completed(self, chunk: Chunk) -> bool:
+        return chunk.key() in self.completed
+
+    def mark_completed(self, chunk: Chunk):
+        self.completed.add(chunk.key())
+        with open(self.path, "a") as file:
+            file.write(
+                json.dumps(
+                    {
+                        "chunk": chunk.key(),
+                        "output": chunk.output_filename(),
+                        "chunk_size": self.chunk_size,
+                    }
+                )
+                + "\n"
+            )
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def build_resource_handler(settings: config.Settings) -> ResourceHandler:
+    session = build_session(settings.ahd_client)
+    client = get_pooled_averbis_client(settings, session)
+    pipeline = get_pipeline(settings, client)
+    return ResourceHandler(
+        pipeline,
+        analysis_cache=build_pipeline_analysis_cache(settings, pipeline),
+        analysis_archive=build_analysis_archive(settings.ahd_archive),
+        output_validator=build_output_validator(settings.output_validation),
+        text_chunker=build_text_chunker(settings.ahd_chunking),
+        release_attachment_data=settings.release_attachment_data,
+    )
+
+
+def init_worker(replay: bool = False):
+    global resource_handler
+    setup_logging()
+    # replaying archived AHD responses doesn't need AHD
+    if not replay:
+        resource_handler = build_resource_handler(config.Settings())
+
+
+def serialize_result(result: Bundle, output_format: str) -> List[bytes]:
+    if output_format == "resources":
+        return [serialize_resource(entry.resource) for entry in result.entry]
+    return [serialize_resource(result)]
+
+
+def analyze_line(
+    line_number: int, line: bytes, output_format: str
+) -> Tuple[List[bytes], bool]:
+    """
+    Returns the serialized results of a line and whether analyzing it failed
+    """
+    if len(line.strip()) == 0:
+        return [], False
+
+    try:
+        resource = decode_resource(line)
+        if resource.resource_type == "Bundle":
+            result = resource_handler.handle_bundle(resource)
+        else:
+            result = resource_handler.handle_documents([resource])
+    except TransientError:
+        # AHD is most likely down. Fail the chunk so it's retried when resuming.
+        raise
+    except Exception as exc:
+        log.error("Failed to analyze line", line_number=line_number, error=exc)
+        return [serialize_resource(build_operation_outcome(line_number, exc))], True
+
+    return serialize_result(result, output_format), False
+
+
+def replay_line(
+    line_number: int, line: bytes, output_format: str
+) -> Tuple[List[bytes], bool]:
+    """
+    Like analyze_line, but maps a record of an archived AHD response
+    """
+    if len(line.strip()) == 0:
+        return [], False
+
+    try:
+        result = replay_archive_record(line)
+    except Exception as exc:
+        log.error("Failed to replay line", line_number=line_number, error=exc)
+        return [serialize_resource(build_operation_outcome(line_number, exc))], True
+
+    return serialize_result(result, output_format), False
+
+
+def analyze_chunk(
+    chunk: Chunk,
+    output_dir: str,
+    output_format: str,
+    threads: int,
+    process_line: LineProcessor,
+) -> ChunkResult:
+    """
+    Process all lines of a chunk using `threads` threads and atomically
+    write the results to the chunk's output file
+    """
+    lines = read_chunk(chunk)
+    line_numbers = range(chunk.first_line, chunk.first_line + len(lines))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        # map keeps the results in the order of the input lines
+        results = list(
+            executor.map(
+                process_line, line_numbers, lines, [output_format] * len(lines)
+            )
+        )
+
+    output_path = pathlib.Path(output_dir) / chunk.output_filename()
+    temporary_path = output_path.with_suffix(".ndjson.tmp")
+    with open(temporary_path, "wb") as file:
+        for resources, _ in results:
+            for resource in resources:
+                file.write(resource)
+                file.write(b"\n")
+    os.replace(temporary_path, output_path)
+
+    failed_lines = sum(1 for _, failed in results if failed)
+    return ChunkResult(chunk, len(results), failed_lines)
+
+
+def run_analysis(
+    inputs: List[str],
+    output_dir: str,
+    processes: int,
+    threads: int,
+    chunk_size: int,
+    output_format: str,
+    checkpoint_path: str | None = None,
+) -> int:
+    """
+    Analyze all DocumentReferences of the NDJSON input files, skipping chunks
+    completed by a previous run. Returns the number of failed chunks.
+    """
+    return run_chunks(
+        inputs,
+        output_dir,
+        processes,
+        threads,
+        chunk_size,
+        output_format,
+        checkpoint_path,
+        replay=False,
+    )
+
+
+def run_replay(
+    inputs: List[str],
+    output_dir: str,
+    processes: int,
+    chunk_size: int,
+    output_format: str,
+    checkpoint_path: str | None = None,
+) -> int:
+    """
+    Map all archived AHD responses of the NDJSON input files without calling
+    AHD, skipping chunks completed by a previous run.
+    Returns the number of failed chunks.
+    """
+    # mapping is CPU-bound, so only parallelize across processes
+    return run_chunks(
+        inputs,
+        output_dir,
+        processes,
+        1,
+        chunk_size,
+        output_format,
+        checkpoint_path,
+        replay=True,
+    )
+
+
+def run_chunks(
+    inputs: List[str],
+    output_dir: str,
+    processes: int,
+    threads: int,
+    chunk_size: int,
+    output_format: str,
+    checkpoint_path: str | None,
+    replay: bool,
+) -> int:
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = Checkpoint(
+        pathlib.Path(checkpoint_path or os.path.join(output_dir, CHECKPOINT_FILENAME)),
+        chunk_size,
+    )
+
+    chunks = [
+        chunk
+        for path in find_input_files(inputs)
+        for chunk in split_into_chunks(path, chunk_size)
+        if not checkpoint.is_completed(chunk)
+    ]
+    log.info(
+        "Starting",
+        replay=replay,
+        pending_chunks=len(chunks),
+        completed_chunks=len(checkpoint.completed),
+        processes=processes,
+        threads=threads,
+    )
+
+    failed_chunks = 0
+
+    def on_chunk_done(chunk: Chunk, get_result: Callable[[], ChunkResult]):
+        nonlocal failed_chunks
+        try:
+            result = get_result()
+        except Exception as exc:
+            failed_chunks = failed_chunks + 1
+            log.error("Failed to process chunk", chunk=chunk.key(), error=exc)
+            return
+
+        checkpoint.mark_completed(chunk)
+        log.info(
+            "Processed chunk",
+            output=chunk.output_filename(),
+            lines=result.lines,
+            failed_lines=result.failed_lines,
+        )
+
+    process_line = replay_line if replay else analyze_line
+
+    if processes == 1:
+        # process in this process, e.g. for debugging
+        init_worker(replay)
+        for chunk in chunks:
+            on_chunk_done(
+                chunk,
+                functools.partial(
+                    analyze_chunk,
+                    chunk,
+                    output_dir,
+                    output_format,
+                    threads,
+                    process_line,
+                ),
+            )
+        return failed_chunks
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=processes, initializer=init_worker, initargs=(replay,)
+    ) as executor:
+        futures = {
+            executor.submit(
+                analyze_chunk, chunk, output_dir, output_format, threads, process_line
+            ): chunk
+            for chunk in chunks
+        }
+        for future in concurrent.futures.as_completed(futures):
+            on_chunk_done(futures[future], future.result)
+
+    return failed_chunks
+
+
+def load_document_reference(path: str) -> DocumentReference:
+    """
+    Reads a DocumentReference, or the first one of a Bundle, from a JSON file
+    """
+    with open(path, "rb") as file:
+        resource = decode_resource(file.read())
+
+    if resource.resource_type == "DocumentReference":
+        return resource
+    for entry in resource.entry or []:
+        if entry.resource.resource_type == "DocumentReference":
+            return entry.resource
+    raise ValueError(f"{path} contains no DocumentReference")
+
+
+def run_response_replay(
+    inputs: List[str],
+    document_reference_path: str,
+    output_path: str,
+    output_format: str,
+) -> int:
+    """
+    Map raw AHD responses, like those of tests/resources/ahd, each paired with
+    the same DocumentReference, without calling AHD. The results of each
+    response are written to the output in the order of the inputs.
+    Returns the number of failed responses.
+    """
+    document_reference = load_document_reference(document_reference_path)
+    response_paths = find_input_files(inputs, pattern="*.json")
+
+    failed_responses = 0
+    with open(output_path, "wb") as output:
+        for response_number, response_path in enumerate(response_paths, start=1):
+            try:
+                with open(response_path, "rb") as file:
+                    annotations = loads(file.read())
+                result = replay_document(document_reference, annotations)
+                resources = serialize_result(result, output_format)
+            except Exception as exc:
+                failed_responses = failed_responses + 1
+                log.error(
+                    "Failed to replay response", path=str(response_path), error=exc
+                )
+                resources = [
+                    serialize_resource(build_operation_outcome(response_number, exc))
+                ]
+
+            for resource in resources:
+                output.write(resource)
+                output.write(b"\n")
+
+    log.info(
+        "Replayed responses",
+        responses=len(response_paths),
+        failed_responses=failed_responses,
+    )
+    return failed_responses
+
+
+def add_common_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "inputs", nargs="+", help="NDJSON files or directories containing them"
+    )
+    parser.add_argument(
+        "-o", "--output-dir", required=True, help="Directory to write results to"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=1000,
+        help="Number of lines processed, written and checkpointed as a unit",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default="bundles",
+        help="Write one result Bundle per document "
+        + "or each extracted resource on its own line",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help=f"Checkpoint file (default: <output-dir>/{CHECKPOINT_FILENAME})",
+    )
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="ahd2fhir",
+        description="Creates FHIR resources from Averbis Health Discovery "
+        + "NLP Annotations. AHD is configured using the same environment "
+        + "variables as the service.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    analyze = subparsers.add_parser(
+        "analyze",
+        help="Analyze DocumentReferences, or Bundles thereof, from NDJSON files",
+    )
+    add_common_arguments(analyze)
+    analyze.add_argument(
+        "--threads",
+        type=int,
+        default=4,
+        help="Number of documents analyzed concurrently by each process",
+    )
+
+    replay = subparsers.add_parser(
+        "replay",
+        help="Map archived AHD responses to FHIR without calling AHD. "
+        + "Reads the NDJSON files written if AHD_ARCHIVE_DIRECTORY is set.",
+    )
+    add_common_arguments(replay)
+
+    replay_responses = subparsers.add_parser(
+        "replay-responses",
+        help="Map raw AHD responses, each paired with the same DocumentReference, "
+        + "to FHIR without calling AHD",
+    )
+    replay_responses.add_argument(
+        "inputs",
+        nargs="+",
+        help="JSON files of AHD responses or directories containing them",
+    )
+    replay_responses.add_argument(
+        "-d",
+        "--document-reference",
+        required=True,
+        help="JSON file of the analyzed DocumentReference, or a Bundle of it",
+    )
+    replay_responses.add_argument(
+        "-o", "--output", required=True, help="NDJSON file to write results to"
+    )
+    replay_responses.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default="bundles",
+        help="Write one result Bundle per response "
+        + "or each extracted resource on its own line",
+    )
+    return parser
+
+
+def main(argv: List[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    setup_logging()
+
+    if args.command == "replay-responses":
+        failed_responses = run_response_replay(
+            inputs=args.inputs,
+            document_reference_path=args.document_reference,
+            output_path=args.output,
+            output_format=args.output_format,
+        )
+        return 1 if failed_responses > 0 else 0
+
+    try:
+        if args.command == "replay":
+            failed_chunks = run_replay(
+                inputs=args.inputs,
+                output_dir=args.output_dir,
+                processes=args.processes,
+                chunk_size=args.chunk_size,
+                output_format=args.output_format,
+                checkpoint_path=args.checkpoint,
+            )
+        else:
+            failed_chunks = run_analysis(
+                inputs=args.inputs,
+                output_dir=args.output_dir,
+                processes=args.processes,
+                threads=args.threads,
+                chunk_size=args.chunk_size,
+                output_format=args.output_format,
+                checkpoint_path=args.checkpoint,
+            )
+    except CheckpointMismatchError as exc:
+        log.error("Refusing to resume from the checkpoint", error=str(exc))
+        return 1
+
+    if failed_chunks > 0:
+        log.error(
+            "Some chunks failed. Run the same command again to retry them.",
+            failed_chunks=failed_chunks,
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
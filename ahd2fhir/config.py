@@ -1,7 +1,8 @@
+import tempfile
 from os import path
 
 from aiokafka.helpers import create_ssl_context
-from pydantic import model_validator
+from pydantic import field_validator, model_validator
 from pydantic_settings import BaseSettings
 
 TLS_ROOT_DIR = "/opt/kafka-certs/"
@@ -30,21 +31,66 @@ class KafkaConsumerSettings(BaseSettings):
 
 class KafkaProducerSettings(BaseSettings):
     compression_type: str = "gzip"
+    # number of acknowledgments the producer requires: 0, 1 or "all"
+    acks: int | str = 1
+    # time to wait for more records to fill up a batch before sending it
+    linger_ms: int = 5
+    # maximum size of a batch of records sent to a partition in bytes
+    max_batch_size: int = 16384
+
+    # environment variables are strings, but aiokafka expects acks as an int
+    @field_validator("acks", mode="before")
+    def parse_acks(cls, v):
+        return int(v) if isinstance(v, str) and v.lstrip("-").isdigit() else v
 
     class Config:
         env_prefix = "kafka_producer_"
 
 
+class ClaimCheckSettings(BaseSettings):
+    # where to store payloads too large for a Kafka message, which are then
+    # replaced by a reference to them: "none", "filesystem" or "s3"
+    backend: str = "none"
+    # payloads larger than this are stored. Must be below max_message_size_bytes
+    # unless the backend is "none".
+    threshold_bytes: int = 4194304  # 4 MiB
+    # directory of the "filesystem" backend, shared by producers and consumers
+    directory: str = ""
+    # bucket and key prefix of the "s3" backend. Credentials are read from
+    # the usual AWS environment variables.
+    s3_bucket: str = ""
+    s3_prefix: str = "ahd2fhir/"
+    # e.g. to use an S3-compatible store like MinIO
+    s3_endpoint_url: str | None = None
+
+    class Config:
+        env_prefix = "kafka_claim_check_"
+
+
 class KafkaSettings(BaseSettings):
     input_topic: str = "fhir.documents"
     output_topic: str = "fhir.nlp-results"
     consumer: KafkaConsumerSettings = KafkaConsumerSettings()
     producer: KafkaProducerSettings = KafkaProducerSettings()
+    claim_check: ClaimCheckSettings = ClaimCheckSettings()
 
     # Kafka-related settings
     bootstrap_servers: str = "localhost:9094"
     max_message_size_bytes: int = 5242880  # 5 MiB
 
+    # maximum number of messages processed concurrently
+    max_in_flight_messages: int = 1
+    # if enabled, messages with the same key are processed one after another
+    preserve_key_order: bool = True
+    # how often the offsets of fully processed messages are committed
+    commit_interval_ms: int = 5000
+    # name of an optional message header holding the resource type. Messages
+    # of an unsupported type are rejected without parsing their body.
+    resource_type_header: str = "resourceType"
+    # "model" maps to fhir.resources models. "dict" maps to plain dicts instead,
+    # which serialize to the same JSON without constructing any models.
+    mapping_backend: str = "model"
+
     # SSL Settings
     security_protocol: str = "PLAINTEXT"
     ssl_cafile: str = path.join(TLS_ROOT_DIR, "ca.crt")
@@ -62,6 +108,18 @@ class KafkaSettings(BaseSettings):
     def parse_to_none(cls, v):
         return None if v in ["", "None", 0, False] else v
 
+    @model_validator(mode="after")
+    def check_claim_check_threshold(self):
+        if (
+            self.claim_check.backend != "none"
+            and self.claim_check.threshold_bytes >= self.max_message_size_bytes
+        ):
+            raise ValueError(
+                "kafka_claim_check_threshold_bytes must be below "
+                + "kafka_max_message_size_bytes."
+            )
+        return self
+
     def get_connection_context(self):
         return {
             "ssl_context": self.get_ssl_context(),
@@ -116,6 +174,87 @@ class FhirSystemSettings(BaseSettings):
         env_prefix = "fhir_systems_"
 
 
+class AhdClientSettings(BaseSettings):
+    # number of ResourceHandlers shared by the HTTP API and the Kafka consumer
+    pool_size: int = 4
+    # maximum number of documents of a single Bundle analyzed concurrently
+    max_concurrent_documents_per_bundle: int = 4
+    # maximum number of concurrent AHD requests across all ResourceHandlers.
+    # Also the maximum number of kept-alive connections to AHD.
+    max_in_flight_analyses: int = 8
+    # maximum number of documents of a single bulk request analyzed concurrently
+    max_concurrent_bulk_documents: int = 8
+    # lines of a bulk request longer than this are rejected without reading
+    # them into memory
+    max_bulk_line_bytes: int = 67108864  # 64 MiB
+    # maximum time to wait for a free ResourceHandler. None waits indefinitely.
+    pool_timeout_seconds: float | None = None
+    connect_timeout_seconds: float = 10.0
+    # maximum time to wait for AHD to respond. None waits indefinitely.
+    read_timeout_seconds: float | None = None
+
+    class Config:
+        env_prefix = "ahd_client_"
+
+
+class AnalysisCacheSettings(BaseSettings):
+    # where to cache AHD analysis results: "none", "memory" or "disk"
+    backend: str = "none"
+    # least recently used results are evicted once all cached results
+    # exceed this size. Measured compressed for the disk backend.
+    max_size_bytes: int = 268435456  # 256 MiB
+    # cached results expire after this time. None keeps them until evicted.
+    ttl_seconds: float | None = 604800  # 7 days
+    # path of the SQLite database used by the disk backend
+    disk_path: str = path.join(tempfile.gettempdir(), "ahd2fhir-analysis-cache.db")
+    # change to invalidate all cached results, e.g. after updating the pipeline
+    pipeline_version: str = ""
+    # also invalidate the cache whenever the pipeline configuration changes
+    include_pipeline_configuration: bool = True
+    # how often the pipeline configuration is checked for changes. None only
+    # checks it once, before the first analysis.
+    pipeline_configuration_refresh_seconds: float | None = 300
+
+    class Config:
+        env_prefix = "ahd_cache_"
+
+
+class AnalysisArchiveSettings(BaseSettings):
+    # if set, raw AHD responses are appended to NDJSON files in this
+    # directory so the mapping can be replayed without calling AHD
+    directory: str = ""
+
+    class Config:
+        env_prefix = "ahd_archive_"
+
+
+class TextChunkingSettings(BaseSettings):
+    # if enabled, plain texts longer than max_chunk_size characters are split
+    # at paragraph or sentence boundaries and the chunks analyzed concurrently
+    enabled: bool = False
+    max_chunk_size: int = 100_000
+    # number of characters repeated at the start of the next chunk, so
+    # annotations cut at the end of a chunk are found whole in the next one
+    overlap: int = 2000
+    # maximum number of chunks of a single document analyzed concurrently
+    max_concurrent_chunks: int = 4
+
+    class Config:
+        env_prefix = "ahd_chunking_"
+
+
+class OutputValidationSettings(BaseSettings):
+    # whether to validate the result Bundles against the FHIR R4B models:
+    # "always", "sampled" or "never". Invalid Bundles are logged and counted
+    # in the output_validation_failures metric, but still returned.
+    policy: str = "never"
+    # fraction of the result Bundles validated if the policy is "sampled"
+    sample_rate: float = 0.01
+
+    class Config:
+        env_prefix = "output_validation_"
+
+
 class Settings(BaseSettings):
     # AHD URL. Should not end with a trailing '/'
     ahd_url: str
@@ -137,6 +276,25 @@ class Settings(BaseSettings):
     # if set to true, create the specified project and make sure the pipeline is running
     ahd_ensure_project_is_created_and_pipeline_is_started: bool = False
 
+    # AHD client and connection pool settings
+    ahd_client: AhdClientSettings = AhdClientSettings()
+
+    # cache of AHD analysis results
+    ahd_cache: AnalysisCacheSettings = AnalysisCacheSettings()
+
+    # archive of raw AHD responses
+    ahd_archive: AnalysisArchiveSettings = AnalysisArchiveSettings()
+
+    # splitting of long documents for analysis
+    ahd_chunking: TextChunkingSettings = TextChunkingSettings()
+
+    # if enabled, the attachment data of each document is dropped once its text
+    # is decoded, freeing the memory while the document is analyzed and mapped
+    release_attachment_data: bool = False
+
+    # validation of the result Bundles
+    output_validation: OutputValidationSettings = OutputValidationSettings()
+
     # Kafka Settings
     kafka: KafkaSettings = KafkaSettings()
 
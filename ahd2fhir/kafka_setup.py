@@ -1,26 +1,70 @@
-import json
+import asyncio
+from typing import Tuple
 
 import aiokafka
+import aiokafka.errors
 import structlog
-from aiokafka.structs import ConsumerRecord
+from aiokafka.structs import ConsumerRecord, TopicPartition
 from fhir.resources.R4B.bundle import Bundle
 from fhir.resources.R4B.documentreference import DocumentReference
+from prometheus_client import Gauge
 
 from ahd2fhir import config
+from ahd2fhir.utils.ahd_client import ResourceHandlerPool
+from ahd2fhir.utils.claim_check import CLAIM_CHECK_HEADER, ClaimCheck, build_claim_check
+from ahd2fhir.utils.fhir_response import serialize_dict, serialize_resource
+from ahd2fhir.utils.offset_tracker import OffsetTracker
+from ahd2fhir.utils.resource_decoder import decode_resource, get_header
 from ahd2fhir.utils.resource_handler import ResourceHandler, TransientError
 
+IN_FLIGHT_MESSAGES_GAUGE = Gauge(
+    "kafka_in_flight_messages", "Number of Kafka messages currently being processed"
+)
+PARTITION_LAG_GAUGE = Gauge(
+    "kafka_partition_lag",
+    "Number of messages between the partition's high watermark "
+    + "and the last committed offset",
+    ["topic", "partition"],
+)
+PENDING_DELIVERIES_GAUGE = Gauge(
+    "kafka_pending_deliveries",
+    "Number of results queued for sending but not yet acknowledged by the broker",
+)
+COMMITTED_OFFSET_GAUGE = Gauge(
+    "kafka_committed_offset",
+    "Offset up to which all messages of the partition were fully processed",
+    ["topic", "partition"],
+)
+
 logger = structlog.get_logger()
 
 consumer: aiokafka.AIOKafkaConsumer = None
 producer: aiokafka.AIOKafkaProducer = None
-resource_handler: ResourceHandler | None = None
+resource_handler_pool: ResourceHandlerPool | None = None
+claim_check: ClaimCheck | None = None
+offset_tracker = OffsetTracker()
+# tasks waiting for the delivery of a result to mark its message's offset
+pending_deliveries: set[asyncio.Task] = set()
+
+
+class CommitOnRevokeListener(aiokafka.ConsumerRebalanceListener):  # pragma: no cover
+    def __init__(self, kafka_consumer: aiokafka.AIOKafkaConsumer):
+        self.consumer = kafka_consumer
+
+    async def on_partitions_revoked(self, revoked):
+        await commit_processed_offsets(self.consumer)
+        for partition in revoked:
+            offset_tracker.forget(partition)
+
+    async def on_partitions_assigned(self, assigned):
+        pass
 
 
-async def initialize_kafka(handler: ResourceHandler):  # pragma: no cover
+async def initialize_kafka(handler_pool: ResourceHandlerPool):  # pragma: no cover
     settings = config.Settings()
 
-    global resource_handler
-    resource_handler = handler
+    global resource_handler_pool
+    resource_handler_pool = handler_pool
 
     group_id = settings.kafka.consumer.group_id
 
@@ -29,15 +73,23 @@ async def initialize_kafka(handler: ResourceHandler):  # pragma: no cover
         input_topic=settings.kafka.input_topic,
         group_id=group_id,
         bootstrap_servers=settings.kafka.bootstrap_servers,
+        max_in_flight_messages=settings.kafka.max_in_flight_messages,
     )
 
     global consumer
 
+    # offsets are committed manually once messages are fully processed
     consumer = aiokafka.AIOKafkaConsumer(
-        settings.kafka.input_topic,
         **settings.kafka.get_connection_context(),
         **settings.kafka.consumer.dict(),
+        enable_auto_commit=False,
     )
+    consumer.subscribe(
+        [settings.kafka.input_topic], listener=CommitOnRevokeListener(consumer)
+    )
+
+    global claim_check
+    claim_check = build_claim_check(settings.kafka.claim_check)
 
     global producer
     producer = aiokafka.AIOKafkaProducer(
@@ -51,6 +103,197 @@ async def initialize_kafka(handler: ResourceHandler):  # pragma: no cover
     await producer.start()
 
 
+async def commit_processed_offsets(
+    kafka_consumer: aiokafka.AIOKafkaConsumer,
+):  # pragma: no cover
+    # send any lingering batches so their messages' offsets can be committed,
+    # once the tasks waiting for the flushed deliveries have marked them
+    flushed_deliveries = list(pending_deliveries)
+    await producer.flush()
+    if len(flushed_deliveries) > 0:
+        await asyncio.wait(flushed_deliveries)
+
+    offsets = offset_tracker.committable()
+    if len(offsets) > 0:
+        await kafka_consumer.commit(offsets)
+        offset_tracker.mark_committed(offsets)
+
+    for partition, partition_offsets in offset_tracker.partitions.items():
+        if partition_offsets.committed is None:
+            continue
+
+        labels = {"topic": partition.topic, "partition": partition.partition}
+        COMMITTED_OFFSET_GAUGE.labels(**labels).set(partition_offsets.committed)
+
+        highwater = kafka_consumer.highwater(partition)
+        if highwater is not None:
+            PARTITION_LAG_GAUGE.labels(**labels).set(
+                highwater - partition_offsets.committed
+            )
+
+
+async def commit_periodically(
+    kafka_consumer: aiokafka.AIOKafkaConsumer, interval_seconds: float
+):  # pragma: no cover
+    while True:
+        await asyncio.sleep(interval_seconds)
+        try:
+            await commit_processed_offsets(kafka_consumer)
+        except Exception as exc:
+            logger.exception(exc)
+            logger.error("Failed to commit processed offsets")
+
+
+async def process_message(
+    msg: ConsumerRecord, settings: config.Settings, failed_topic: str
+) -> asyncio.Future | None:  # pragma: no cover
+    """
+    Map the message and queue the resulting Bundle for sending.
+    Returns the future of the queued record's delivery.
+    """
+    try:
+        # parsing and validating large Bundles would block the event loop
+        resource = await asyncio.to_thread(
+            decode_resource,
+            await resolve_claim_check(msg),
+            resource_type=get_header(msg.headers, settings.kafka.resource_type_header),
+        )
+        async with resource_handler_pool.acquire() as resource_handler:
+            if settings.kafka.mapping_backend == "dict":
+                value, key = await map_to_dict(resource_handler, resource)
+            else:
+                value, key = await map_to_model(resource_handler, resource)
+
+        value, headers = await check_in_result(value)
+        return await producer.send(
+            settings.kafka.output_topic, value, key.encode("utf8"), headers=headers
+        )
+    except TransientError:
+        raise
+    except Exception as exc:
+        logger.exception(exc)
+        logger.error(
+            f"Mapping payload failed: {exc}. Storing in error topic",
+            failed_topic=failed_topic,
+        )
+        return await send_to_error_topic(msg, failed_topic, f"Mapping Error: {exc}")
+
+
+async def resolve_claim_check(msg: ConsumerRecord) -> bytes:
+    """
+    The message's value, or the payload it refers to if it's a claim check
+    reference. Raises a TransientError if the blob store is unavailable.
+    """
+    if get_header(msg.headers, CLAIM_CHECK_HEADER) is None:
+        return msg.value
+
+    if claim_check is None:
+        raise ValueError(
+            "Received a claim check reference, but no claim check backend is set"
+        )
+
+    try:
+        return await asyncio.to_thread(claim_check.check_out, msg.value)
+    except ValueError:
+        # invalid references and missing payloads won't resolve on a retry
+        raise
+    except Exception as exc:
+        raise TransientError(exc)
+
+
+async def check_in_result(value: bytes) -> Tuple[bytes, list | None]:
+    """
+    The value and headers of the result message, a claim check reference to
+    the stored value if it is too large. Raises a TransientError if the blob
+    store is unavailable, so the result isn't lost.
+    """
+    if claim_check is None:
+        return value, None
+
+    try:
+        value, is_reference = await asyncio.to_thread(claim_check.check_in, value)
+    except Exception as exc:
+        raise TransientError(exc)
+
+    if not is_reference:
+        return value, None
+    return value, [(CLAIM_CHECK_HEADER, claim_check.store.backend.encode("utf8"))]
+
+
+async def map_to_model(
+    resource_handler: ResourceHandler, resource: Bundle | DocumentReference
+) -> Tuple[bytes, str]:
+    """
+    Map the resource to a Bundle model, returning its JSON and its id
+    """
+    result: Bundle = None
+    if isinstance(resource, Bundle):
+        result = await resource_handler.ahandle_bundle(resource)
+    else:
+        result = await resource_handler.ahandle_documents([resource])
+    return serialize_resource(result), result.id
+
+
+async def map_to_dict(
+    resource_handler: ResourceHandler, resource: Bundle | DocumentReference
+) -> Tuple[bytes, str]:
+    """
+    Map the resource to a Bundle using the dict mapping backend, returning
+    the same JSON and id as map_to_model
+    """
+    result: dict = None
+    if isinstance(resource, Bundle):
+        result = await resource_handler.ahandle_bundle_as_dict(resource)
+    else:
+        result = await resource_handler.ahandle_documents_as_dict([resource])
+    return serialize_dict(result), result["id"]
+
+
+async def send_to_error_topic(
+    msg: ConsumerRecord, failed_topic: str, error: str
+) -> asyncio.Future | None:  # pragma: no cover
+    headers = [("error", error.encode("utf8"))]
+    # keep claim check references resolvable
+    headers.extend(
+        (key, value) for key, value in msg.headers or [] if key == CLAIM_CHECK_HEADER
+    )
+
+    try:
+        return await producer.send(
+            failed_topic, msg.value, key=msg.key, headers=headers
+        )
+    except Exception as error_topic_exc:
+        logger.error(f"Failed to send message to error topic: {error_topic_exc}")
+        logger.exception(error_topic_exc)
+        return None
+
+
+async def wait_for_delivery(
+    msg: ConsumerRecord, delivery: asyncio.Future, failed_topic: str
+):  # pragma: no cover
+    try:
+        await delivery
+        return
+    except Exception as exc:
+        logger.exception(exc)
+        logger.error(
+            f"Sending result failed: {exc}. Storing in error topic",
+            failed_topic=failed_topic,
+        )
+        delivery = await send_to_error_topic(
+            msg, failed_topic, f"Delivery Error: {exc}"
+        )
+
+    if delivery is None:
+        return
+
+    try:
+        await delivery
+    except Exception as error_topic_exc:
+        logger.error(f"Failed to send message to error topic: {error_topic_exc}")
+        logger.exception(error_topic_exc)
+
+
 async def send_consumer_message(consumer):  # pragma: no cover
     settings = config.Settings()
 
@@ -58,70 +301,136 @@ async def send_consumer_message(consumer):  # pragma: no cover
         f"error.{settings.kafka.input_topic}.{settings.kafka.consumer.group_id}"
     )
 
-    if resource_handler is None:
+    if resource_handler_pool is None:
         raise ValueError(
-            "resource_handler is unset. Be sure to call initialize_kafka first."
+            "resource_handler_pool is unset. Be sure to call initialize_kafka first."
         )
 
-    # consume messages
-    msg: ConsumerRecord
-    async for msg in consumer:
+    in_flight_slots = asyncio.Semaphore(settings.kafka.max_in_flight_messages)
+    in_flight_tasks: set[asyncio.Task] = set()
+    # set once the result of the most recent message for each key has been
+    # queued for sending, used to keep messages with the same key in order
+    latest_enqueued_by_key: dict[bytes, asyncio.Event] = {}
+    transient_errors: list[TransientError] = []
+    # set on the first transient error, to stop consuming right away instead
+    # of only once the next message arrives
+    stop_consuming = asyncio.Event()
+
+    async def process(
+        msg: ConsumerRecord,
+        predecessor_enqueued: asyncio.Event | None,
+        enqueued: asyncio.Event,
+    ):
+        delivery = None
         try:
-            resource_json = json.loads(msg.value)
-            resource = None
-            result: Bundle = None
-            if resource_json["resourceType"] == "DocumentReference":
-                resource = DocumentReference.parse_raw(msg.value)
-                result = resource_handler.handle_documents([resource])
-            elif resource_json["resourceType"] == "Bundle":
-                resource = Bundle.parse_raw(msg.value)
-                result = resource_handler.handle_bundle(resource)
-            else:
-                raise ValueError(
-                    f"Unprocessable resource type '{resource_json['resourceType']}'"
-                )
-
-            await producer.send_and_wait(
-                settings.kafka.output_topic,
-                result.json().encode("utf8"),
-                result.id.encode("utf8"),
-            )
+            if predecessor_enqueued is not None:
+                await predecessor_enqueued.wait()
+            if len(transient_errors) > 0:
+                return
+            delivery = await process_message(msg, settings, failed_topic)
         except TransientError as exc:
-            logger.exception(exc)
-            logger.error(
-                "Message processing failed with a transient error. "
-                + "AHD is most likely down. Stopping consumer entirely."
-                + "Please restart it manually."
-            )
-            # will leave consumer group; perform autocommit if enabled
-            await consumer.stop()
+            transient_errors.append(exc)
+            stop_consuming.set()
             return
-        except Exception as exc:
-            logger.exception(exc)
-            logger.error(
-                f"Mapping payload failed: {exc}. Storing in error topic",
-                failed_topic=failed_topic,
-            )
+        finally:
+            enqueued.set()
+            in_flight_slots.release()
+            IN_FLIGHT_MESSAGES_GAUGE.dec()
 
-            headers = [("error", f"Mapping Error: {exc}".encode("utf8"))]
+        # the next message can be processed while this result waits to be sent
+        # as part of a batch. Its offset may only be committed once delivered.
+        delivered = asyncio.create_task(complete_after_delivery(msg, delivery))
+        pending_deliveries.add(delivered)
+        delivered.add_done_callback(pending_deliveries.discard)
+        await delivered
 
+    async def complete_after_delivery(
+        msg: ConsumerRecord, delivery: asyncio.Future | None
+    ):
+        if delivery is not None:
+            with PENDING_DELIVERIES_GAUGE.track_inprogress():
+                await wait_for_delivery(msg, delivery, failed_topic)
+
+        offset_tracker.complete(TopicPartition(msg.topic, msg.partition), msg.offset)
+
+    def on_task_done(task: asyncio.Task, key: bytes | None, enqueued: asyncio.Event):
+        in_flight_tasks.discard(task)
+        if key is not None and latest_enqueued_by_key.get(key) is enqueued:
+            del latest_enqueued_by_key[key]
+
+    commit_task = asyncio.create_task(
+        commit_periodically(consumer, settings.kafka.commit_interval_ms / 1000)
+    )
+
+    # consume messages until the consumer is stopped or processing a message
+    # failed with a transient error
+    stop_requested = asyncio.ensure_future(stop_consuming.wait())
+    next_message: asyncio.Future | None = None
+    msg: ConsumerRecord
+    try:
+        while True:
+            next_message = asyncio.ensure_future(consumer.getone())
+            await asyncio.wait(
+                [next_message, stop_requested], return_when=asyncio.FIRST_COMPLETED
+            )
+            if stop_requested.done():
+                break
             try:
-                await producer.send_and_wait(
-                    failed_topic, msg.value, key=msg.key, headers=headers
-                )
-            except Exception as error_topic_exc:
-                logger.error(
-                    f"Failed to send message to error topic: {error_topic_exc}"
-                )
-                logger.exception(error_topic_exc)
-
-
-async def kafka_start_consuming(resource_handler: ResourceHandler):
-    await initialize_kafka(resource_handler)
+                msg = next_message.result()
+            except aiokafka.errors.ConsumerStoppedError:
+                break
+
+            await in_flight_slots.acquire()
+
+            if stop_consuming.is_set():
+                in_flight_slots.release()
+                break
+
+            offset_tracker.start(TopicPartition(msg.topic, msg.partition), msg.offset)
+            IN_FLIGHT_MESSAGES_GAUGE.inc()
+
+            key = msg.key if settings.kafka.preserve_key_order else None
+            enqueued = asyncio.Event()
+            task = asyncio.create_task(
+                process(msg, latest_enqueued_by_key.get(key), enqueued)
+            )
+            in_flight_tasks.add(task)
+            if key is not None:
+                latest_enqueued_by_key[key] = enqueued
+            task.add_done_callback(lambda t, k=key, e=enqueued: on_task_done(t, k, e))
+    finally:
+        if next_message is not None:
+            next_message.cancel()
+        stop_requested.cancel()
+        commit_task.cancel()
+
+    if len(in_flight_tasks) > 0:
+        await asyncio.wait(in_flight_tasks)
+
+    if len(transient_errors) == 0:
+        # the consumer was stopped
+        return
+
+    for exc in transient_errors:
+        logger.exception(exc)
+
+    logger.error(
+        "Message processing failed with a transient error. "
+        + "AHD is most likely down. Stopping consumer entirely."
+        + "Please restart it manually."
+    )
+    # only commit messages that were fully processed, then leave the consumer group
+    await commit_processed_offsets(consumer)
+    await consumer.stop()
+
+
+async def kafka_start_consuming(handler_pool: ResourceHandlerPool):
+    await initialize_kafka(handler_pool)
     return await send_consumer_message(consumer)
 
 
 async def kafka_stop_consuming():
     logger.info("Stopping Kafka consumer")
+    await commit_processed_offsets(consumer)
     await consumer.stop()
     return await producer.stop()
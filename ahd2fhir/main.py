@@ -1,12 +1,13 @@
 import asyncio
+import contextlib
+import math
 import os
 from functools import lru_cache
-from typing import Any, Dict, Union
+from typing import Any, AsyncIterator, Dict, Union
 
 import structlog
-from averbis import Client, Pipeline
-from fastapi import Depends, FastAPI, status
-from fastapi.encoders import jsonable_encoder
+from averbis import Client
+from fastapi import Depends, FastAPI, HTTPException, Request, status
 from fhir.resources.R4B.bundle import Bundle
 from fhir.resources.R4B.documentreference import DocumentReference
 from prometheus_fastapi_instrumentator import Instrumentator
@@ -15,12 +16,14 @@ from starlette.responses import JSONResponse
 from ahd2fhir import config
 from ahd2fhir.kafka_setup import kafka_start_consuming, kafka_stop_consuming
 from ahd2fhir.logging_setup import setup_logging
+from ahd2fhir.utils.ahd_client import (
+    ResourceHandlerPool,
+    ResourceHandlerPoolTimeoutError,
+)
+from ahd2fhir.utils.bulk_analysis import aiter_ndjson_lines, analyze_ndjson_lines
+from ahd2fhir.utils.fhir_response import FHIRJSONResponse, FHIRNDJSONStreamingResponse
 from ahd2fhir.utils.resource_handler import ResourceHandler
 
-app = FastAPI()
-
-Instrumentator().instrument(app).expose(app)
-
 logger = structlog.get_logger()
 
 
@@ -29,39 +32,28 @@ def get_settings() -> config.Settings:
     return config.Settings()
 
 
-def get_averbis_client(settings: config.Settings) -> Client:
-    api_token: str | None = None
-    if settings.ahd_api_token:
-        api_token = settings.ahd_api_token
+async def get_resource_handler(request: Request) -> AsyncIterator[ResourceHandler]:
+    pool: ResourceHandlerPool = request.app.state.resource_handler_pool
+    try:
+        async with pool.acquire() as resource_handler:
+            yield resource_handler
+    except ResourceHandlerPoolTimeoutError as exc:
+        # about as long as this request waited for a handler to become available
+        retry_after = math.ceil(pool.settings.ahd_client.pool_timeout_seconds or 1)
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="All resource handlers are busy, please retry later",
+            headers={"Retry-After": str(retry_after)},
+        ) from exc
 
-    client = Client(
-        url_or_id=settings.ahd_url,
-        api_token=api_token,
-        username=settings.ahd_username,
-        password=settings.ahd_password,
-    )
 
-    return client
+def get_resource_handler_pool(request: Request) -> ResourceHandlerPool:
+    return request.app.state.resource_handler_pool
 
 
-def get_averbis_pipeline(
+def init_ahd_project_and_pipeline(
     settings: config.Settings,
     client: Client,
-) -> Pipeline:
-    return client.get_project(settings.ahd_project).get_pipeline(settings.ahd_pipeline)
-
-
-def get_resource_handler(
-    settings: config.Settings = Depends(get_settings),
-) -> ResourceHandler:
-    client = get_averbis_client(settings)
-    pipeline = get_averbis_pipeline(settings, client)
-    return ResourceHandler(pipeline)
-
-
-def init_ahd_project_and_pipeline(
-    settings: config.Settings = Depends(get_settings),
-    client: Client = Depends(get_averbis_client),
 ):
     logger.info(f"Creating project {settings.ahd_project}")
     project = client.create_project(
@@ -84,6 +76,49 @@ def init_ahd_project_and_pipeline(
     logger.info("Done initializing project and pipeline.")
 
 
+def is_kafka_enabled() -> bool:
+    return os.getenv("KAFKA_ENABLED", "False").lower() in ["true", "1"]
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    setup_logging()
+    logger.info("Initializing API")
+
+    settings = get_settings()
+    resource_handler_pool = ResourceHandlerPool(settings)
+    app.state.resource_handler_pool = resource_handler_pool
+
+    kafka_consumer_task: asyncio.Task | None = None
+    if is_kafka_enabled():
+        logger.info("Initializing Kafka")
+        kafka_consumer_task = asyncio.create_task(
+            kafka_start_consuming(resource_handler_pool)
+        )
+
+    if settings.ahd_ensure_project_is_created_and_pipeline_is_started:
+        logger.info(
+            f"Making sure project {settings.ahd_project} exists "
+            + f"and {settings.ahd_pipeline} pipeline is started."
+        )
+        init_ahd_project_and_pipeline(settings, resource_handler_pool.client)
+
+    yield
+
+    logger.info("Shutting down API")
+    if kafka_consumer_task is not None:
+        logger.info("Shutting down Kafka consumer")
+        await kafka_stop_consuming()
+        kafka_consumer_task.cancel()
+
+    resource_handler_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+Instrumentator().instrument(app).expose(app)
+
+
 @app.get("/ready")
 @app.get("/live")
 async def health():
@@ -111,11 +146,36 @@ async def analyze_document(
 
     result = await analyze_resource(resource, resource_handler)
 
-    return JSONResponse(
-        status_code=status.HTTP_200_OK,
-        content=jsonable_encoder(result.dict()),
-        media_type="application/fhir+json",
-    )
+    return FHIRJSONResponse(status_code=status.HTTP_200_OK, content=result)
+
+
+@app.post("/fhir/$analyze-document-bulk")
+async def analyze_document_bulk(
+    request: Request,
+    settings: config.Settings = Depends(get_settings),
+    resource_handler_pool: ResourceHandlerPool = Depends(get_resource_handler_pool),
+):
+    """
+    Analyze an NDJSON stream of DocumentReferences or Bundles thereof.
+    Streams back one result Bundle per line as soon as it is done, or an
+    OperationOutcome with the id `line-<number>` if the line failed or is
+    longer than `ahd_client.max_bulk_line_bytes`.
+    """
+
+    async def stream_results() -> AsyncIterator[bytes]:
+        # the handler is held until the whole stream is sent, so it can't be
+        # acquired via a dependency which exits before the response is sent
+        async with resource_handler_pool.acquire() as resource_handler:
+            async for result in analyze_ndjson_lines(
+                aiter_ndjson_lines(
+                    request.stream(), settings.ahd_client.max_bulk_line_bytes
+                ),
+                resource_handler,
+                settings.ahd_client.max_concurrent_bulk_documents,
+            ):
+                yield result
+
+    return FHIRNDJSONStreamingResponse(stream_results())
 
 
 async def analyze_resource(
@@ -128,10 +188,10 @@ async def analyze_resource(
 
     if isinstance(payload, Bundle):
         log.debug("Received Bundle to process")
-        result = resource_handler.handle_bundle(payload)
+        result = await resource_handler.ahandle_bundle(payload)
     elif isinstance(payload, DocumentReference):
         log.debug("Received single DocumentReference to process")
-        result = resource_handler.handle_documents([payload])
+        result = await resource_handler.ahandle_documents([payload])
     else:
         raise ValueError(f"Unprocessable resource type={payload.resource_type}")
 
@@ -139,38 +199,3 @@ async def analyze_resource(
         log.warn("The response bundle is empty")
 
     return result
-
-
-kafka_consumer_task: asyncio.Task
-
-
-@app.on_event("startup")
-async def startup_event():
-    setup_logging()
-    logger.info("Initializing API")
-
-    settings = get_settings()
-    if os.getenv("KAFKA_ENABLED", "False").lower() in ["true", "1"]:
-        logger.info("Initializing Kafka")
-        resource_handler = get_resource_handler(settings)
-        global kafka_consumer_task
-        kafka_consumer_task = asyncio.create_task(
-            kafka_start_consuming(resource_handler)
-        )
-
-    if settings.ahd_ensure_project_is_created_and_pipeline_is_started:
-        logger.info(
-            f"Making sure project {settings.ahd_project} exists "
-            + f"and {settings.ahd_pipeline} pipeline is started."
-        )
-        init_ahd_project_and_pipeline(settings, get_averbis_client(settings))
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    logger.info("Shutting down API")
-    if os.getenv("KAFKA_ENABLED", "False").lower() in ["true", "1"]:
-        logger.info("Shutting down Kafka consumer")
-        await kafka_stop_consuming()
-        global kafka_consumer_task
-        kafka_consumer_task.cancel()
@@ -1,17 +1,16 @@
 import datetime
 import re
 
-from fhir.resources.R4B.codeableconcept import CodeableConcept
-from fhir.resources.R4B.coding import Coding
 from fhir.resources.R4B.condition import Condition
 from fhir.resources.R4B.documentreference import DocumentReference
 from fhir.resources.R4B.fhirtypes import DateTime
 from fhir.resources.R4B.identifier import Identifier
-from fhir.resources.R4B.meta import Meta
 from structlog import get_logger
 
 from ahd2fhir import config
-from ahd2fhir.utils.fhir_utils import sha256_of_identifier
+from ahd2fhir.utils import fhir_dicts
+from ahd2fhir.utils import fhir_fragments as fragments
+from ahd2fhir.utils.fhir_utils import sha256_of_system_and_value
 
 log = get_logger()
 
@@ -30,6 +29,24 @@ SIDE_MAPPING: dict[str, tuple[str, str]] = {
 
 EXTRACT_YEAR_FROM_ICD_REGEX = r"ICD.*_(?P<version>\d{4})"
 
+CONDITION_META_DICT = fragments.as_dict(fragments.meta(FHIR_SYSTEMS.condition_profile))
+CLINICAL_STATUS_DICTS = {
+    clinical_status: fragments.as_dict(
+        fragments.codeable_concept(
+            fragments.coding(FHIR_SYSTEMS.condition_clinical_status, status_code)
+        )
+    )
+    for clinical_status, status_code in CLINICAL_STATUS_MAPPING.items()
+}
+BODY_SITE_DICTS = {
+    side: fragments.as_dict(
+        fragments.codeable_concept(
+            fragments.coding(FHIR_SYSTEMS.snomed_ct, code, display=display)
+        )
+    )
+    for side, (code, display) in SIDE_MAPPING.items()
+}
+
 
 def get_fhir_condition(
     ahd_response_entry, document_reference: DocumentReference
@@ -43,30 +60,20 @@ def get_fhir_condition(
 def get_condition_from_annotation(
     annotation, doc_ref: DocumentReference
 ) -> Condition | None:
-    condition = Condition.construct()
-
-    condition.subject = doc_ref.subject
-    if doc_ref.date is not None:
-        condition.recordedDate = doc_ref.date
-    else:
-        condition.recordedDate = DateTime.validate(
-            datetime.datetime.now(datetime.timezone.utc)
-        )
-
-    condition.encounter = (
-        doc_ref.context.encounter[0]
-        if doc_ref.context is not None and len(doc_ref.context.encounter) > 0
-        else None
+    condition = get_fhir_condition_dict(
+        annotation, fhir_dicts.get_document_elements(doc_ref)
     )
+    if condition is None:
+        return None
+    return fhir_dicts.construct(Condition, condition)
 
-    condition_identifier = build_identifier_from_annotation(annotation, doc_ref)
-
-    condition.identifier = [condition_identifier]
-
-    condition.id = sha256_of_identifier(condition_identifier)
 
-    condition.meta = Meta.construct()
-    condition.meta.profile = [FHIR_SYSTEMS.condition_profile]
+def get_fhir_condition_dict(ahd_response_entry, document: dict) -> dict | None:
+    """
+    Maps the annotation and the document given as a dict to a Condition given
+    as a dict, without constructing any models
+    """
+    annotation = ahd_response_entry
 
     if annotation.get("belongsTo") in ["FAMILY", "OTHER"]:
         log.warning("Dropped condition result because it refers to family history")
@@ -76,63 +83,64 @@ def get_condition_from_annotation(
         log.warning("Dropped condition result due to negation")
         return None
 
-    # Terminologie
     if "ICD10GM" in str(annotation.get("source")):
         system = FHIR_SYSTEMS.icd_10_gm
     else:
         log.warning("Unknown coding source. Ignoring.", source=annotation.get("source"))
         return None
 
-    condition_coding = Coding.construct()
-    condition_coding.system = system
-    condition_coding.display = annotation.get("dictCanon")
-    condition_coding.code = annotation.get("conceptID")
-    condition_coding.userSelected = False
-
+    version = None
     if match := re.search(EXTRACT_YEAR_FROM_ICD_REGEX, annotation.get("source")):
-        condition_coding.version = match.group("version")
+        version = match.group("version")
     else:
         log.warning("Could not extract version from ICD system. Not setting it.")
 
-    condition_code = CodeableConcept.construct()
-    condition_code.coding = [condition_coding]
-
-    condition.code = condition_code
+    condition_coding = fhir_dicts.compact(
+        {
+            "system": system,
+            "version": version,
+            "code": annotation.get("conceptID"),
+            "display": annotation.get("dictCanon"),
+            "userSelected": False,
+        }
+    )
 
-    if clinical_status := annotation.get("clinicalStatus"):
-        status_code = CLINICAL_STATUS_MAPPING.get(clinical_status)
-        if status_code is not None:
-            clinical_status_coding = Coding.construct()
-            clinical_status_coding.system = FHIR_SYSTEMS.condition_clinical_status
-            clinical_status_coding.code = status_code
-            clinical_status_code = CodeableConcept.construct()
-            clinical_status_code.coding = [clinical_status_coding]
-            condition.clinicalStatus = clinical_status_code
+    clinical_status = None
+    if status := annotation.get("clinicalStatus"):
+        clinical_status = CLINICAL_STATUS_DICTS.get(status)
 
+    body_site = None
     if (side := annotation.get("side")) is not None:
-        body_side_snomed = SIDE_MAPPING.get(side)
-
-        if body_side_snomed is None:
+        body_site = BODY_SITE_DICTS.get(side)
+        if body_site is None:
             log.warning(
                 "Could not map body side from annotation to a SNOMED concept.",
                 annotation_side=side,
             )
-            return condition
-
-        body_side_code = CodeableConcept.construct()
-        body_side_code.coding = []
-
-        body_side_coding = Coding.construct()
-        body_side_coding.system = FHIR_SYSTEMS.snomed_ct
-        body_side_coding.code = body_side_snomed[0]
-        body_side_coding.display = body_side_snomed[1]
 
-        body_side_code.coding.append(body_side_coding)
+    recorded_date = document.get("date")
+    if recorded_date is None:
+        recorded_date = DateTime.validate(datetime.datetime.now(datetime.timezone.utc))
 
-        condition.bodySite = []
-        condition.bodySite.append(body_side_code)
+    encounters = (document.get("context") or {}).get("encounter", [])
+    identifier = build_identifier_dict_from_annotation(
+        annotation, fhir_dicts.get_document_identifier_value(document)
+    )
 
-    return condition
+    return fhir_dicts.compact(
+        {
+            "resourceType": "Condition",
+            "id": sha256_of_system_and_value(identifier["system"], identifier["value"]),
+            "meta": CONDITION_META_DICT,
+            "identifier": [identifier],
+            "clinicalStatus": clinical_status,
+            "code": {"coding": [condition_coding]},
+            "bodySite": [body_site] if body_site is not None else None,
+            "subject": document.get("subject"),
+            "encounter": encounters[0] if len(encounters) > 0 else None,
+            "recordedDate": recorded_date,
+        }
+    )
 
 
 def build_identifier_from_annotation(annotation, doc_ref: DocumentReference):
@@ -141,21 +149,15 @@ def build_identifier_from_annotation(annotation, doc_ref: DocumentReference):
     the document identifier as well as the offset into the text
     and the unique id of the annotation
     """
-    doc_ref_identifier = None
-    if doc_ref.identifier is None or len(doc_ref.identifier) == 0:
-        log.warning(
-            "No identifier specified on the document. "
-            + "Trying to fall-back to the DocumentReference.id"
-        )
-        doc_ref_identifier = doc_ref.id
-    else:
-        if len(doc_ref.identifier) > 1:
-            log.warning(
-                "More than one identifier specified on the document. "
-                + "Using the first occurrence."
-            )
-        doc_ref_identifier = doc_ref.identifier[0].value
+    doc_ref_identifier = fhir_dicts.get_document_identifier_value(
+        fhir_dicts.get_document_elements(doc_ref)
+    )
+    return Identifier(
+        **build_identifier_dict_from_annotation(annotation, doc_ref_identifier)
+    )
+
 
+def build_identifier_dict_from_annotation(annotation, doc_ref_identifier) -> dict:
     condition_identifier_system = (
         "https://fhir.miracum.org/nlp/identifiers/"
         + f"{annotation['type'].replace('.', '-').lower()}"
@@ -167,6 +169,4 @@ def build_identifier_from_annotation(annotation, doc_ref: DocumentReference):
         + f"{annotation.get('uniqueID')}".replace(":", "-")
     )
 
-    return Identifier(
-        **{"system": condition_identifier_system, "value": condition_identifier_value}
-    )
+    return {"system": condition_identifier_system, "value": condition_identifier_value}
@@ -1,36 +1,23 @@
-from hashlib import sha256
+from typing import Any, Iterable, Tuple
 
-from fhir.resources.R4B.codeableconcept import CodeableConcept
-from fhir.resources.R4B.coding import Coding
 from fhir.resources.R4B.documentreference import DocumentReference
-from fhir.resources.R4B.fhirprimitiveextension import FHIRPrimitiveExtension
-from fhir.resources.R4B.identifier import Identifier
 from fhir.resources.R4B.list import List
-from fhir.resources.R4B.meta import Meta
-from fhir.resources.R4B.reference import Reference
+from fhir.resources.R4B.medicationstatement import MedicationStatement
 from structlog import get_logger
 
 from ahd2fhir import config
 from ahd2fhir.mappers.ahd_to_medication_statement import (
     get_medication_statement_from_annotation,
 )
+from ahd2fhir.utils import fhir_dicts
+from ahd2fhir.utils import fhir_fragments as fragments
 from ahd2fhir.utils.const import AHD_TYPE_MEDICATION
+from ahd2fhir.utils.fhir_utils import sha256_of_system_and_value
 
 log = get_logger()
 
 FHIR_SYSTEMS = config.FhirSystemSettings()
 
-DATA_ABSENT_EXTENSION_UNKNOWN = FHIRPrimitiveExtension(
-    **{
-        "extension": [
-            {
-                "url": "http://hl7.org/fhir/StructureDefinition/data-absent-reason",
-                "valueCode": "unknown",
-            }
-        ]
-    }
-)
-
 LIST_CONTEXT_CODE_MAPPING = {
     "ADMISSION": "E210",
     "INPATIENT": "E200",
@@ -43,22 +30,23 @@ LIST_CONTEXT_CODE_SYSTEM = (
 LIST_MED_CODE = "medications"
 LIST_MED_CODE_SYSTEM = "http://terminology.hl7.org/CodeSystem/list-example-use-codes"
 
-
-def get_medication_statement_reference(annotation, document_reference):
-    medication_statement = get_medication_statement_from_annotation(
-        annotation, document_reference
+LIST_META_DICT = fragments.as_dict(fragments.meta(FHIR_SYSTEMS.medication_list_profile))
+LIST_CODE_DICTS = {
+    list_type: fragments.as_dict(
+        fragments.codeable_concept(
+            fragments.coding(LIST_MED_CODE_SYSTEM, LIST_MED_CODE),
+            fragments.coding(LIST_CONTEXT_CODE_SYSTEM, context_code),
+            text="List Code",
+        )
     )
-
-    if medication_statement is None:
-        return None
-
-    medication_reference = Reference.construct()
-    medication_reference.type = f"{medication_statement.resource_type}"
-    medication_reference.identifier = medication_statement.identifier[0]
-    medication_reference.reference = (
-        f"{medication_statement.resource_type}/{medication_statement.id}"
+    for list_type, context_code in LIST_CONTEXT_CODE_MAPPING.items()
+}
+EMPTY_REASON_DICTS = {
+    list_type: fragments.freeze(
+        {"text": f"No {list_type.lower()} entries in document found."}
     )
-    return medication_reference
+    for list_type in LIST_CONTEXT_CODE_MAPPING
+}
 
 
 # TODO: could be refactored to just return the list of List resources.
@@ -75,106 +63,151 @@ def get_fhir_list(annotation_results, document_reference: DocumentReference):
 def get_medication_list_from_document_reference(
     annotation_results, document_reference: DocumentReference
 ):
-    base_list = List.construct(
-        status="current",
-        mode="snapshot",
-        title="discharge",
-        subject=document_reference.subject,
+    """
+    Maps the medication annotations to MedicationStatements to build the lists
+    from. Use build_medication_lists if they are already mapped.
+    """
+    if len(annotation_results) < 1:
+        return None
+
+    medication_statements = (
+        (
+            annotation,
+            get_medication_statement_from_annotation(annotation, document_reference),
+        )
+        for annotation in annotation_results
+        if annotation["type"] == AHD_TYPE_MEDICATION
     )
 
-    metadata = Meta.construct()
-    metadata.profile = [FHIR_SYSTEMS.medication_list_profile]
-    base_list.meta = metadata
+    return build_medication_lists(medication_statements, document_reference)
 
-    list_creation_date = document_reference.date
-    base_list.date = list_creation_date
 
-    document_identifier_value = (
-        document_reference.identifier[0].value
-        if document_reference.identifier is not None
-        else document_reference.id
+def build_medication_lists(
+    medication_statements: Iterable[Tuple[dict, MedicationStatement | None]],
+    document_reference: DocumentReference,
+):
+    """
+    Builds the admission, inpatient and discharge medication lists from the
+    medication annotations and the MedicationStatements already mapped from them
+    """
+    lists = _build_medication_list_dicts(
+        (
+            # the identifier model is shared by the list entry, like the
+            # elements of the document
+            (
+                (annotation, None, None)
+                if statement is None
+                else (annotation, statement.id, statement.identifier[0])
+            )
+            for annotation, statement in medication_statements
+        ),
+        fhir_dicts.get_document_elements(document_reference),
     )
+    return {
+        list_type: fhir_dicts.construct(List, medication_list)
+        for list_type, medication_list in lists.items()
+    }
 
-    if len(annotation_results) < 1:
-        return None
 
-    med_entries: dict[str, list] = {"ADMISSION": [], "DISCHARGE": [], "INPATIENT": []}
+def build_medication_list_dicts(
+    medication_statements: Iterable[Tuple[dict, dict | None]],
+    document: dict,
+):
+    """
+    Builds the admission, inpatient and discharge medication lists as dicts
+    from the medication annotations, the MedicationStatements already mapped
+    from them and the document, all given as dicts, without constructing any
+    models
+    """
+    return _build_medication_list_dicts(
+        (
+            (
+                (annotation, None, None)
+                if statement is None
+                else (annotation, statement["id"], statement["identifier"][0])
+            )
+            for annotation, statement in medication_statements
+        ),
+        document,
+    )
 
-    for annotation in annotation_results:
-        if annotation["type"] != AHD_TYPE_MEDICATION:
-            continue
 
+def _build_medication_list_dicts(
+    medication_statements: Iterable[Tuple[dict, str | None, Any]],
+    document: dict,
+):
+    """
+    Builds the lists from the annotations paired with the id and the first
+    identifier of the MedicationStatement mapped from them, or None if none was
+    """
+    document_identifier_value = (
+        document["identifier"][0].get("value")
+        if "identifier" in document
+        else document.get("id")
+    )
+
+    med_entries: dict[str, list] = {"ADMISSION": [], "DISCHARGE": [], "INPATIENT": []}
+
+    for annotation, statement_id, statement_identifier in medication_statements:
         status = annotation.get("status")
         if status == "NEGATED" or status == "FAMILY":
             log.warning("annotation status is NEGATED or FAMILY.")
             continue
-        if med_entries.keys().__contains__(status) is False:
+        if status not in med_entries:
             log.warning(
                 "Annotation not part of admission, inpatient or discharge list."
             )
             continue
 
-        medication_statement_reference = get_medication_statement_reference(
-            annotation, document_reference
-        )
-        if medication_statement_reference is None:
+        if statement_id is None:
             continue
 
-        med_entry = {
-            "item": medication_statement_reference,
+        item = {
+            "reference": f"MedicationStatement/{statement_id}",
+            "type": "MedicationStatement",
+            "identifier": statement_identifier,
         }
 
         # lst-3 "An entry date can only be used if the mode of the list is "working""
         if status == "INPATIENT":
-            med_entry["date"] = document_reference.date
-
-        med_entries[status].append(med_entry)
+            med_entries[status].append(
+                fhir_dicts.compact({"date": document.get("date"), "item": item})
+            )
+        else:
+            med_entries[status].append({"item": item})
 
     result = {}
 
-    # TODO: refactor to turn list_type into an enum for enhanced type safety
     for list_type in ["DISCHARGE", "ADMISSION", "INPATIENT"]:
-        result[list_type] = base_list.copy(deep=True)
-        result[list_type].entry = med_entries[list_type]
-        result[list_type].title = f"List of {list_type.lower()} medication"
-
-        # medication-list-context-2: Wenn der Kontext stationärer Aufenthalt ist,
-        # soll der mode 'working' sein.
-        if list_type == "INPATIENT":
-            result[list_type].mode = "working"
-
-        empty_reason_coding = Coding.construct(
-            display="No {} entries in document found.".format(list_type.lower())
-        )
-        empty_reason = CodeableConcept.construct(
-            text="No {} entries in document found.".format(list_type.lower()),
-            code=empty_reason_coding,
-        )
-        if len(med_entries[list_type]) == 0:
-            result[list_type].emptyReason = empty_reason
-
-        list_med_coding = Coding.construct(
-            system=LIST_MED_CODE_SYSTEM, code=LIST_MED_CODE
-        )
-        list_coding = Coding.construct(
-            system=LIST_CONTEXT_CODE_SYSTEM, code=LIST_CONTEXT_CODE_MAPPING[list_type]
-        )
-        list_code = CodeableConcept.construct()
-        list_code.text = "List Code"
-        list_code.coding = [list_med_coding, list_coding]
-
-        result[list_type].code = list_code
+        list_identifier = {
+            "system": "https://fhir.miracum.org/nlp/identifiers/"
+            + f"{list_type.lower()}-medication-list",
+            "value": f"{list_type.lower()}_list_{document_identifier_value}",
+        }
 
-        list_identifier = Identifier.construct()
-        list_identifier.system = (
-            "https://fhir.miracum.org/nlp/identifiers/"
-            + f"{list_type.lower()}-medication-list"
+        result[list_type] = fhir_dicts.compact(
+            {
+                "resourceType": "List",
+                "id": sha256_of_system_and_value(
+                    list_identifier["system"], list_identifier["value"]
+                ),
+                "meta": LIST_META_DICT,
+                "identifier": [list_identifier],
+                "status": "current",
+                # medication-list-context-2: Wenn der Kontext stationärer
+                # Aufenthalt ist, soll der mode 'working' sein.
+                "mode": "working" if list_type == "INPATIENT" else "snapshot",
+                "title": f"List of {list_type.lower()} medication",
+                "code": LIST_CODE_DICTS[list_type],
+                "subject": document.get("subject"),
+                "date": document.get("date"),
+                "entry": med_entries[list_type],
+                "emptyReason": (
+                    EMPTY_REASON_DICTS[list_type]
+                    if len(med_entries[list_type]) == 0
+                    else None
+                ),
+            }
         )
-        list_identifier.value = f"{list_type.lower()}_list_{document_identifier_value}"
-
-        result[list_type].identifier = [list_identifier]
-        result[list_type].id = sha256(
-            f"{list_identifier.system}" f"|{list_identifier.value}".encode("utf-8")
-        ).hexdigest()
 
     return result
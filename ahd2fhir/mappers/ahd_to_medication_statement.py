@@ -1,15 +1,11 @@
 import re
 from typing import Union
 
-from fhir.resources.R4B.codeableconcept import CodeableConcept
-from fhir.resources.R4B.coding import Coding
 from fhir.resources.R4B.documentreference import DocumentReference
 from fhir.resources.R4B.dosage import Dosage, DosageDoseAndRate
 from fhir.resources.R4B.fhirprimitiveextension import FHIRPrimitiveExtension
 from fhir.resources.R4B.fhirtypes import DateTime
-from fhir.resources.R4B.identifier import Identifier
 from fhir.resources.R4B.medicationstatement import MedicationStatement
-from fhir.resources.R4B.meta import Meta
 from fhir.resources.R4B.period import Period
 from fhir.resources.R4B.quantity import Quantity
 from fhir.resources.R4B.timing import Timing, TimingRepeat
@@ -17,7 +13,9 @@ from slugify import slugify
 from structlog import get_logger
 
 from ahd2fhir import config
-from ahd2fhir.utils.fhir_utils import sha256_of_identifier
+from ahd2fhir.utils import fhir_dicts
+from ahd2fhir.utils import fhir_fragments as fragments
+from ahd2fhir.utils.fhir_utils import sha256_of_system_and_value
 
 log = get_logger()
 
@@ -57,6 +55,13 @@ DATA_ABSENT_EXTENSION_UNKNOWN = FHIRPrimitiveExtension(
 
 FHIR_SYSTEMS = config.FhirSystemSettings()
 
+MEDICATION_STATEMENT_META_DICT = fragments.as_dict(
+    fragments.meta(MEDICATION_STATEMENT_PROFILE)
+)
+DATA_ABSENT_EXTENSION_UNKNOWN_DICT = fragments.freeze(
+    DATA_ABSENT_EXTENSION_UNKNOWN.dict()
+)
+
 
 def get_fhir_medication_statement(val, document_reference: DocumentReference):
     """
@@ -70,6 +75,20 @@ def get_fhir_medication_statement(val, document_reference: DocumentReference):
 def get_medication_statement_from_annotation(
     annotation, document_reference: DocumentReference
 ) -> MedicationStatement | None:
+    medication_statement = get_fhir_medication_statement_dict(
+        annotation, fhir_dicts.get_document_elements(document_reference)
+    )
+    if medication_statement is None:
+        return None
+    return fhir_dicts.construct(MedicationStatement, medication_statement)
+
+
+def get_fhir_medication_statement_dict(val, document: dict) -> dict | None:
+    """
+    Maps the annotation and the document given as a dict to a
+    MedicationStatement given as a dict, without constructing any models
+    """
+    annotation = val
     annotation_type_lowercase = annotation["type"].replace(".", "-").lower()
     identifier_system = (
         f"{FHIR_SYSTEMS.ahd_to_fhir_base_url}/identifiers/{annotation_type_lowercase}"
@@ -92,62 +111,56 @@ def get_medication_statement_from_annotation(
             "More than one drugs entry found. Defaulting to only the first entry."
         )
 
-    drug = drugs[0]
-    druq_unique_id = slugify(drug["ingredient"]["uniqueID"])
-
-    medication_statement = MedicationStatement.construct(
-        status=STATUS_MAPPING.get(annotation["status"], "unknown"),
-        medicationCodeableConcept=CodeableConcept.construct(),
-    )
-
-    medication_statement.meta = Meta.construct()
-    medication_statement.meta.profile = [MEDICATION_STATEMENT_PROFILE]
+    druq_unique_id = slugify(drugs[0]["ingredient"]["uniqueID"])
 
-    medication_statement.subject = document_reference.subject
-    medication_statement.context = (
-        document_reference.context.encounter[0]
-        if document_reference.context is not None
-        else None
-    )
     document_identifier_value = (
-        document_reference.identifier[0].value
-        if document_reference.identifier is not None
-        else None
-    )
-
-    statement_identifier = Identifier.construct()
-    statement_identifier.system = identifier_system
-    statement_identifier.value = (
-        f"{druq_unique_id}" + f"_{document_identifier_value}" + f"_{annotation['id']}"
+        document["identifier"][0].get("value") if "identifier" in document else None
     )
-
-    medication_statement.identifier = [statement_identifier]
-    medication_statement.id = sha256_of_identifier(statement_identifier)
-
-    medication_statement.effectiveDateTime__ext = DATA_ABSENT_EXTENSION_UNKNOWN
-    medication_statement.dateAsserted = document_reference.date
+    statement_identifier = {
+        "system": identifier_system,
+        "value": f"{druq_unique_id}"
+        + f"_{document_identifier_value}"
+        + f"_{annotation['id']}",
+    }
 
     codings = []
     for atc_code in atc_codes:
-        coding = Coding.construct()
-        coding.system = FHIR_SYSTEMS.atc
-        coding.code = atc_code["conceptID"]
-        coding.display = atc_code["dictCanon"]
-
+        version = None
         year_match = re.search(r"_(\d{4})$", atc_code["source"])
         if year_match:
-            year = year_match.group(1)
-            coding.version = year
+            version = year_match.group(1)
         else:
             log.warn(
                 f"Unable to extract version from atcCode source: {atc_code['source']}"
             )
 
-        codings.append(coding)
-
-    medication_statement.medicationCodeableConcept.coding = codings
+        codings.append(
+            fhir_dicts.compact(
+                {
+                    "system": FHIR_SYSTEMS.atc,
+                    "version": version,
+                    "code": atc_code["conceptID"],
+                    "display": atc_code["dictCanon"],
+                }
+            )
+        )
 
-    return medication_statement
+    return fhir_dicts.compact(
+        {
+            "resourceType": "MedicationStatement",
+            "id": sha256_of_system_and_value(
+                statement_identifier["system"], statement_identifier["value"]
+            ),
+            "meta": MEDICATION_STATEMENT_META_DICT,
+            "identifier": [statement_identifier],
+            "status": STATUS_MAPPING.get(annotation["status"], "unknown"),
+            "medicationCodeableConcept": {"coding": codings},
+            "subject": document.get("subject"),
+            "context": fhir_dicts.get_first_encounter(document),
+            "_effectiveDateTime": DATA_ABSENT_EXTENSION_UNKNOWN_DICT,
+            "dateAsserted": document.get("date"),
+        }
+    )
 
 
 def get_medication_interval_from_annotation(
@@ -1,16 +1,16 @@
 import datetime
+import decimal
 import uuid
 from typing import List
 
-from fhir.resources.R4B.codeableconcept import CodeableConcept
-from fhir.resources.R4B.coding import Coding
 from fhir.resources.R4B.documentreference import DocumentReference
-from fhir.resources.R4B.fhirtypes import DateTime, QuantityType, ReferenceType
-from fhir.resources.R4B.meta import Meta
+from fhir.resources.R4B.fhirtypes import DateTime
 from fhir.resources.R4B.observation import Observation
 from structlog import get_logger
 
 from ahd2fhir import config
+from ahd2fhir.utils import fhir_dicts
+from ahd2fhir.utils import fhir_fragments as fragments
 
 log = get_logger()
 
@@ -49,135 +49,130 @@ STONE_DIMENSION_MAP = {
     },
 }
 
-
-def get_fhir_resources(
-    ahd_response_entry, document_reference: DocumentReference
-) -> List[Observation]:
-    return get_kidney_stone_from_annotation(
-        annotation=ahd_response_entry,
-        date=document_reference.date,
-        doc_ref=document_reference,
+OBSERVATION_META = fragments.meta(OBSERVATION_PROFILE)
+KIDNEY_STONE_CODE = fragments.codeable_concept(
+    fragments.coding(
+        FHIR_SYSTEMS.snomed_ct,
+        "95570007",
+        display="Kidney stone (disorder)",
+        user_selected=False,
+    ),
+    text="Kidney stone",
+)
+IMAGING_CATEGORY = fragments.codeable_concept(
+    fragments.coding(OBSERVATION_CATEGORY_SYSTEM, "imaging", display="Imaging")
+)
+RADIOGRAPHIC_IMAGING_METHOD = fragments.codeable_concept(
+    fragments.coding(
+        FHIR_SYSTEMS.snomed_ct,
+        "363680008",
+        display=" Radiographic imaging procedure",
     )
+)
+CALCULUS_VALUE = fragments.codeable_concept(
+    fragments.coding(FHIR_SYSTEMS.snomed_ct, "56381008"),
+    text="Calculus (morphologic abnormality)",
+)
+STONE_DIMENSION_CODES = {
+    dimension: fragments.codeable_concept(
+        fragments.coding(
+            FHIR_SYSTEMS.loinc,
+            dimension_type["code"],
+            display=dimension_type["display"],
+            user_selected=False,
+        ),
+        text=dimension_type["name"],
+    )
+    for dimension, dimension_type in STONE_DIMENSION_MAP.items()
+}
 
-
-def fhirdate_now() -> DateTime:
-    return DateTime.validate(datetime.datetime.now(datetime.timezone.utc))
+OBSERVATION_META_DICT = fragments.as_dict(OBSERVATION_META)
+KIDNEY_STONE_CODE_DICT = fragments.as_dict(KIDNEY_STONE_CODE)
+IMAGING_CATEGORY_DICT = fragments.as_dict(IMAGING_CATEGORY)
+RADIOGRAPHIC_IMAGING_METHOD_DICT = fragments.as_dict(RADIOGRAPHIC_IMAGING_METHOD)
+CALCULUS_VALUE_DICT = fragments.as_dict(CALCULUS_VALUE)
+STONE_DIMENSION_CODE_DICTS = {
+    dimension: fragments.as_dict(code)
+    for dimension, code in STONE_DIMENSION_CODES.items()
+}
 
 
-def get_kidney_stone_from_annotation(
-    annotation, date, doc_ref: DocumentReference
+def get_fhir_resources(
+    ahd_response_entry, document_reference: DocumentReference
 ) -> List[Observation]:
-    # Observation details
-    observation = Observation.construct()
-    observation.status = "final"
-    observation.meta = Meta.construct()
-    observation.meta.profile = [OBSERVATION_PROFILE]
-    observation.subject = doc_ref.subject
-    observation.effectiveDateTime = date or fhirdate_now()
-    observation.id = str(uuid.uuid4())
-    observation.encounter = (
-        doc_ref.context.encounter[0] if doc_ref.context is not None else None
-    )
-
-    # Coding + Code
-    observation_coding = Coding.construct()
-    observation_coding.system = FHIR_SYSTEMS.snomed_ct
-    observation_coding.code = "95570007"
-    observation_coding.display = "Kidney stone (disorder)"
-    observation_coding.userSelected = False
-    observation_code = CodeableConcept.construct()
-    observation_code.coding = [observation_coding]
-    observation_code.text = "Kidney stone"
-    observation.code = observation_code
-
-    # Category
-    observation_category = Coding.construct()
-    observation_category.system = OBSERVATION_CATEGORY_SYSTEM
-    observation_category.code = "imaging"
-    observation_category.display = "Imaging"
-    category = CodeableConcept.construct()
-    category.coding = [observation_category]
-    observation.category = [category]
-
-    # Method
-    observation_method = Coding.construct()
-    observation_method.system = FHIR_SYSTEMS.snomed_ct
-    observation_method.code = "363680008"
-    observation_method.display = " Radiographic imaging procedure"
-    method = CodeableConcept.construct()
-    method.coding = [observation_method]
-    observation.method = method
-
-    # valueCodeableConcept
-    value_codeable_concept = CodeableConcept()
-    value_coding = Coding.construct()
-    value_coding.system = FHIR_SYSTEMS.snomed_ct
-    value_coding.code = "56381008"
-    value_codeable_concept.coding = [value_coding]
-    value_codeable_concept.text = "Calculus (morphologic abnormality)"
-    observation.valueCodeableConcept = value_codeable_concept
-
+    return [
+        fhir_dicts.construct(Observation, observation)
+        for observation in get_fhir_resources_dict(
+            ahd_response_entry, fhir_dicts.get_document_elements(document_reference)
+        )
+    ]
+
+
+def get_fhir_resources_dict(ahd_response_entry, document: dict) -> List[dict]:
+    """
+    Maps a kidney stone annotation and the document given as a dict to
+    Observations given as dicts, without constructing any models
+    """
+    annotation = ahd_response_entry
+
+    observation = {
+        "resourceType": "Observation",
+        "id": str(uuid.uuid4()),
+        "meta": OBSERVATION_META_DICT,
+        "status": "final",
+        "category": [IMAGING_CATEGORY_DICT],
+        "code": KIDNEY_STONE_CODE_DICT,
+        "subject": document.get("subject"),
+        "encounter": fhir_dicts.get_first_encounter(document),
+        "effectiveDateTime": document.get("date") or fhirdate_now(),
+        "valueCodeableConcept": CALCULUS_VALUE_DICT,
+        "method": RADIOGRAPHIC_IMAGING_METHOD_DICT,
+    }
     observations = [observation]
 
-    # Create Observation for each Dimension (X/Y)
     if (stone_size := annotation["size"]) is not None:
-        observation.hasMember = []
         stone_unit = stone_size["unit"]["coveredText"]
         stone_len = stone_size["value1"]
-        stone_len_obs = stone_dimension_observation(
-            observation, "length", stone_len, unit=stone_unit
-        )
-        observation.hasMember.append(stone_len_obs[1])
-        observations.append(stone_len_obs[0])
-
         stone_width = stone_size["value2"]
         if stone_width in [0, "0"]:
             stone_width = stone_len
-        stone_width_obs = stone_dimension_observation(
-            observation, "width", stone_width, unit=stone_unit
-        )
-        observation.hasMember.append(stone_width_obs[1])
-        observations.append(stone_width_obs[0])
-
-    return observations
-
-
-def stone_dimension_observation(
-    parent: Observation, dimension: str, value: float, unit: str
-):
-    dimension_type = STONE_DIMENSION_MAP[dimension]
-    # Observation details
-    observation = Observation.construct()
-    observation.status = "final"
-    observation.meta = Meta.construct()
-    observation.meta.profile = [OBSERVATION_PROFILE]
-    observation.subject = parent.subject
-    observation.effectiveDateTime = parent.effectiveDateTime
-    observation.id = str(uuid.uuid4())
-
-    # Coding
-    observation_coding = Coding.construct()
-    observation_coding.system = FHIR_SYSTEMS.loinc
-    observation_coding.code = dimension_type["code"]
-    observation_coding.display = dimension_type["display"]
-    observation_coding.userSelected = False
-    # Code
-    observation_code = CodeableConcept.construct()
-    observation_code.coding = [observation_coding]
-    observation_code.text = dimension_type["name"]
-    observation.code = observation_code
-
-    # valueCodeableConcept
-    value_quantity = QuantityType()
-    value_quantity["system"] = FHIR_SYSTEMS.ucum
-    value_quantity["code"] = unit
-    value_quantity["value"] = value
-    value_quantity["unit"] = unit
-    observation.valueQuantity = value_quantity
-
-    # Create Reference to Observation
-    observation_reference = ReferenceType()
-    observation_reference["reference"] = f"Observation/{observation.id}"
-    observation_reference["display"] = observation.code.coding[0].display
-
-    return observation, observation_reference
+
+        observation["hasMember"] = []
+        for dimension, value in [("length", stone_len), ("width", stone_width)]:
+            dimension_observation = stone_dimension_observation_dict(
+                observation, dimension, value, unit=stone_unit
+            )
+            observation["hasMember"].append(
+                {
+                    "reference": f"Observation/{dimension_observation['id']}",
+                    "display": STONE_DIMENSION_MAP[dimension]["display"],
+                }
+            )
+            observations.append(dimension_observation)
+
+    return [fhir_dicts.compact(observation) for observation in observations]
+
+
+def stone_dimension_observation_dict(
+    parent: dict, dimension: str, value: float, unit: str
+) -> dict:
+    return {
+        "resourceType": "Observation",
+        "id": str(uuid.uuid4()),
+        "meta": OBSERVATION_META_DICT,
+        "status": "final",
+        "code": STONE_DIMENSION_CODE_DICTS[dimension],
+        "subject": parent.get("subject"),
+        "effectiveDateTime": parent["effectiveDateTime"],
+        # Quantity.value is a decimal, parsed from its string like the model does
+        "valueQuantity": {
+            "value": decimal.Decimal(str(value)),
+            "unit": unit,
+            "system": FHIR_SYSTEMS.ucum,
+            "code": unit,
+        },
+    }
+
+
+def fhirdate_now() -> DateTime:
+    return DateTime.validate(datetime.datetime.now(datetime.timezone.utc))
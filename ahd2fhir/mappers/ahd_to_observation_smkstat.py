@@ -3,15 +3,14 @@ import os
 import uuid
 from typing import List
 
-from fhir.resources.R4B.codeableconcept import CodeableConcept
-from fhir.resources.R4B.coding import Coding
 from fhir.resources.R4B.documentreference import DocumentReference
-from fhir.resources.R4B.fhirtypes import DateTime, String
-from fhir.resources.R4B.meta import Meta
+from fhir.resources.R4B.fhirtypes import DateTime
 from fhir.resources.R4B.observation import Observation
 from structlog import get_logger
 
 from ahd2fhir import config
+from ahd2fhir.utils import fhir_dicts
+from ahd2fhir.utils import fhir_fragments as fragments
 
 log = get_logger()
 
@@ -41,87 +40,101 @@ SNOMED_LOINC_MAPPING = {
 }
 
 
-def get_fhir_resources(
-    ahd_response_entry, document_reference: DocumentReference
-) -> List[Observation]:
-    return get_smoking_status_observation_from_annotation(
-        annotation=ahd_response_entry,
-        date=document_reference.date,
-        doc_ref=document_reference,
+OBSERVATION_META = fragments.meta(OBSERVATION_PROFILE)
+SMOKING_STATUS_CODE = fragments.codeable_concept(
+    fragments.coding(
+        FHIR_SYSTEMS.loinc,
+        "72166-2",
+        display="Tobacco smoking status",
+        user_selected=False,
+    ),
+    text="Tobacco smoking status",
+)
+SOCIAL_HISTORY_CATEGORY = fragments.codeable_concept(
+    fragments.coding(
+        OBSERVATION_CATEGORY_SYSTEM, "social-history", display="Social History"
     )
+)
 
-
-def fhirdate_now():
-    return DateTime.validate(datetime.datetime.now(datetime.timezone.utc))
+OBSERVATION_META_DICT = fragments.as_dict(OBSERVATION_META)
+SMOKING_STATUS_CODE_DICT = fragments.as_dict(SMOKING_STATUS_CODE)
+SOCIAL_HISTORY_CATEGORY_DICT = fragments.as_dict(SOCIAL_HISTORY_CATEGORY)
+SMOKING_STATUS_LOINC_CODING_DICTS = {
+    smoking_status: fragments.as_dict(
+        fragments.coding(FHIR_SYSTEMS.loinc, smkstat["code"])
+    )
+    for smoking_status, smkstat in SNOMED_LOINC_MAPPING.items()
+}
 
 
-def get_smoking_status_observation_from_annotation(
-    annotation, date, doc_ref: DocumentReference
-):
-    # Observation details
-    observation = Observation.construct()
-    observation.status = "final"
-    observation.meta = Meta.construct()
-    observation.meta.profile = [OBSERVATION_PROFILE]
-    observation.subject = doc_ref.subject
-    observation.effectiveDateTime = date or fhirdate_now()
-    observation.id = str(uuid.uuid4())
-    observation.encounter = (
-        doc_ref.context.encounter[0] if doc_ref.context is not None else None
-    )
+def is_value_string_enabled() -> bool:
+    return os.getenv("SMKSTAT_AS_VALUESTRING", "").lower() in ["true", "1", "yes"]
 
-    # Coding
-    observation_coding = Coding.construct()
-    observation_coding.system = FHIR_SYSTEMS.loinc
-    observation_coding.code = "72166-2"
-    observation_coding.display = "Tobacco smoking status"
-    observation_coding.userSelected = False
-
-    # Code
-    observation_code = CodeableConcept.construct()
-    observation_code.coding = [observation_coding]
-    observation_code.text = "Tobacco smoking status"
-    observation.code = observation_code
-
-    # Category
-    observation_category = Coding.construct()
-    observation_category.system = OBSERVATION_CATEGORY_SYSTEM
-    observation_category.code = "social-history"
-    observation_category.display = "Social History"
-    category = CodeableConcept.construct()
-    category.coding = [observation_category]
-    observation.category = [category]
 
+def get_fhir_resources(
+    ahd_response_entry,
+    document_reference: DocumentReference,
+    as_value_string: bool | None = None,
+) -> List[Observation]:
+    """
+    Maps a smoking status annotation. If as_value_string isn't given, it is
+    read from the SMKSTAT_AS_VALUESTRING environment variable.
+    """
+    return [
+        fhir_dicts.construct(Observation, observation)
+        for observation in get_fhir_resources_dict(
+            ahd_response_entry,
+            fhir_dicts.get_document_elements(document_reference),
+            as_value_string,
+        )
+    ]
+
+
+def get_fhir_resources_dict(
+    ahd_response_entry,
+    document: dict,
+    as_value_string: bool | None = None,
+) -> List[dict]:
+    """
+    Maps a smoking status annotation and the document given as a dict to
+    Observations given as dicts, without constructing any models
+    """
+    if as_value_string is None:
+        as_value_string = is_value_string_enabled()
+
+    annotation = ahd_response_entry
     smkstat = SNOMED_LOINC_MAPPING[annotation["smokingStatus"]]
 
-    # If SMKSTAT_AS_VALUESTRING is set
-    if os.getenv("SMKSTAT_AS_VALUESTRING", "").lower() in ["true", 1, "yes"]:
-        # Code Resource as fhirTypes.valueString
-        observation.valueString = String(smkstat["text"])
+    value_codeable_concept = None
+    value_string = None
+    if as_value_string:
+        value_string = smkstat["text"]
     else:
-        # Code Resource as valueCodeableConcept
-        codeable_concept = CodeableConcept()
-
-        # Create LOINC coding
-        coding_loinc = Coding.construct()
-        coding_loinc.system = FHIR_SYSTEMS.loinc
-        coding_loinc.code = smkstat["code"]
-
-        # Create snomed coding
-        coding_snomed = Coding.construct()
-        coding_snomed.system = FHIR_SYSTEMS.snomed_ct
-        coding_snomed.code = annotation["sctid"]
-
-        codeable_concept.coding = [coding_loinc, coding_snomed]
-        codeable_concept.text = smkstat["text"]
-        observation.valueCodeableConcept = codeable_concept
-
-    # if pack_years := annotation["packYears"] != "null":
-    # valueCodeableConcept
-    # value_quantity = QuantityType()
-    # value_quantity["value"] = pack_years
-    # value_quantity.system = FHIR_SYSTEMS.snomed_ct
-    # value_quantity.code = "401201003"
-    # value_quantity.text = "401201003"
-    # observation.valueQuantity = value_quantity
-    return [observation]
+        value_codeable_concept = {
+            "coding": [
+                SMOKING_STATUS_LOINC_CODING_DICTS[annotation["smokingStatus"]],
+                fhir_dicts.compact(
+                    {"system": FHIR_SYSTEMS.snomed_ct, "code": annotation["sctid"]}
+                ),
+            ],
+            "text": smkstat["text"],
+        }
+
+    observation = {
+        "resourceType": "Observation",
+        "id": str(uuid.uuid4()),
+        "meta": OBSERVATION_META_DICT,
+        "status": "final",
+        "category": [SOCIAL_HISTORY_CATEGORY_DICT],
+        "code": SMOKING_STATUS_CODE_DICT,
+        "subject": document.get("subject"),
+        "encounter": fhir_dicts.get_first_encounter(document),
+        "effectiveDateTime": document.get("date") or fhirdate_now(),
+        "valueCodeableConcept": value_codeable_concept,
+        "valueString": value_string,
+    }
+    return [fhir_dicts.compact(observation)]
+
+
+def fhirdate_now():
+    return DateTime.validate(datetime.datetime.now(datetime.timezone.utc))
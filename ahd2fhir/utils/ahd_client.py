@@ -0,0 +1,261 @@
+import asyncio
+import contextlib
+from typing import AsyncIterator
+
+import requests
+import structlog
+from averbis import Client, Pipeline
+from prometheus_client import Counter, Gauge, Histogram
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from ahd2fhir import config
+from ahd2fhir.utils.analysis_archive import build_analysis_archive
+from ahd2fhir.utils.analysis_cache import (
+    AnalysisCache,
+    build_analysis_cache,
+    get_pipeline_identity,
+)
+from ahd2fhir.utils.mapper_registry import (
+    build_dict_mapper_registry,
+    build_mapper_registry,
+)
+from ahd2fhir.utils.output_validation import build_output_validator
+from ahd2fhir.utils.resource_handler import ResourceHandler
+from ahd2fhir.utils.text_chunking import build_text_chunker
+
+AHD_HTTP_REQUESTS_COUNTER = Counter(
+    "ahd_http_requests", "Number of requests sent to the AHD REST API"
+)
+AHD_HTTP_CONNECTIONS_COUNTER = Counter(
+    "ahd_http_connections_opened",
+    "Number of new connections opened to the AHD REST API. "
+    + "Requests not opening a new connection re-used a kept-alive one.",
+)
+RESOURCE_HANDLER_POOL_SIZE_GAUGE = Gauge(
+    "resource_handler_pool_size", "Number of ResourceHandlers in the pool"
+)
+RESOURCE_HANDLER_POOL_IN_USE_GAUGE = Gauge(
+    "resource_handler_pool_in_use", "Number of ResourceHandlers currently in use"
+)
+RESOURCE_HANDLER_POOL_WAIT_DURATION = Histogram(
+    "resource_handler_pool_wait_seconds",
+    "Time spent waiting for a ResourceHandler to become available",
+    buckets=(0.001, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, "inf"),
+)
+
+log = structlog.get_logger()
+
+
+class _CountingHTTPConnectionPool(HTTPConnectionPool):
+    def _new_conn(self):
+        AHD_HTTP_CONNECTIONS_COUNTER.inc()
+        return super()._new_conn()
+
+
+class _CountingHTTPSConnectionPool(HTTPSConnectionPool):
+    def _new_conn(self):
+        AHD_HTTP_CONNECTIONS_COUNTER.inc()
+        return super()._new_conn()
+
+
+class _CountingHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _CountingHTTPConnectionPool,
+            "https": _CountingHTTPSConnectionPool,
+        }
+
+
+def build_session(settings: config.AhdClientSettings) -> requests.Session:
+    """
+    Create a requests.Session keeping up to `max_in_flight_analyses`
+    connections to AHD alive
+    """
+    adapter = _CountingHTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=settings.max_in_flight_analyses,
+        pool_block=False,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+class PooledClient(Client):
+    """
+    An averbis.Client sending all requests through a shared requests.Session
+    instead of opening a new connection for every call.
+    """
+
+    def __init__(self, *args, session: requests.Session, **kwargs):
+        # needs to be set before calling the base constructor, which may
+        # already send a request to generate an API token
+        self._session = session
+        super().__init__(*args, **kwargs)
+
+    def _run_request(self, method: str, endpoint: str, **kwargs) -> requests.Response:
+        """
+        Prepares the request like Client._run_request, but sends it through
+        the session
+        """
+        AHD_HTTP_REQUESTS_COUNTER.inc()
+
+        kwargs["headers"] = self._default_headers(kwargs.get("headers"))
+        if "json" in kwargs:
+            kwargs["headers"]["Content-Type"] = "application/json"
+
+        if "params" in kwargs:
+            kwargs["params"] = {
+                key: _to_rest_api_value(value)
+                for key, value in kwargs["params"].items()
+            }
+
+        kwargs["verify"] = self._verify_ssl
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self._timeout
+
+        return self._session.request(method, self._build_url(endpoint), **kwargs)
+
+
+def _to_rest_api_value(value):
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    return value
+
+
+class ResourceHandlerPoolTimeoutError(asyncio.TimeoutError):
+    pass
+
+
+class ResourceHandlerPool:
+    """
+    Process-wide pool of ResourceHandlers sharing a single AHD client and pipeline.
+    Used by both the HTTP API and the Kafka consumer.
+    """
+
+    def __init__(self, settings: config.Settings):
+        self.settings = settings
+        self.session = build_session(settings.ahd_client)
+        self.client = get_pooled_averbis_client(settings, self.session)
+        self.pipeline: Pipeline = get_pipeline(settings, self.client)
+        self.analysis_cache = build_pipeline_analysis_cache(settings, self.pipeline)
+        self.analysis_archive = build_analysis_archive(settings.ahd_archive)
+        self.mapper_registry = build_mapper_registry()
+        self.dict_mapper_registry = build_dict_mapper_registry()
+        self.output_validator = build_output_validator(settings.output_validation)
+        self.text_chunker = build_text_chunker(settings.ahd_chunking)
+
+        self.analysis_semaphore = asyncio.Semaphore(
+            settings.ahd_client.max_in_flight_analyses
+        )
+
+        self._available: asyncio.Queue[ResourceHandler] = asyncio.Queue()
+        for _ in range(settings.ahd_client.pool_size):
+            self._available.put_nowait(
+                ResourceHandler(
+                    self.pipeline,
+                    max_concurrent_documents=(
+                        settings.ahd_client.max_concurrent_documents_per_bundle
+                    ),
+                    analysis_semaphore=self.analysis_semaphore,
+                    analysis_cache=self.analysis_cache,
+                    analysis_archive=self.analysis_archive,
+                    mapper_registry=self.mapper_registry,
+                    dict_mapper_registry=self.dict_mapper_registry,
+                    output_validator=self.output_validator,
+                    text_chunker=self.text_chunker,
+                    release_attachment_data=settings.release_attachment_data,
+                )
+            )
+
+        RESOURCE_HANDLER_POOL_SIZE_GAUGE.set(settings.ahd_client.pool_size)
+        RESOURCE_HANDLER_POOL_IN_USE_GAUGE.set(0)
+
+    @contextlib.asynccontextmanager
+    async def acquire(self) -> AsyncIterator[ResourceHandler]:
+        """
+        Borrow a ResourceHandler from the pool, waiting at most
+        `ahd_client.pool_timeout_seconds` for one to become available.
+        Raises a ResourceHandlerPoolTimeoutError otherwise.
+        """
+        with RESOURCE_HANDLER_POOL_WAIT_DURATION.time():
+            try:
+                handler = await asyncio.wait_for(
+                    self._available.get(),
+                    timeout=self.settings.ahd_client.pool_timeout_seconds,
+                )
+            except asyncio.TimeoutError as exc:
+                raise ResourceHandlerPoolTimeoutError(
+                    "Timed out waiting for a ResourceHandler to become available"
+                ) from exc
+
+        RESOURCE_HANDLER_POOL_IN_USE_GAUGE.inc()
+        try:
+            yield handler
+        finally:
+            RESOURCE_HANDLER_POOL_IN_USE_GAUGE.dec()
+            self._available.put_nowait(handler)
+
+    def close(self):
+        log.info("Closing AHD client session")
+        self.session.close()
+        if self.analysis_cache is not None:
+            self.analysis_cache.close()
+        if self.analysis_archive is not None:
+            self.analysis_archive.close()
+
+
+def get_pipeline(settings: config.Settings, client: Client) -> Pipeline:
+    return client.get_project(settings.ahd_project).get_pipeline(settings.ahd_pipeline)
+
+
+def build_pipeline_analysis_cache(
+    settings: config.Settings, pipeline: Pipeline
+) -> AnalysisCache | None:
+    """
+    Create the configured analysis cache, invalidated if the pipeline changed.
+    The pipeline is only identified once the first text is analyzed, so it
+    may still be created after the cache.
+    """
+    analysis_cache = build_analysis_cache(settings.ahd_cache)
+    if analysis_cache is not None:
+        include_configuration = settings.ahd_cache.include_pipeline_configuration
+        analysis_cache.bind_pipeline_lazily(
+            lambda: get_pipeline_identity(
+                pipeline,
+                version=settings.ahd_cache.pipeline_version,
+                include_configuration=include_configuration,
+            ),
+            # only the configuration changes while running
+            refresh_seconds=(
+                settings.ahd_cache.pipeline_configuration_refresh_seconds
+                if include_configuration
+                else None
+            ),
+        )
+    return analysis_cache
+
+
+def get_pooled_averbis_client(
+    settings: config.Settings, session: requests.Session
+) -> PooledClient:
+    api_token: str | None = None
+    if settings.ahd_api_token:
+        api_token = settings.ahd_api_token
+
+    return PooledClient(
+        url_or_id=settings.ahd_url,
+        api_token=api_token,
+        username=settings.ahd_username,
+        password=settings.ahd_password,
+        timeout=(
+            settings.ahd_client.connect_timeout_seconds,
+            settings.ahd_client.read_timeout_seconds,
+        ),
+        session=session,
+    )
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from typing import IO, List, Tuple
+
+import structlog
+from fhir.resources.R4B.documentreference import DocumentReference
+
+from ahd2fhir import config
+from ahd2fhir.utils.fhir_response import serialize_resource
+from ahd2fhir.utils.resource_decoder import loads
+
+log = structlog.get_logger()
+
+
+def load_annotations(annotations_json: list | dict) -> List[dict]:
+    """
+    Returns the annotations of a raw AHD response. Accepts both a plain list
+    of annotations and a response wrapping them in a `payload`.
+    """
+    if isinstance(annotations_json, dict):
+        return annotations_json["payload"]
+    return annotations_json
+
+
+def build_archive_record(
+    document_reference: DocumentReference, annotations: List[dict]
+) -> bytes:
+    """
+    Serialize an analyzed document to a single NDJSON line. The attachment data
+    is left out as the mappers only need the document's metadata.
+    """
+    document_reference_json = loads(serialize_resource(document_reference))
+    for content in document_reference_json.get("content", []):
+        content.get("attachment", {}).pop("data", None)
+
+    return (
+        json.dumps(
+            {
+                "documentReference": document_reference_json,
+                "annotations": annotations,
+            },
+            ensure_ascii=False,
+            separators=(",", ":"),
+        ).encode("utf8")
+        + b"\n"
+    )
+
+
+def parse_archive_record(
+    record: bytes | str,
+) -> Tuple[DocumentReference, List[dict]]:
+    record_json = loads(record)
+    return (
+        DocumentReference.parse_obj(record_json["documentReference"]),
+        load_annotations(record_json["annotations"]),
+    )
+
+
+class AnalysisArchive:
+    """
+    Appends raw AHD responses together with their DocumentReferences to daily
+    NDJSON files, so the mapping can be replayed later without calling AHD.
+    Every process writes to its own files.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._file: IO[bytes] | None = None
+        self._file_path: str | None = None
+
+    def append(self, document_reference: DocumentReference, annotations: List[dict]):
+        try:
+            record = build_archive_record(document_reference, annotations)
+            with self._lock:
+                self._get_file().write(record)
+                self._file.flush()
+        except Exception as exc:
+            # archiving is best-effort and must never fail the mapping
+            log.exception(exc)
+            log.error("Failed to archive AHD response", error=exc)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _get_file(self) -> IO[bytes]:
+        date = datetime.now(tz=timezone.utc).strftime("%Y-%m-%d")
+        file_path = os.path.join(
+            self.directory, f"ahd-responses-{date}-{os.getpid()}.ndjson"
+        )
+        if file_path != self._file_path or self._file is None:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(file_path, "ab")
+            self._file_path = file_path
+        return self._file
+
+
+def build_analysis_archive(
+    settings: config.AnalysisArchiveSettings,
+) -> AnalysisArchive | None:
+    if settings.directory == "":
+        return None
+    return AnalysisArchive(settings.directory)
@@ -0,0 +1,446 @@
+import abc
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Callable, List, Tuple
+
+import structlog
+from prometheus_client import Counter, Gauge
+
+from ahd2fhir import config
+
+CACHE_HITS_COUNTER = Counter(
+    "analysis_cache_hits", "Number of AHD analysis results read from cache", ["backend"]
+)
+CACHE_MISSES_COUNTER = Counter(
+    "analysis_cache_misses",
+    "Number of AHD analysis results not found in cache",
+    ["backend"],
+)
+CACHE_EVICTIONS_COUNTER = Counter(
+    "analysis_cache_evictions",
+    "Number of cached AHD analysis results evicted to stay below the size limit",
+    ["backend"],
+)
+CACHE_ERRORS_COUNTER = Counter(
+    "analysis_cache_errors",
+    "Number of failed reads and writes of cached AHD analysis results",
+    ["backend", "operation"],
+)
+CACHE_SIZE_BYTES_GAUGE = Gauge(
+    "analysis_cache_size_bytes",
+    "Size of all cached AHD analysis results in bytes",
+    ["backend"],
+)
+
+log = structlog.get_logger()
+
+
+def build_cache_key(
+    text: str,
+    mime_type: str,
+    lang: str | None,
+    annotation_types: str,
+    pipeline_identity: str,
+) -> str:
+    """
+    Content-addressed key of an analysis result. Every input influencing the
+    AHD response is part of the hash.
+    """
+    digest = hashlib.sha256()
+    for part in [pipeline_identity, annotation_types, mime_type, str(lang)]:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_pipeline_identity(
+    pipeline, version: str = "", include_configuration: bool = False
+) -> str:
+    """
+    Identifies the pipeline producing the cached results. Changing the
+    version, or the pipeline configuration if included, invalidates the cache.
+    """
+    project = getattr(pipeline, "project", None)
+    parts = [
+        getattr(project, "name", ""),
+        getattr(pipeline, "name", ""),
+        version,
+    ]
+
+    if include_configuration:
+        # raises if AHD can't be reached, as an identity without the
+        # configuration would return results of a changed pipeline
+        configuration = pipeline.get_configuration()
+        parts.append(
+            hashlib.sha256(
+                json.dumps(configuration, sort_keys=True).encode("utf-8")
+            ).hexdigest()
+        )
+
+    return "|".join(parts)
+
+
+class AnalysisCache(abc.ABC):
+    """
+    Cache of raw AHD analysis results keyed by `build_cache_key`.
+    Implementations need to be thread-safe.
+    """
+
+    backend: str
+    # part of every cache key, set by bind_pipeline
+    pipeline_identity: str = ""
+
+    def __init__(self):
+        # set by bind_pipeline_lazily
+        self._identify_pipeline: Callable[[], str] | None = None
+        self._refresh_seconds: float | None = None
+        self._identified_at: float | None = None
+        self._identity_lock = threading.Lock()
+
+    @abc.abstractmethod
+    def get(self, key: str) -> List[dict] | None:
+        pass
+
+    @abc.abstractmethod
+    def set(self, key: str, annotations: List[dict]):
+        pass
+
+    @abc.abstractmethod
+    def clear(self):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def _get_pipeline_identity(self) -> str | None:
+        pass
+
+    @abc.abstractmethod
+    def _set_pipeline_identity(self, pipeline_identity: str):
+        pass
+
+    def bind_pipeline(self, pipeline_identity: str):
+        """
+        Drop all cached results if they were produced by a different pipeline
+        """
+        previous_identity = self._get_pipeline_identity()
+        if previous_identity is not None and previous_identity != pipeline_identity:
+            log.info(
+                "Pipeline changed. Invalidating analysis cache.",
+                previous_pipeline=previous_identity,
+                pipeline=pipeline_identity,
+            )
+            self.clear()
+        self._set_pipeline_identity(pipeline_identity)
+        self.pipeline_identity = pipeline_identity
+
+    def bind_pipeline_lazily(
+        self,
+        identify_pipeline: Callable[[], str],
+        refresh_seconds: float | None = None,
+    ):
+        """
+        Bind the pipeline identified by identify_pipeline once the identity is
+        first needed, e.g. after the pipeline was created, and again every
+        refresh_seconds to notice changes of the running pipeline
+        """
+        self._identify_pipeline = identify_pipeline
+        self._refresh_seconds = refresh_seconds
+        self._identified_at = None
+
+    def get_pipeline_identity(self) -> str:
+        """
+        The identity of the bound pipeline, identifying it first if bound
+        lazily and not identified yet or anymore. Raises if that fails.
+        """
+        if self._identify_pipeline is None:
+            return self.pipeline_identity
+
+        with self._identity_lock:
+            now = time.monotonic()
+            if self._identified_at is None or (
+                self._refresh_seconds is not None
+                and now - self._identified_at >= self._refresh_seconds
+            ):
+                self.bind_pipeline(self._identify_pipeline())
+                self._identified_at = now
+        return self.pipeline_identity
+
+    def _record_lookup(self, hit: bool):
+        if hit:
+            CACHE_HITS_COUNTER.labels(backend=self.backend).inc()
+        else:
+            CACHE_MISSES_COUNTER.labels(backend=self.backend).inc()
+
+
+class InMemoryAnalysisCache(AnalysisCache):
+    """
+    LRU cache evicting the least recently used results once the serialized
+    size of all entries exceeds `max_size_bytes`
+    """
+
+    backend = "memory"
+
+    def __init__(
+        self,
+        max_size_bytes: int,
+        ttl_seconds: float | None = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        super().__init__()
+        self.max_size_bytes = max_size_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.size_bytes = 0
+        self._entries: OrderedDict[str, Tuple[bytes, float | None]] = OrderedDict()
+        self._pipeline_identity: str | None = None
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> List[dict] | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] <= self.clock():
+                self._remove(key)
+                entry = None
+
+            self._record_lookup(entry is not None)
+            if entry is None:
+                return None
+
+            self._entries.move_to_end(key)
+
+        # always hand out a new copy so the cached value can't be modified
+        return json.loads(entry[0])
+
+    def set(self, key: str, annotations: List[dict]):
+        value = json.dumps(annotations).encode("utf-8")
+        if len(value) > self.max_size_bytes:
+            return
+
+        expires_at = None
+        if self.ttl_seconds is not None:
+            expires_at = self.clock() + self.ttl_seconds
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at)
+            self.size_bytes = self.size_bytes + len(value)
+
+            while self.size_bytes > self.max_size_bytes:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                CACHE_EVICTIONS_COUNTER.labels(backend=self.backend).inc()
+
+            CACHE_SIZE_BYTES_GAUGE.labels(backend=self.backend).set(self.size_bytes)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size_bytes = 0
+            CACHE_SIZE_BYTES_GAUGE.labels(backend=self.backend).set(0)
+
+    def close(self):
+        self.clear()
+
+    def _remove(self, key: str):
+        value, _ = self._entries.pop(key)
+        self.size_bytes = self.size_bytes - len(value)
+
+    def _get_pipeline_identity(self) -> str | None:
+        return self._pipeline_identity
+
+    def _set_pipeline_identity(self, pipeline_identity: str):
+        self._pipeline_identity = pipeline_identity
+
+
+class DiskAnalysisCache(AnalysisCache):
+    """
+    Persistent cache storing zlib-compressed results in a SQLite database.
+    Evicts the least recently used results once the compressed size of all
+    entries exceeds `max_size_bytes`.
+    """
+
+    backend = "disk"
+
+    def __init__(
+        self,
+        path: str,
+        max_size_bytes: int,
+        ttl_seconds: float | None = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        super().__init__()
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS analysis_results ("
+                + "key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+                + "size INTEGER NOT NULL, expires_at REAL, last_access REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS analysis_results_last_access "
+                + "ON analysis_results (last_access)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT)"
+            )
+            # running total of the entries' sizes, kept in the database as
+            # well so processes sharing it agree on it. Only summed up once
+            # for databases created before it was introduced.
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_size ("
+                + "id INTEGER PRIMARY KEY CHECK (id = 0), size_bytes INTEGER NOT NULL)"
+            )
+            self._connection.execute(
+                "INSERT OR IGNORE INTO cache_size (id, size_bytes) "
+                + "SELECT 0, COALESCE(SUM(size), 0) FROM analysis_results"
+            )
+            self._update_size_gauge(self._get_size_bytes())
+
+    def get(self, key: str) -> List[dict] | None:
+        now = self.clock()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT value, expires_at, size FROM analysis_results WHERE key = ?",
+                (key,),
+            ).fetchone()
+
+            if row is not None and row[1] is not None and row[1] <= now:
+                self._connection.execute(
+                    "DELETE FROM analysis_results WHERE key = ?", (key,)
+                )
+                self._update_size_gauge(self._add_size_bytes(-row[2]))
+                row = None
+
+            self._record_lookup(row is not None)
+            if row is None:
+                return None
+
+            self._connection.execute(
+                "UPDATE analysis_results SET last_access = ? WHERE key = ?",
+                (now, key),
+            )
+
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, key: str, annotations: List[dict]):
+        value = zlib.compress(json.dumps(annotations).encode("utf-8"))
+        if len(value) > self.max_size_bytes:
+            return
+
+        now = self.clock()
+        expires_at = None
+        if self.ttl_seconds is not None:
+            expires_at = now + self.ttl_seconds
+
+        with self._lock, self._connection:
+            replaced = self._connection.execute(
+                "SELECT size FROM analysis_results WHERE key = ?", (key,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO analysis_results "
+                + "(key, value, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value), expires_at, now),
+            )
+            size_bytes = self._add_size_bytes(
+                len(value) - (replaced[0] if replaced is not None else 0)
+            )
+            self._update_size_gauge(self._evict(size_bytes))
+
+    def clear(self):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM analysis_results")
+            self._connection.execute("UPDATE cache_size SET size_bytes = 0")
+            self._update_size_gauge(0)
+
+    def close(self):
+        self._connection.close()
+
+    def _evict(self, size_bytes: int) -> int:
+        """
+        Evict the least recently used entries until the entries fit into
+        max_size_bytes, returning their size afterwards
+        """
+        while size_bytes > self.max_size_bytes:
+            row = self._connection.execute(
+                "SELECT key, size FROM analysis_results "
+                + "ORDER BY last_access ASC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                # the tracked size is off, e.g. as the entries were deleted
+                # from outside of the cache, and nothing is left to evict
+                self._connection.execute("UPDATE cache_size SET size_bytes = 0")
+                return 0
+
+            key, size = row
+            self._connection.execute(
+                "DELETE FROM analysis_results WHERE key = ?", (key,)
+            )
+            size_bytes = self._add_size_bytes(-size)
+            CACHE_EVICTIONS_COUNTER.labels(backend=self.backend).inc()
+        return size_bytes
+
+    def _add_size_bytes(self, delta: int) -> int:
+        self._connection.execute(
+            "UPDATE cache_size SET size_bytes = size_bytes + ?", (delta,)
+        )
+        return self._get_size_bytes()
+
+    def _get_size_bytes(self) -> int:
+        row = self._connection.execute("SELECT size_bytes FROM cache_size").fetchone()
+        return row[0]
+
+    def _update_size_gauge(self, size_bytes: int):
+        CACHE_SIZE_BYTES_GAUGE.labels(backend=self.backend).set(size_bytes)
+
+    def _get_pipeline_identity(self) -> str | None:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT value FROM metadata WHERE key = 'pipeline_identity'"
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def _set_pipeline_identity(self, pipeline_identity: str):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO metadata (key, value) "
+                + "VALUES ('pipeline_identity', ?)",
+                (pipeline_identity,),
+            )
+
+
+def build_analysis_cache(
+    settings: config.AnalysisCacheSettings,
+) -> AnalysisCache | None:
+    if settings.backend == "none":
+        return None
+
+    if settings.backend == "memory":
+        return InMemoryAnalysisCache(
+            max_size_bytes=settings.max_size_bytes,
+            ttl_seconds=settings.ttl_seconds,
+        )
+
+    if settings.backend == "disk":
+        return DiskAnalysisCache(
+            path=settings.disk_path,
+            max_size_bytes=settings.max_size_bytes,
+            ttl_seconds=settings.ttl_seconds,
+        )
+
+    raise ValueError(f"Unknown analysis cache backend '{settings.backend}'")
@@ -0,0 +1,39 @@
+import binascii
+import codecs
+from typing import Iterator
+
+# number of base64 characters decoded at once, a multiple of 4
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+_WHITESPACE = b" \t\r\n"
+
+
+def iter_decoded_text(
+    data: bytes | str, chunk_size: int = DECODE_CHUNK_SIZE
+) -> Iterator[str]:
+    """
+    Decode base64 encoded UTF-8 text chunk by chunk, so the decoded bytes of
+    the whole text are never held at once. Whitespace is ignored, like the
+    line breaks of MIME encoded data.
+    """
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    leftover = b""
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start : start + chunk_size]
+        if isinstance(chunk, str):
+            chunk = chunk.encode("ascii")
+        chunk = (leftover + chunk).translate(None, _WHITESPACE)
+
+        # base64 decodes groups of 4 characters, the rest waits for the next chunk
+        usable = len(chunk) - len(chunk) % 4
+        leftover = chunk[usable:]
+        yield text_decoder.decode(binascii.a2b_base64(chunk[:usable]))
+
+    yield text_decoder.decode(binascii.a2b_base64(leftover), final=True)
+
+
+def decode_text(data: bytes | str, chunk_size: int = DECODE_CHUNK_SIZE) -> str:
+    """
+    Decode base64 encoded UTF-8 text, e.g. an attachment's data
+    """
+    return "".join(iter_decoded_text(data, chunk_size))
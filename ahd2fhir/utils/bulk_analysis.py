@@ -0,0 +1,177 @@
+import asyncio
+from typing import AsyncIterable, AsyncIterator
+
+import structlog
+from fhir.resources.R4B.bundle import Bundle
+from fhir.resources.R4B.operationoutcome import OperationOutcome
+from prometheus_client import Counter
+
+from ahd2fhir.utils.fhir_response import serialize_resource
+from ahd2fhir.utils.resource_decoder import (
+    UnsupportedResourceTypeError,
+    decode_resource,
+)
+from ahd2fhir.utils.resource_handler import ResourceHandler, TransientError
+
+BULK_LINES_COUNTER = Counter(
+    "bulk_analysis_lines",
+    "Number of NDJSON lines processed by the bulk analysis",
+    ["status"],
+)
+
+log = structlog.get_logger()
+
+
+class LineTooLongError(ValueError):
+    pass
+
+
+async def aiter_ndjson_lines(
+    chunks: AsyncIterable[bytes], max_line_bytes: int | None = None
+) -> AsyncIterator[bytes | LineTooLongError]:
+    """
+    Split a stream of bytes into its newline-delimited lines. Lines longer than
+    `max_line_bytes` are dropped without buffering them and a LineTooLongError
+    is yielded in their place.
+    """
+
+    def line_too_long() -> LineTooLongError:
+        return LineTooLongError(
+            f"The line is longer than the maximum of {max_line_bytes} bytes"
+        )
+
+    buffer = bytearray()
+    # the part of the buffer already searched for a newline
+    scanned = 0
+    # set while dropping the rest of a line that is too long
+    dropping = False
+    async for chunk in chunks:
+        buffer.extend(chunk)
+        line_start = 0
+        while (line_end := buffer.find(b"\n", scanned)) != -1:
+            if dropping:
+                dropping = False
+            elif max_line_bytes is not None and line_end - line_start > max_line_bytes:
+                yield line_too_long()
+            else:
+                yield bytes(buffer[line_start:line_end])
+            line_start = scanned = line_end + 1
+
+        del buffer[:line_start]
+        scanned = len(buffer)
+
+        if max_line_bytes is not None and len(buffer) > max_line_bytes:
+            if not dropping:
+                yield line_too_long()
+                dropping = True
+            buffer.clear()
+            scanned = 0
+
+    if len(buffer) > 0 and not dropping:
+        yield bytes(buffer)
+
+
+def build_operation_outcome(line_number: int, exc: Exception) -> OperationOutcome:
+    code = "processing"
+    if isinstance(exc, TransientError):
+        code = "transient"
+    elif isinstance(exc, LineTooLongError):
+        code = "too-long"
+    elif isinstance(exc, UnsupportedResourceTypeError):
+        code = "not-supported"
+    elif isinstance(exc, ValueError):
+        code = "invalid"
+
+    return OperationOutcome(
+        **{
+            # lets clients correlate errors with their input lines
+            "id": f"line-{line_number}",
+            "issue": [
+                {
+                    "severity": "error",
+                    "code": code,
+                    "diagnostics": f"Line {line_number}: {exc}",
+                }
+            ],
+        }
+    )
+
+
+async def analyze_ndjson_lines(
+    lines: AsyncIterable[bytes | LineTooLongError],
+    resource_handler: ResourceHandler,
+    max_concurrent_documents: int,
+) -> AsyncIterator[bytes]:
+    """
+    Analyze each line holding a DocumentReference or a Bundle thereof, running
+    at most `max_concurrent_documents` at the same time. Yields one NDJSON line
+    per input line in the order they finish: either the result Bundle or an
+    OperationOutcome describing why the line failed.
+    """
+
+    async def process(line_number: int, line: bytes | LineTooLongError) -> bytes:
+        try:
+            if isinstance(line, LineTooLongError):
+                raise line
+            resource = decode_resource(line)
+            if isinstance(resource, Bundle):
+                result = await resource_handler.ahandle_bundle(resource)
+            else:
+                result = await resource_handler.ahandle_documents([resource])
+            BULK_LINES_COUNTER.labels(status="success").inc()
+        except Exception as exc:
+            log.error("Failed to analyze line", line_number=line_number, error=exc)
+            BULK_LINES_COUNTER.labels(status="error").inc()
+            result = build_operation_outcome(line_number, exc)
+
+        return serialize_resource(result) + b"\n"
+
+    line_iterator = aiter(lines)
+
+    async def read_line() -> bytes | None:
+        try:
+            return await anext(line_iterator)
+        except StopAsyncIteration:
+            return None
+
+    in_flight: set[asyncio.Future] = set()
+    next_line: asyncio.Future | None = None
+    line_number = 0
+    lines_exhausted = False
+
+    try:
+        while True:
+            # only read ahead while there is capacity, so the request body
+            # is consumed no faster than it can be processed
+            if (
+                next_line is None
+                and not lines_exhausted
+                and len(in_flight) < max_concurrent_documents
+            ):
+                next_line = asyncio.ensure_future(read_line())
+
+            waiting = (in_flight | {next_line}) if next_line is not None else in_flight
+            if len(waiting) == 0:
+                return
+
+            done, _ = await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+
+            if next_line in done:
+                line = next_line.result()
+                next_line = None
+                if line is None:
+                    lines_exhausted = True
+                else:
+                    line_number = line_number + 1
+                    if isinstance(line, LineTooLongError) or len(line.strip()) > 0:
+                        in_flight.add(asyncio.ensure_future(process(line_number, line)))
+
+            for task in done & in_flight:
+                in_flight.remove(task)
+                yield task.result()
+    finally:
+        # e.g. the client disconnected
+        for task in in_flight:
+            task.cancel()
+        if next_line is not None:
+            next_line.cancel()
@@ -1,28 +1,62 @@
 import uuid
-from typing import List
+from typing import Iterable, Iterator
 
 from fhir.resources.R4B.bundle import Bundle, BundleEntry, BundleEntryRequest
 from fhir.resources.R4B.resource import Resource
 
 
 class BundleBuilder:
-    def build_from_resources(self, resources: List[Resource], id: str | None) -> Bundle:
+    def build_from_resources(
+        self, resources: Iterable[Resource], id: str | None
+    ) -> Bundle:
         bundle_id = id
         if bundle_id is None:
             bundle_id = str(uuid.uuid4())
 
-        bundle = Bundle(**{"id": bundle_id, "type": "transaction", "entry": []})
-
+        return Bundle.construct(
+            id=bundle_id, type="transaction", entry=list(self.iter_entries(resources))
+        )
+
+    def iter_entries(self, resources: Iterable[Resource]) -> Iterator[BundleEntry]:
+        """
+        Yield a transaction entry for each of the resources, e.g. to stream them
+        instead of holding the whole Bundle. The resources are trusted to be
+        valid and the entries are built without validating them again, which
+        assigning them to a constructed entry would do.
+        """
         for resource in resources:
-            request = BundleEntryRequest(
-                **{"url": f"{resource.resource_type}/{resource.id}", "method": "PUT"}
+            url = f"{resource.resource_type}/{resource.id}"
+            yield BundleEntry.construct(
+                fullUrl=url,
+                resource=resource,
+                request=BundleEntryRequest.construct(url=url, method="PUT"),
             )
 
-            entry = BundleEntry.construct()
-            entry.request = request
-            entry.fullUrl = request.url
-            entry.resource = resource
+    def build_dict_from_resources(
+        self, resources: Iterable[dict], id: str | None
+    ) -> dict:
+        """
+        Same as build_from_resources, but for resources given as dicts
+        """
+        bundle_id = id
+        if bundle_id is None:
+            bundle_id = str(uuid.uuid4())
 
-            bundle.entry.append(entry)
+        entries = list(self.iter_entry_dicts(resources))
 
+        bundle = {"resourceType": "Bundle", "id": bundle_id, "type": "transaction"}
+        if len(entries) > 0:
+            bundle["entry"] = entries
         return bundle
+
+    def iter_entry_dicts(self, resources: Iterable[dict]) -> Iterator[dict]:
+        """
+        Same as iter_entries, but for resources given as dicts
+        """
+        for resource in resources:
+            url = f"{resource['resourceType']}/{resource['id']}"
+            yield {
+                "fullUrl": url,
+                "resource": resource,
+                "request": {"method": "PUT", "url": url},
+            }
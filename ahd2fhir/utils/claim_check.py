@@ -0,0 +1,209 @@
+import abc
+import hashlib
+import json
+import os
+import re
+import tempfile
+from typing import Any, Tuple
+
+import boto3
+import structlog
+from prometheus_client import Counter
+
+from ahd2fhir import config
+
+# messages carrying a reference to a stored payload instead of the payload
+CLAIM_CHECK_HEADER = "claimCheck"
+
+CLAIM_CHECK_STORED_COUNTER = Counter(
+    "claim_check_stored_payloads",
+    "Number of payloads too large for a Kafka message written to the blob store",
+    ["backend"],
+)
+CLAIM_CHECK_RESOLVED_COUNTER = Counter(
+    "claim_check_resolved_payloads",
+    "Number of claim check references resolved from the blob store",
+    ["backend"],
+)
+
+SHA256_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+log = structlog.get_logger()
+
+
+class BlobNotFoundError(ValueError):
+    pass
+
+
+class BlobStore(abc.ABC):
+    """
+    Stores payloads too large for Kafka messages by key.
+    Implementations need to be thread-safe.
+    """
+
+    backend: str
+
+    @abc.abstractmethod
+    def put(self, key: str, value: bytes):
+        pass
+
+    @abc.abstractmethod
+    def get(self, key: str) -> bytes:
+        """
+        Raises BlobNotFoundError if there is no payload stored for the key
+        """
+        pass
+
+
+class FileSystemBlobStore(BlobStore):
+    """
+    Stores each payload in its own file below `directory`, e.g. a volume
+    shared by the producers and consumers of the topics
+    """
+
+    backend = "filesystem"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, key: str, value: bytes):
+        path = self._get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # written to a temporary file first, so readers never see partial payloads
+        with tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), delete=False
+        ) as file:
+            file.write(value)
+        os.replace(file.name, path)
+
+    def get(self, key: str) -> bytes:
+        try:
+            with open(self._get_path(key), "rb") as file:
+                return file.read()
+        except FileNotFoundError as exc:
+            raise BlobNotFoundError(f"No payload stored for key '{key}'") from exc
+
+    def _get_path(self, key: str) -> str:
+        # spread the files over subdirectories to keep the directories small
+        return os.path.join(self.directory, key[:2], key)
+
+
+class S3BlobStore(BlobStore):
+    """
+    Stores the payloads as objects in an S3 bucket. The client is created from
+    the usual AWS environment variables unless given, e.g. one for MinIO.
+    """
+
+    backend = "s3"
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint_url: str | None = None,
+        client: Any = None,
+    ):
+        if client is None:
+            client = boto3.client("s3", endpoint_url=endpoint_url)
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = client
+
+    def put(self, key: str, value: bytes):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=value)
+
+    def get(self, key: str) -> bytes:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except Exception as exc:
+            # botocore's ClientError, without depending on botocore
+            error_code = getattr(exc, "response", {}).get("Error", {}).get("Code")
+            if error_code in ("NoSuchKey", "404"):
+                raise BlobNotFoundError(f"No payload stored for key '{key}'") from exc
+            raise
+        return response["Body"].read()
+
+
+class ClaimCheck:
+    """
+    Replaces payloads larger than threshold_bytes by a small reference to the
+    payload written to the blob store, and resolves such references back to
+    the payload. The references are JSON objects holding the SHA-256 hash and
+    the size of the payload, which are verified when resolving them.
+    """
+
+    def __init__(self, store: BlobStore, threshold_bytes: int):
+        self.store = store
+        self.threshold_bytes = threshold_bytes
+
+    def check_in(self, value: bytes) -> Tuple[bytes, bool]:
+        """
+        Returns the value to send and whether it is a reference to the stored
+        value, to be marked with the CLAIM_CHECK_HEADER
+        """
+        if len(value) <= self.threshold_bytes:
+            return value, False
+
+        digest = hashlib.sha256(value).hexdigest()
+        # content-addressed, so sending the same payload again stores it once
+        self.store.put(digest, value)
+        CLAIM_CHECK_STORED_COUNTER.labels(backend=self.store.backend).inc()
+        log.info(
+            "Stored payload too large for a Kafka message",
+            key=digest,
+            size_bytes=len(value),
+        )
+
+        reference = {"store": self.store.backend, "sha256": digest, "size": len(value)}
+        return json.dumps(reference).encode("utf8"), True
+
+    def check_out(self, reference: bytes) -> bytes:
+        """
+        Returns the payload a reference created by check_in refers to.
+        Raises a ValueError if the reference is invalid, the payload missing or
+        it doesn't match the reference. Other errors of the store are raised
+        as they are, e.g. if it is unavailable.
+        """
+        try:
+            reference_json = json.loads(reference)
+            digest = reference_json["sha256"]
+            expected_size = reference_json["size"]
+        except (ValueError, TypeError, KeyError) as exc:
+            raise ValueError(f"Invalid claim check reference: {exc}") from exc
+
+        # the hash is used as the key, so it must not be able to point elsewhere
+        if not isinstance(digest, str) or SHA256_PATTERN.fullmatch(digest) is None:
+            raise ValueError(f"Invalid claim check hash '{digest}'")
+
+        value = self.store.get(digest)
+        if len(value) != expected_size:
+            raise ValueError(
+                f"Claim checked payload '{digest}' has {len(value)} bytes, "
+                + f"expected {expected_size}"
+            )
+        if hashlib.sha256(value).hexdigest() != digest:
+            raise ValueError(f"Claim checked payload '{digest}' doesn't match its hash")
+
+        CLAIM_CHECK_RESOLVED_COUNTER.labels(backend=self.store.backend).inc()
+        return value
+
+
+def build_claim_check(settings: config.ClaimCheckSettings) -> ClaimCheck | None:
+    if settings.backend == "none":
+        return None
+
+    if settings.backend == "filesystem":
+        store = FileSystemBlobStore(settings.directory)
+    elif settings.backend == "s3":
+        store = S3BlobStore(
+            bucket=settings.s3_bucket,
+            prefix=settings.s3_prefix,
+            endpoint_url=settings.s3_endpoint_url,
+        )
+    else:
+        raise ValueError(f"Unknown claim check backend '{settings.backend}'")
+
+    return ClaimCheck(store, settings.threshold_bytes)
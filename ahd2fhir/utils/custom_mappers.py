@@ -1,4 +1,5 @@
-from fhir.resources.R4B.documentreference import DocumentReference
+import functools
+from typing import Callable, Dict, List, NamedTuple
 
 from ahd2fhir.mappers import ahd_to_observation_kidney_stone as ks
 from ahd2fhir.mappers import ahd_to_observation_smkstat as smk
@@ -8,10 +9,45 @@ mapper_functions = {
     ks.AHD_TYPE: [ks.get_fhir_resources],
 }
 
+# the same mappers for the dict mapping backend, mapping to and from dicts
+dict_mapper_functions = {
+    smk.AHD_TYPE: [smk.get_fhir_resources_dict],
+    ks.AHD_TYPE: [ks.get_fhir_resources_dict],
+}
+
+
+class MapperOptions(NamedTuple):
+    """
+    Options of the custom mappers, passed to each of their factories
+    """
+
+    smkstat_as_value_string: bool = False
+
+    @classmethod
+    def from_environment(cls) -> "MapperOptions":
+        return cls(smkstat_as_value_string=smk.is_value_string_enabled())
+
+
+# builds a mapper configured by the options
+MapperFactory = Callable[[MapperOptions], Callable]
+
 
-def custom_mappers(val: dict, document_reference: DocumentReference) -> list:
-    results = []
-    if (mappers := mapper_functions.get(val["type"], None)) is not None:
-        for mapper in mappers:
-            results.extend(mapper(val, document_reference))
-    return results
+def _without_options(mapper: Callable) -> MapperFactory:
+    return lambda options: mapper
+
+
+def _smkstat_factory(mapper: Callable) -> MapperFactory:
+    return lambda options: functools.partial(
+        mapper, as_value_string=options.smkstat_as_value_string
+    )
+
+
+mapper_factories: Dict[str, List[MapperFactory]] = {
+    smk.AHD_TYPE: [_smkstat_factory(smk.get_fhir_resources)],
+    ks.AHD_TYPE: [_without_options(ks.get_fhir_resources)],
+}
+
+dict_mapper_factories: Dict[str, List[MapperFactory]] = {
+    smk.AHD_TYPE: [_smkstat_factory(smk.get_fhir_resources_dict)],
+    ks.AHD_TYPE: [_without_options(ks.get_fhir_resources_dict)],
+}
@@ -1,8 +1,10 @@
 import hashlib
 
 import structlog
-from fhir.resources.R4B.device import Device, DeviceDeviceName, DeviceVersion
-from fhir.resources.R4B.identifier import Identifier
+from fhir.resources.R4B.device import Device
+
+from ahd2fhir.utils import fhir_dicts, fhir_fragments
+from ahd2fhir.utils.metadata_registry import MetadataResourceRegistry
 
 log = structlog.get_logger()
 
@@ -12,27 +14,64 @@ AHD_DEVICE_IDENTIFIER_SYSTEM = (
 
 
 def build_device(document_annotation) -> Device:
-    ahd_version = document_annotation.get("version")
-
-    identifier = Identifier(
-        **{
-            "system": AHD_DEVICE_IDENTIFIER_SYSTEM,
-            "value": f"ahd-v{ahd_version}",
-        }
-    )
-
-    device = Device.construct()
-    device.status = "active"
-    device.manufacturer = "Averbis GmbH"
-    device.deviceName = [
-        DeviceDeviceName(
-            **{"name": "Averbis Health Discovery", "type": "manufacturer-name"}
-        )
-    ]
-    device.version = [DeviceVersion(**{"value": ahd_version})]
-    device.identifier = [identifier]
-
-    device_id_plain = f"{identifier.system}|{identifier.value}"
-    device.id = hashlib.sha256(device_id_plain.encode("utf-8")).hexdigest()
-
-    return device
+    return build_device_of_version(document_annotation.get("version"))
+
+
+def build_device_of_version(ahd_version: str | None) -> Device:
+    return fhir_dicts.construct(Device, build_device_dict_of_version(ahd_version))
+
+
+def build_device_dict(document_annotation) -> dict:
+    """
+    Builds the Device of the annotation's AHD version as a dict without
+    constructing any models
+    """
+    return build_device_dict_of_version(document_annotation.get("version"))
+
+
+def build_device_dict_of_version(ahd_version: str | None) -> dict:
+    identifier = {
+        "system": AHD_DEVICE_IDENTIFIER_SYSTEM,
+        "value": f"ahd-v{ahd_version}",
+    }
+
+    device_id_plain = f"{identifier['system']}|{identifier['value']}"
+
+    return {
+        "resourceType": "Device",
+        "id": hashlib.sha256(device_id_plain.encode("utf-8")).hexdigest(),
+        "identifier": [identifier],
+        "status": "active",
+        "manufacturer": "Averbis GmbH",
+        "deviceName": [
+            {"name": "Averbis Health Discovery", "type": "manufacturer-name"}
+        ],
+        "version": [{"value": ahd_version}],
+    }
+
+
+# the Device only depends on the AHD version, so each one is built once and
+# shared by all documents analyzed by that version
+DEVICE_REGISTRY: MetadataResourceRegistry[Device] = MetadataResourceRegistry(
+    "device", build_device_of_version
+)
+DEVICE_DICT_REGISTRY: MetadataResourceRegistry[dict] = MetadataResourceRegistry(
+    "device_dict",
+    lambda ahd_version: fhir_fragments.freeze(
+        build_device_dict_of_version(ahd_version)
+    ),
+)
+
+
+def get_device(document_annotation) -> Device:
+    """
+    The shared Device of the annotation's AHD version. Must not be modified.
+    """
+    return DEVICE_REGISTRY.get(document_annotation.get("version"))
+
+
+def get_device_dict(document_annotation) -> dict:
+    """
+    Same as get_device, but for the dict mapping backend
+    """
+    return DEVICE_DICT_REGISTRY.get(document_annotation.get("version"))
@@ -0,0 +1,142 @@
+"""
+Helpers for the dict mapping backend, which maps annotations to plain dicts
+shaped like the output of FHIRAbstractModel.dict() instead of constructing
+fhir.resources models. The keys of each element must be inserted in the
+order of its elements_sequence() to serialize to the same JSON.
+
+The mappers only build these dicts. The model mapping backend constructs the
+models from them using construct.
+"""
+
+import functools
+from typing import Any, Dict, Tuple, Type
+
+import structlog
+from fhir.resources.core.fhirabstractmodel import FHIRAbstractModel
+from fhir.resources.R4B import get_fhir_model_class
+from fhir.resources.R4B.documentreference import DocumentReference
+from fhir.resources.R4B.fhirtypes import AbstractType
+
+from ahd2fhir.utils import fhir_fragments
+
+log = structlog.get_logger()
+
+
+def compact(element: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Drop the None and empty values of an element, like FHIRAbstractModel.dict()
+    """
+    return {
+        key: value
+        for key, value in element.items()
+        if value is not None
+        and not (isinstance(value, (list, dict)) and len(value) == 0)
+    }
+
+
+def get_first_encounter(document: Dict[str, Any]) -> Dict[str, Any] | None:
+    context = document.get("context")
+    if context is None:
+        return None
+    return context["encounter"][0]
+
+
+def get_document_identifier_value(document: Dict[str, Any]) -> str | None:
+    """
+    The value of the document's first identifier, falling back to its id
+    """
+    identifiers = document.get("identifier")
+    if identifiers is None or len(identifiers) == 0:
+        log.warning(
+            "No identifier specified on the document. "
+            + "Trying to fall-back to the DocumentReference.id"
+        )
+        return document.get("id")
+
+    if len(identifiers) > 1:
+        log.warning(
+            "More than one identifier specified on the document. "
+            + "Using the first occurrence."
+        )
+    return identifiers[0].get("value")
+
+
+def get_document_elements(
+    document_reference: DocumentReference, as_dicts: bool = False
+) -> Dict[str, Any]:
+    """
+    The elements of the document read by the mappers, without converting the
+    whole document including its attachments to a dict. Unless as_dicts is set
+    for the dict mapping backend, the subject and the encounters are kept as
+    models, which construct leaves as they are, so the constructed resources
+    share them with the document.
+    """
+
+    def convert(element: FHIRAbstractModel | None):
+        return element.dict() if as_dicts and element is not None else element
+
+    context = document_reference.context
+    return compact(
+        {
+            "id": document_reference.id,
+            "identifier": [
+                identifier.dict() for identifier in document_reference.identifier or []
+            ],
+            "subject": convert(document_reference.subject),
+            "date": document_reference.date,
+            "context": (
+                compact({"encounter": [convert(e) for e in context.encounter or []]})
+                if context is not None
+                else None
+            ),
+        }
+    )
+
+
+def construct(
+    model_class: Type[FHIRAbstractModel], element: Dict[str, Any]
+) -> FHIRAbstractModel:
+    """
+    Construct a model and its nested elements from a dict built by the mappers
+    without validating them. Dicts of shared fragments are replaced by the
+    fragments themselves, and elements that already are models are kept.
+    """
+    if isinstance(element, FHIRAbstractModel):
+        return element
+
+    fragment = fhir_fragments.get_fragment_of_dict(element)
+    if fragment is not None:
+        return fragment
+
+    element_types = _get_element_types(model_class)
+    values = {}
+    for key, value in element.items():
+        if key == "resourceType":
+            continue
+
+        name, element_class = element_types[key]
+        if element_class is not None:
+            if isinstance(value, (list, tuple)):
+                value = [construct(element_class, item) for item in value]
+            else:
+                value = construct(element_class, value)
+        values[name] = value
+
+    return model_class.construct(**values)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_element_types(
+    model_class: Type[FHIRAbstractModel],
+) -> Dict[str, Tuple[str, Type[FHIRAbstractModel] | None]]:
+    """
+    The field name and, for complex types, the model class of each element of
+    the model by its key in the dict
+    """
+    element_types = {}
+    for field in model_class.__fields__.values():
+        element_class = None
+        if isinstance(field.type_, type) and issubclass(field.type_, AbstractType):
+            element_class = get_fhir_model_class(field.type_.__resource_type__)
+        element_types[field.alias] = (field.name, element_class)
+    return element_types
@@ -0,0 +1,157 @@
+import threading
+from typing import Any, Callable, Dict, Tuple
+
+from fhir.resources.core.fhirabstractmodel import FHIRAbstractModel
+from fhir.resources.R4B.codeableconcept import CodeableConcept
+from fhir.resources.R4B.coding import Coding
+from fhir.resources.R4B.meta import Meta
+
+# fragments for the same content are only built once and shared by all
+# resources using them. They are meant for the profiles and codes defined by
+# the mappers, not for content coming from annotations, which would grow the
+# cache without bound.
+_fragments: Dict[Tuple, Any] = {}
+_fragments_by_dict_id: Dict[int, Tuple[Dict[str, Any], FHIRAbstractModel]] = {}
+_lock = threading.Lock()
+
+
+class _FrozenConfig:
+    # assigning to a shared fragment raises a TypeError
+    allow_mutation = False
+
+
+# defined at module level so that resources sharing them can be pickled
+class _FrozenMeta(Meta):
+    Config = _FrozenConfig
+
+
+class _FrozenCoding(Coding):
+    Config = _FrozenConfig
+
+
+class _FrozenCodeableConcept(CodeableConcept):
+    Config = _FrozenConfig
+
+
+class FrozenDict(dict):
+    """
+    A dict raising a TypeError when modified, for the dicts shared by the
+    resources of the dict mapping backend. Serializes like any other dict.
+    """
+
+    def _raise_frozen(self, *args, **kwargs):
+        raise TypeError("Shared FHIR fragments must not be modified")
+
+    __setitem__ = _raise_frozen
+    __delitem__ = _raise_frozen
+    __ior__ = _raise_frozen
+    clear = _raise_frozen
+    pop = _raise_frozen
+    popitem = _raise_frozen
+    setdefault = _raise_frozen
+    update = _raise_frozen
+
+    def __reduce__(self):
+        # the default would fill an empty FrozenDict item by item
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(element: Any) -> Any:
+    """
+    A copy of the element in which all dicts are FrozenDicts and all lists
+    are tuples, so it can be shared by the resources of the dict mapping backend
+    """
+    if isinstance(element, dict):
+        return FrozenDict({key: freeze(value) for key, value in element.items()})
+    if isinstance(element, (list, tuple)):
+        return tuple(freeze(value) for value in element)
+    return element
+
+
+def _get_or_build(key: Tuple, build: Callable[[], Any]) -> Any:
+    fragment = _fragments.get(key)
+    if fragment is not None:
+        return fragment
+
+    fragment = build()
+    with _lock:
+        return _fragments.setdefault(key, fragment)
+
+
+def _coding_key(coding: Coding) -> Tuple:
+    return (
+        coding.system,
+        coding.version,
+        coding.code,
+        coding.display,
+        coding.userSelected,
+    )
+
+
+def meta(*profiles: str) -> Meta:
+    """
+    A shared, immutable Meta listing the given profiles
+    """
+
+    def build() -> Meta:
+        return _FrozenMeta.construct(profile=tuple(profiles))
+
+    return _get_or_build(("Meta", profiles), build)
+
+
+def coding(
+    system: str,
+    code: str,
+    display: str | None = None,
+    user_selected: bool | None = None,
+) -> Coding:
+    """
+    A shared, immutable Coding of the given code
+    """
+
+    def build() -> Coding:
+        values: Dict[str, Any] = {"system": system, "code": code}
+        if display is not None:
+            values["display"] = display
+        if user_selected is not None:
+            values["userSelected"] = user_selected
+        return _FrozenCoding.construct(**values)
+
+    return _get_or_build(("Coding", system, code, display, user_selected), build)
+
+
+def codeable_concept(*codings: Coding, text: str | None = None) -> CodeableConcept:
+    """
+    A shared, immutable CodeableConcept of the given codings, keyed by their
+    content
+    """
+
+    def build() -> CodeableConcept:
+        values: Dict[str, Any] = {"coding": tuple(codings)}
+        if text is not None:
+            values["text"] = text
+        return _FrozenCodeableConcept.construct(**values)
+
+    return _get_or_build(
+        ("CodeableConcept", tuple(_coding_key(c) for c in codings), text), build
+    )
+
+
+def as_dict(fragment: FHIRAbstractModel) -> Dict[str, Any]:
+    """
+    The fragment as an immutable dict for the dict mapping backend. Models
+    constructed from that dict by fhir_dicts.construct share the fragment again.
+    """
+    element = freeze(fragment.dict())
+    with _lock:
+        # the dict is kept alive with the fragment, so its id is never reused
+        _fragments_by_dict_id[id(element)] = (element, fragment)
+    return element
+
+
+def get_fragment_of_dict(element: Dict[str, Any]) -> FHIRAbstractModel | None:
+    """
+    The fragment the dict was returned for by as_dict, if any
+    """
+    entry = _fragments_by_dict_id.get(id(element))
+    return None if entry is None else entry[1]
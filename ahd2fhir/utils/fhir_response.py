@@ -0,0 +1,84 @@
+from typing import Any
+
+from fhir.resources.core.fhirabstractmodel import FHIRAbstractModel
+from fhir.resources.core.fhirabstractmodel import json_dumps as fhir_json_dumps
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+FHIR_JSON_MEDIA_TYPE = "application/fhir+json"
+FHIR_NDJSON_MEDIA_TYPE = "application/fhir+ndjson"
+
+
+def serialize_resource(resource: FHIRAbstractModel, indent: bool = False) -> bytes:
+    """
+    Serialize a FHIR resource to UTF-8 encoded JSON in a single pass.
+    Uses orjson if installed, otherwise the standard library's json module.
+    """
+    # orjson ignores all dumps arguments except indent, the others keep the
+    # output of the json module fallback identical
+    if indent:
+        return resource.json(return_bytes=True, indent=2, ensure_ascii=False)
+
+    return resource.json(return_bytes=True, ensure_ascii=False, separators=(",", ":"))
+
+
+def serialize_dict(resource: dict, indent: bool = False) -> bytes:
+    """
+    Serialize a FHIR resource given as a dict, e.g. by the dict mapping backend,
+    to the same bytes serialize_resource returns for the equivalent model
+    """
+    encoder = FHIRAbstractModel.__json_encoder__
+    # fhir.resources uses orjson if installed, see serialize_resource
+    if getattr(fhir_json_dumps, "__qualname__", "") == "orjson_json_dumps":
+        option = orjson.OPT_INDENT_2 if indent else 0
+        return fhir_json_dumps(
+            resource, default=encoder, option=option, return_bytes=True
+        )
+
+    if indent:
+        result = fhir_json_dumps(
+            resource, default=encoder, indent=2, ensure_ascii=False
+        )
+    else:
+        result = fhir_json_dumps(
+            resource, default=encoder, ensure_ascii=False, separators=(",", ":")
+        )
+    return result.encode("utf-8")
+
+
+class FHIRJSONResponse(JSONResponse):
+    """
+    Renders FHIR resources directly from the model instead of converting them
+    to a dict and running it through the generic jsonable_encoder first.
+    """
+
+    media_type = FHIR_JSON_MEDIA_TYPE
+
+    def render(self, content: Any) -> bytes:
+        if isinstance(content, FHIRAbstractModel):
+            return serialize_resource(content)
+        return super().render(content)
+
+
+class FHIRNDJSONStreamingResponse(StreamingResponse):
+    """
+    Streams newline-delimited FHIR resources produced while the request body
+    is still being read.
+    """
+
+    media_type = FHIR_NDJSON_MEDIA_TYPE
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # StreamingResponse listens for the client disconnecting by receiving
+        # messages, which would swallow the chunks of the request body the
+        # content is produced from. Disconnects surface while reading the body
+        # via request.stream() instead.
+        await self.stream_response(send)
+
+        if self.background is not None:
+            await self.background()
@@ -4,4 +4,8 @@ from fhir.resources.R4B.identifier import Identifier
 
 
 def sha256_of_identifier(identifier: Identifier) -> str:
-    return sha256(f"{identifier.system}|{identifier.value}".encode("utf-8")).hexdigest()
+    return sha256_of_system_and_value(identifier.system, identifier.value)
+
+
+def sha256_of_system_and_value(system: str | None, value: str | None) -> str:
+    return sha256(f"{system}|{value}".encode("utf-8")).hexdigest()
@@ -0,0 +1,133 @@
+import functools
+import os
+from typing import Callable, Dict, List, Tuple
+
+from fhir.resources.R4B.documentreference import DocumentReference
+from fhir.resources.R4B.resource import Resource
+
+from ahd2fhir.mappers import ahd_to_condition, ahd_to_medication_statement
+from ahd2fhir.utils.const import (
+    AHD_TYPE_DIAGNOSIS,
+    AHD_TYPE_DOCUMENT_ANNOTATION,
+    AHD_TYPE_MEDICATION,
+)
+from ahd2fhir.utils.custom_mappers import (
+    MapperFactory,
+    MapperOptions,
+    dict_mapper_factories,
+    mapper_factories,
+)
+from ahd2fhir.utils.device_builder import get_device, get_device_dict
+
+# maps a single annotation of a document to any number of resources
+Mapper = Callable[[dict, DocumentReference], List[Resource]]
+# the same for the dict mapping backend, mapping the annotation and the
+# document's elements given as a dict, see fhir_dicts.get_document_elements,
+# to resources given as dicts
+DictMapper = Callable[[dict, dict], List[dict]]
+
+
+def is_custom_mappers_enabled() -> bool:
+    return os.getenv("CUSTOM_MAPPERS_ENABLED", "False").lower() in ["true", "1"]
+
+
+def _to_list(mapper: Callable[[dict, DocumentReference], Resource | None]) -> Mapper:
+    @functools.wraps(mapper)
+    def map_annotation(annotation: dict, document_reference: DocumentReference):
+        resource = mapper(annotation, document_reference)
+        return [] if resource is None else [resource]
+
+    return map_annotation
+
+
+def _map_device(annotation: dict, document_reference: DocumentReference):
+    return [get_device(annotation)]
+
+
+def _map_device_dict(annotation: dict, document: dict):
+    return [get_device_dict(annotation)]
+
+
+class MapperRegistry:
+    """
+    Maps AHD annotation types to the mappers run for each annotation of
+    that type. Annotations of types without mappers are skipped.
+    """
+
+    def __init__(self, mappers: Dict[str, Tuple[Mapper | DictMapper, ...]]):
+        self._mappers = mappers
+
+    def get(self, annotation_type: str) -> Tuple[Mapper | DictMapper, ...]:
+        return self._mappers.get(annotation_type, ())
+
+    @property
+    def annotation_types(self) -> List[str]:
+        return list(self._mappers.keys())
+
+
+def build_mapper_registry(
+    custom_mappers_enabled: bool | None = None,
+    smkstat_as_value_string: bool | None = None,
+) -> MapperRegistry:
+    """
+    Create the registry of the built-in mappers and, if enabled, the custom
+    mappers. Flags that aren't given are read from the environment once, i.e.
+    CUSTOM_MAPPERS_ENABLED and SMKSTAT_AS_VALUESTRING.
+    """
+    return _build_registry(
+        {
+            AHD_TYPE_DIAGNOSIS: [_to_list(ahd_to_condition.get_fhir_condition)],
+            AHD_TYPE_DOCUMENT_ANNOTATION: [_map_device],
+            AHD_TYPE_MEDICATION: [
+                _to_list(ahd_to_medication_statement.get_fhir_medication_statement)
+            ],
+        },
+        mapper_factories,
+        custom_mappers_enabled,
+        smkstat_as_value_string,
+    )
+
+
+def build_dict_mapper_registry(
+    custom_mappers_enabled: bool | None = None,
+    smkstat_as_value_string: bool | None = None,
+) -> MapperRegistry:
+    """
+    Same as build_mapper_registry, but with the mappers of the dict mapping
+    backend, which map to plain dicts without constructing any models
+    """
+    return _build_registry(
+        {
+            AHD_TYPE_DIAGNOSIS: [_to_list(ahd_to_condition.get_fhir_condition_dict)],
+            AHD_TYPE_DOCUMENT_ANNOTATION: [_map_device_dict],
+            AHD_TYPE_MEDICATION: [
+                _to_list(ahd_to_medication_statement.get_fhir_medication_statement_dict)
+            ],
+        },
+        dict_mapper_factories,
+        custom_mappers_enabled,
+        smkstat_as_value_string,
+    )
+
+
+def _build_registry(
+    mappers: Dict[str, List[Mapper | DictMapper]],
+    custom_mapper_factories: Dict[str, List[MapperFactory]],
+    custom_mappers_enabled: bool | None,
+    smkstat_as_value_string: bool | None,
+) -> MapperRegistry:
+    if custom_mappers_enabled is None:
+        custom_mappers_enabled = is_custom_mappers_enabled()
+
+    if custom_mappers_enabled:
+        options = MapperOptions.from_environment()
+        if smkstat_as_value_string is not None:
+            options = options._replace(smkstat_as_value_string=smkstat_as_value_string)
+
+        for annotation_type, factories in custom_mapper_factories.items():
+            for build_mapper in factories:
+                mappers.setdefault(annotation_type, []).append(build_mapper(options))
+
+    return MapperRegistry(
+        {annotation_type: tuple(m) for annotation_type, m in mappers.items()}
+    )
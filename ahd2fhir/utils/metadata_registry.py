@@ -0,0 +1,79 @@
+import threading
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, TypeVar
+
+from prometheus_client import Counter, Gauge
+
+METADATA_REGISTRY_HITS_COUNTER = Counter(
+    "metadata_registry_hits",
+    "Number of resources derived from pipeline metadata reused from a registry",
+    ["registry"],
+)
+METADATA_REGISTRY_MISSES_COUNTER = Counter(
+    "metadata_registry_misses",
+    "Number of resources derived from pipeline metadata built for a registry",
+    ["registry"],
+)
+METADATA_REGISTRY_HIT_RATE_GAUGE = Gauge(
+    "metadata_registry_hit_rate",
+    "Fraction of lookups in a registry reusing a resource derived from metadata",
+    ["registry"],
+)
+
+T = TypeVar("T")
+
+
+class MetadataResourceRegistry(Generic[T]):
+    """
+    Builds resources depending only on pipeline metadata, e.g. the Device of
+    an AHD version, once per key and hands out the same instance to every
+    document. The returned resources are shared and must never be modified.
+    Keeps the `max_size` most recently used resources.
+    """
+
+    def __init__(self, name: str, build: Callable[[Hashable], T], max_size: int = 64):
+        self.name = name
+        self.build = build
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._resources: OrderedDict[Hashable, T] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits_counter = METADATA_REGISTRY_HITS_COUNTER.labels(registry=name)
+        self._misses_counter = METADATA_REGISTRY_MISSES_COUNTER.labels(registry=name)
+        self._hit_rate_gauge = METADATA_REGISTRY_HIT_RATE_GAUGE.labels(registry=name)
+
+    def get(self, key: Hashable) -> T:
+        with self._lock:
+            resource = self._resources.get(key)
+            if resource is not None:
+                self._resources.move_to_end(key)
+                self.hits = self.hits + 1
+                self._hits_counter.inc()
+                self._update_hit_rate_gauge()
+                return resource
+
+        # built outside of the lock, so concurrent misses may build the same
+        # resource twice, but only the first one is kept
+        resource = self.build(key)
+        with self._lock:
+            self.misses = self.misses + 1
+            self._misses_counter.inc()
+            self._update_hit_rate_gauge()
+            resource = self._resources.setdefault(key, resource)
+            self._resources.move_to_end(key)
+            while len(self._resources) > self.max_size:
+                self._resources.popitem(last=False)
+        return resource
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def _update_hit_rate_gauge(self):
+        self._hit_rate_gauge.set(self.hit_rate)
+
+    def clear(self):
+        with self._lock:
+            self._resources.clear()
@@ -0,0 +1,91 @@
+from collections import deque
+from typing import Dict, Hashable
+
+
+class PartitionOffsets:
+    """
+    Offsets of a single partition which have been started but not yet committed.
+    Messages of a partition are started in offset order but may complete in any order.
+    """
+
+    def __init__(self):
+        self.started: deque[int] = deque()
+        self.pending: set[int] = set()
+        self.completed: set[int] = set()
+        self.committed: int | None = None
+
+    def start(self, offset: int):
+        self.started.append(offset)
+        self.pending.add(offset)
+
+    def complete(self, offset: int):
+        if offset in self.pending:
+            self.pending.remove(offset)
+            self.completed.add(offset)
+
+    def watermark(self) -> int | None:
+        """
+        The next offset to commit, i.e. one past the highest offset up to which
+        all started messages have completed.
+        """
+        watermark = None
+        while len(self.started) > 0 and self.started[0] in self.completed:
+            offset = self.started.popleft()
+            self.completed.remove(offset)
+            watermark = offset + 1
+
+        if watermark is None:
+            return self.committed
+
+        self.committed = watermark
+        return watermark
+
+    def in_flight(self) -> int:
+        return len(self.pending)
+
+
+class OffsetTracker:
+    """
+    Tracks concurrently processed messages to only ever commit offsets below
+    which every message has been fully processed, preserving at-least-once delivery.
+    """
+
+    def __init__(self):
+        self.partitions: Dict[Hashable, PartitionOffsets] = {}
+        self._last_committed: Dict[Hashable, int] = {}
+
+    def start(self, partition: Hashable, offset: int):
+        self.partitions.setdefault(partition, PartitionOffsets()).start(offset)
+
+    def complete(self, partition: Hashable, offset: int):
+        # the partition may have been revoked while the message was processed
+        if (partition_offsets := self.partitions.get(partition)) is not None:
+            partition_offsets.complete(offset)
+
+    def committable(self) -> Dict[Hashable, int]:
+        """
+        Returns the offsets to commit for all partitions that advanced since
+        the last call to `mark_committed`
+        """
+        offsets = {}
+        for partition, partition_offsets in self.partitions.items():
+            watermark = partition_offsets.watermark()
+            if watermark is not None and watermark != self._last_committed.get(
+                partition
+            ):
+                offsets[partition] = watermark
+        return offsets
+
+    def mark_committed(self, offsets: Dict[Hashable, int]):
+        self._last_committed.update(offsets)
+
+    def in_flight(self) -> int:
+        return sum(p.in_flight() for p in self.partitions.values())
+
+    def forget(self, partition: Hashable):
+        """
+        Stop tracking a partition, e.g. after it was revoked during a rebalance.
+        Its uncommitted messages will be re-delivered to the new owner.
+        """
+        self.partitions.pop(partition, None)
+        self._last_committed.pop(partition, None)
@@ -0,0 +1,98 @@
+import random
+import time
+from typing import Callable
+
+import structlog
+from fhir.resources.R4B.bundle import Bundle
+from prometheus_client import Counter, Summary
+
+from ahd2fhir import config
+
+OUTPUT_VALIDATION_POLICIES = ["always", "sampled", "never"]
+
+OUTPUT_VALIDATION_DURATION_SUMMARY = Summary(
+    "output_validation_duration_seconds",
+    "Time spent validating result Bundles against the FHIR R4B models",
+)
+OUTPUT_VALIDATION_CPU_SECONDS_COUNTER = Counter(
+    "output_validation_cpu_seconds",
+    "CPU time spent validating result Bundles against the FHIR R4B models",
+)
+OUTPUT_VALIDATION_FAILURES_COUNTER = Counter(
+    "output_validation_failures",
+    "Number of result Bundles failing validation against the FHIR R4B models",
+)
+
+log = structlog.get_logger()
+
+
+class OutputValidator:
+    """
+    Validates result Bundles against the FHIR R4B models according to a policy:
+    "always" validates every Bundle, "sampled" the fraction of them given by
+    sample_rate and "never" none of them. Invalid Bundles are counted and
+    logged, but still returned, as they are mostly built without validation.
+    """
+
+    def __init__(
+        self,
+        policy: str = "never",
+        sample_rate: float = 0.0,
+        random_number: Callable[[], float] = random.random,
+    ):
+        if policy not in OUTPUT_VALIDATION_POLICIES:
+            raise ValueError(
+                f"Unknown output validation policy '{policy}'. "
+                + f"Expected one of {', '.join(OUTPUT_VALIDATION_POLICIES)}"
+            )
+        if sample_rate < 0 or sample_rate > 1:
+            raise ValueError(
+                "The output validation sample rate must be between 0 and 1, "
+                + f"got {sample_rate}"
+            )
+
+        self.policy = policy
+        self.sample_rate = sample_rate
+        self.random_number = random_number
+
+    def should_validate(self) -> bool:
+        if self.policy == "always":
+            return True
+        if self.policy == "sampled":
+            return self.random_number() < self.sample_rate
+        return False
+
+    def validate(self, bundle: Bundle | dict) -> bool:
+        """
+        Validate the Bundle, given as a model or as a dict from the dict mapping
+        backend, and all of its resources. Returns whether it is valid.
+        """
+        started_at = time.thread_time()
+        try:
+            with OUTPUT_VALIDATION_DURATION_SUMMARY.time():
+                Bundle.parse_obj(bundle if isinstance(bundle, dict) else bundle.dict())
+            return True
+        except ValueError as exc:
+            # pydantic's ValidationError is a ValueError
+            OUTPUT_VALIDATION_FAILURES_COUNTER.inc()
+            log.error(
+                "Result Bundle failed validation",
+                bundle_id=bundle["id"] if isinstance(bundle, dict) else bundle.id,
+                error=str(exc),
+            )
+            return False
+        finally:
+            OUTPUT_VALIDATION_CPU_SECONDS_COUNTER.inc(time.thread_time() - started_at)
+
+    def maybe_validate(self, bundle: Bundle | dict) -> None:
+        """
+        Validate the Bundle if the policy selects it
+        """
+        if self.should_validate():
+            self.validate(bundle)
+
+
+def build_output_validator(
+    settings: config.OutputValidationSettings,
+) -> OutputValidator:
+    return OutputValidator(settings.policy, settings.sample_rate)
@@ -0,0 +1,63 @@
+import concurrent.futures
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Tuple
+
+from fhir.resources.R4B.bundle import Bundle
+from fhir.resources.R4B.documentreference import DocumentReference
+
+from ahd2fhir.utils.analysis_archive import load_annotations, parse_archive_record
+from ahd2fhir.utils.resource_handler import ResourceHandler
+
+
+@lru_cache()
+def get_resource_handler() -> ResourceHandler:
+    """
+    Mapping doesn't need a pipeline, so each process uses a single handler,
+    built on first use as it builds the mapper registries from the environment
+    """
+    return ResourceHandler(averbis_pipeline=None)
+
+
+def replay_document(
+    document_reference: DocumentReference, annotations: list | dict
+) -> Bundle:
+    """
+    Map a DocumentReference and its raw AHD annotations to a result Bundle
+    without calling AHD. The annotations can be in the format returned by AHD,
+    with or without the `payload` wrapper.
+    """
+    return get_resource_handler().map_documents(
+        [(document_reference, load_annotations(annotations))]
+    )
+
+
+def replay_archive_record(record: bytes | str) -> Bundle:
+    return replay_document(*parse_archive_record(record))
+
+
+def _replay_pair(pair: Tuple[DocumentReference, List[dict]]) -> Bundle:
+    return replay_document(*pair)
+
+
+def replay_documents(
+    analyzed_documents: Iterable[Tuple[DocumentReference, list | dict]],
+    processes: int | None = None,
+    chunksize: int = 16,
+) -> Iterator[Bundle]:
+    """
+    Replay pairs of DocumentReferences and their annotations using a pool of
+    `processes` processes. Yields the result Bundles in the order of the input.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        yield from executor.map(_replay_pair, analyzed_documents, chunksize=chunksize)
+
+
+def replay_archive_records(
+    records: Iterable[bytes | str], processes: int | None = None, chunksize: int = 16
+) -> Iterator[Bundle]:
+    """
+    Replay NDJSON records written by the AnalysisArchive using a pool of
+    `processes` processes. Yields the result Bundles in the order of the input.
+    """
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        yield from executor.map(replay_archive_record, records, chunksize=chunksize)
@@ -0,0 +1,71 @@
+import json
+from typing import Iterable, Tuple
+
+from fhir.resources.R4B.bundle import Bundle
+from fhir.resources.R4B.documentreference import DocumentReference
+from prometheus_client import Histogram
+
+try:
+    import orjson
+
+    def loads(value: bytes | str):
+        return orjson.loads(value)
+
+except ImportError:  # pragma: no cover
+    loads = json.loads
+
+DECODE_DURATION_HISTOGRAM = Histogram(
+    "resource_decode_duration_seconds",
+    "Time spent decoding a serialized FHIR resource into its model",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, "inf"),
+)
+
+SUPPORTED_RESOURCE_TYPES = {
+    "DocumentReference": DocumentReference,
+    "Bundle": Bundle,
+}
+
+
+class UnsupportedResourceTypeError(ValueError):
+    pass
+
+
+def get_header(headers: Iterable[Tuple[str, bytes]] | None, name: str) -> str | None:
+    """
+    Returns the decoded value of the first Kafka header called `name`
+    """
+    for key, value in headers or []:
+        if key == name and value is not None:
+            return value.decode("utf8")
+    return None
+
+
+def decode_resource(
+    value: bytes | str, resource_type: str | None = None
+) -> DocumentReference | Bundle:
+    """
+    Parse a serialized DocumentReference or Bundle in a single pass.
+    If the `resource_type` is already known, e.g. from a message header,
+    unsupported resources are rejected without parsing them.
+    """
+    if resource_type is not None and resource_type not in SUPPORTED_RESOURCE_TYPES:
+        raise UnsupportedResourceTypeError(
+            f"Unprocessable resource type '{resource_type}'"
+        )
+
+    with DECODE_DURATION_HISTOGRAM.time():
+        resource_json = loads(value)
+
+        if not isinstance(resource_json, dict):
+            raise ValueError("Payload is not a JSON object")
+
+        if resource_type is None:
+            resource_type = resource_json.get("resourceType")
+            if resource_type not in SUPPORTED_RESOURCE_TYPES:
+                raise UnsupportedResourceTypeError(
+                    f"Unprocessable resource type '{resource_type}'"
+                )
+
+        # builds the model from the already parsed structure.
+        # Fails if the body's resourceType doesn't match the header.
+        return SUPPORTED_RESOURCE_TYPES[resource_type].parse_obj(resource_json)
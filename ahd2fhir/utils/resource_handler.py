@@ -1,33 +1,47 @@
-import base64
+import asyncio
+import concurrent.futures
+import contextlib
+import io
 import logging
-import os
 from datetime import datetime, timezone
-from typing import List, Tuple
+from typing import Callable, List, Tuple
 
 import structlog
 import tenacity
 from averbis import Pipeline
 from fhir.resources.R4B.bundle import Bundle
 from fhir.resources.R4B.codeableconcept import CodeableConcept
-from fhir.resources.R4B.composition import Composition, CompositionSection
+from fhir.resources.R4B.composition import Composition
 from fhir.resources.R4B.documentreference import DocumentReference
 from fhir.resources.R4B.fhirtypes import DateTime
-from fhir.resources.R4B.identifier import Identifier
-from fhir.resources.R4B.reference import Reference
 from fhir.resources.R4B.resource import Resource
 from prometheus_client import Counter, Histogram, Summary
 from tenacity.after import after_log
 
-from ahd2fhir.mappers import ahd_to_condition, ahd_to_list, ahd_to_medication_statement
+from ahd2fhir.mappers import ahd_to_list
+from ahd2fhir.utils import fhir_dicts, fhir_fragments
+from ahd2fhir.utils.analysis_archive import AnalysisArchive
+from ahd2fhir.utils.analysis_cache import (
+    CACHE_ERRORS_COUNTER,
+    AnalysisCache,
+    build_cache_key,
+)
+from ahd2fhir.utils.attachment_decoder import iter_decoded_text
 from ahd2fhir.utils.bundle_builder import BundleBuilder
 from ahd2fhir.utils.const import (
     AHD_TYPE_DIAGNOSIS,
     AHD_TYPE_DOCUMENT_ANNOTATION,
     AHD_TYPE_MEDICATION,
 )
-from ahd2fhir.utils.custom_mappers import custom_mappers, mapper_functions
-from ahd2fhir.utils.device_builder import build_device
-from ahd2fhir.utils.fhir_utils import sha256_of_identifier
+from ahd2fhir.utils.custom_mappers import mapper_functions
+from ahd2fhir.utils.fhir_utils import sha256_of_system_and_value
+from ahd2fhir.utils.mapper_registry import (
+    MapperRegistry,
+    build_dict_mapper_registry,
+    build_mapper_registry,
+)
+from ahd2fhir.utils.output_validation import OutputValidator
+from ahd2fhir.utils.text_chunking import TextChunk, TextChunker
 
 MAPPING_FAILURES_COUNTER = Counter("mapping_failures", "Exceptions during mapping")
 MAPPING_DURATION_SUMMARY = Histogram(
@@ -56,6 +70,10 @@ DOCUMENT_LENGTH_SUMMARY = Summary(
     "document_length",
     "Length of each processed document's text in charactes",
 )
+DOCUMENT_CHUNKS_SUMMARY = Summary(
+    "document_chunks",
+    "Number of chunks each document split for analysis is analyzed in",
+)
 
 DISCHARGE_SUMMARY_CONCEPT_TEXT = "Discharge summary"
 DISCHARGE_SUMMARY_CONCEPT = CodeableConcept(
@@ -70,8 +88,17 @@ DISCHARGE_SUMMARY_CONCEPT = CodeableConcept(
         "text": DISCHARGE_SUMMARY_CONCEPT_TEXT,
     }
 )
+DISCHARGE_SUMMARY_CONCEPT_DICT = fhir_fragments.freeze(DISCHARGE_SUMMARY_CONCEPT.dict())
 
 
+AHD_RETRY_POLICY = dict(
+    stop=tenacity.stop.stop_after_attempt(10),
+    wait=tenacity.wait.wait_fixed(5)
+    + tenacity.wait.wait_random_exponential(multiplier=1, max=30),
+    after=after_log(logging.getLogger(), logging.WARNING),
+    reraise=True,
+)
+
 log = structlog.get_logger()
 
 
@@ -79,15 +106,73 @@ class TransientError(Exception):
     pass
 
 
+def get_annotation_types() -> str:
+    """
+    Comma-separated list of all annotation types requested from AHD
+    """
+    return ",".join(
+        [
+            AHD_TYPE_DIAGNOSIS,
+            AHD_TYPE_MEDICATION,
+            AHD_TYPE_DOCUMENT_ANNOTATION,
+            *mapper_functions.keys(),
+        ]
+    )
+
+
+async def gather_or_cancel(coroutines: list) -> list:
+    """
+    Run the coroutines concurrently and return their results in their order,
+    cancelling the remaining ones as soon as one of them fails
+    """
+    tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+
+
 class ResourceHandler:
     def __init__(
         self,
         averbis_pipeline: Pipeline,
         fixed_composition_datetime: datetime | None = None,
+        max_concurrent_documents: int = 1,
+        analysis_semaphore: asyncio.Semaphore | None = None,
+        analysis_cache: AnalysisCache | None = None,
+        analysis_archive: AnalysisArchive | None = None,
+        mapper_registry: MapperRegistry | None = None,
+        dict_mapper_registry: MapperRegistry | None = None,
+        output_validator: OutputValidator | None = None,
+        text_chunker: TextChunker | None = None,
+        release_attachment_data: bool = False,
     ):
+        """
+        max_concurrent_documents limits the documents of a call to
+        ahandle_documents analyzed at once, a shared analysis_semaphore the
+        in-flight AHD requests of all handlers. Only set release_attachment_data
+        if the documents aren't used afterwards, as their data is removed.
+        """
         self.pipeline = averbis_pipeline
         self.bundle_builder = BundleBuilder()
         self.fixed_composition_datetime = fixed_composition_datetime
+        self.max_concurrent_documents = max_concurrent_documents
+        self.analysis_semaphore = analysis_semaphore
+        self.analysis_cache = analysis_cache
+        self.analysis_archive = analysis_archive
+        self.mapper_registry = (
+            mapper_registry if mapper_registry is not None else build_mapper_registry()
+        )
+        self.dict_mapper_registry = (
+            dict_mapper_registry
+            if dict_mapper_registry is not None
+            else build_dict_mapper_registry()
+        )
+        self.output_validator = output_validator
+        self.text_chunker = text_chunker
+        self.release_attachment_data = release_attachment_data
 
     @MAPPING_FAILURES_COUNTER.count_exceptions()
     @MAPPING_DURATION_SUMMARY.time()
@@ -95,12 +180,149 @@ class ResourceHandler:
         """
         Process a list of DocumentReferences
         """
+        processed_documents = [
+            (document_reference, self._process_documentreference(document_reference))
+            for document_reference in document_references
+        ]
+
+        return self._validate_output(self._build_result_bundle(processed_documents))
+
+    def handle_bundle(self, bundle: Bundle):
+        """
+        Process all FHIR DocumentReference resources from a given bundle
+        """
+        return self.handle_documents(self._get_document_references(bundle))
+
+    def map_documents(
+        self, analyzed_documents: List[Tuple[DocumentReference, List[dict]]]
+    ) -> Bundle:
+        """
+        Map DocumentReferences and their already available AHD annotations,
+        e.g. from an archive, without calling AHD
+        """
+        processed_documents = [
+            (document_reference, self._map_annotations(annotations, document_reference))
+            for document_reference, annotations in analyzed_documents
+        ]
+
+        return self._validate_output(self._build_result_bundle(processed_documents))
+
+    def map_documents_as_dict(
+        self, analyzed_documents: List[Tuple[DocumentReference, List[dict]]]
+    ) -> dict:
+        """
+        Same as map_documents, but maps to a Bundle given as a dict using the
+        dict mapping backend, i.e. without constructing any models
+        """
+        processed_documents = [
+            (
+                document_reference,
+                self._map_annotations_as_dicts(annotations, document_reference),
+            )
+            for document_reference, annotations in analyzed_documents
+        ]
+
+        return self._validate_output(
+            self._build_result_bundle_as_dict(processed_documents)
+        )
+
+    async def ahandle_documents(
+        self, document_references: List[DocumentReference]
+    ) -> Bundle:
+        """
+        Process a list of DocumentReferences without blocking the event loop
+        """
+        return await self._ahandle_documents(
+            document_references, self._map_annotations, self._build_result_bundle
+        )
+
+    async def ahandle_documents_as_dict(
+        self, document_references: List[DocumentReference]
+    ) -> dict:
+        """
+        Same as ahandle_documents, but maps to a Bundle given as a dict using the
+        dict mapping backend. Serialize it with fhir_response.serialize_dict.
+        """
+        return await self._ahandle_documents(
+            document_references,
+            self._map_annotations_as_dicts,
+            self._build_result_bundle_as_dict,
+        )
+
+    async def _ahandle_documents(
+        self,
+        document_references: List[DocumentReference],
+        map_annotations: Callable[[List[dict], DocumentReference], list],
+        build_result_bundle: Callable[[list], Bundle | dict],
+    ):
+        # the prometheus decorators only support synchronous functions
+        with MAPPING_FAILURES_COUNTER.count_exceptions():
+            with MAPPING_DURATION_SUMMARY.time():
+                document_semaphore = asyncio.Semaphore(self.max_concurrent_documents)
+
+                async def process(document_reference: DocumentReference):
+                    async with document_semaphore:
+                        resources_from_document = (
+                            await self._aprocess_documentreference(
+                                document_reference, map_annotations
+                            )
+                        )
+                    return document_reference, resources_from_document
+
+                # in the order of the input documents, keeping the resulting
+                # Bundle deterministic
+                processed_documents = await gather_or_cancel(
+                    [
+                        process(document_reference)
+                        for document_reference in document_references
+                    ]
+                )
+
+                result_bundle = build_result_bundle(processed_documents)
+                if (
+                    self.output_validator is not None
+                    and self.output_validator.should_validate()
+                ):
+                    await asyncio.to_thread(
+                        self.output_validator.validate, result_bundle
+                    )
+                return result_bundle
+
+    async def ahandle_bundle(self, bundle: Bundle):
+        """
+        Process all FHIR DocumentReference resources from a given bundle
+        without blocking the event loop
+        """
+        return await self.ahandle_documents(self._get_document_references(bundle))
+
+    async def ahandle_bundle_as_dict(self, bundle: Bundle) -> dict:
+        """
+        Same as ahandle_bundle, but maps to a Bundle given as a dict using the
+        dict mapping backend
+        """
+        return await self.ahandle_documents_as_dict(
+            self._get_document_references(bundle)
+        )
+
+    def _get_document_references(self, bundle: Bundle) -> List[DocumentReference]:
+        document_references = []
+        for entry in bundle.entry:
+            if entry.resource.resource_type == "DocumentReference":
+                document_references.append(entry.resource)
+
+        return document_references
+
+    def _validate_output(self, result_bundle: Bundle | dict) -> Bundle | dict:
+        if self.output_validator is not None:
+            self.output_validator.maybe_validate(result_bundle)
+        return result_bundle
+
+    def _build_result_bundle(
+        self, processed_documents: List[Tuple[DocumentReference, List[Resource]]]
+    ) -> Bundle:
         all_resources = []
         bundle_id = None
-        for document_reference in document_references:
-            resources_from_document = self._process_documentreference(
-                document_reference
-            )
+        for document_reference, resources_from_document in processed_documents:
             composition = self._build_composition(
                 document_reference, resources_from_document
             )
@@ -118,138 +340,213 @@ class ResourceHandler:
 
         return result_bundle
 
-    def handle_bundle(self, bundle: Bundle):
-        """
-        Process all FHIR DocumentReference resources from a given bundle
-        """
-        document_references = []
-        for entry in bundle.entry:
-            if entry.resource.resource_type == "DocumentReference":
-                document_references.append(entry.resource)
+    def _build_result_bundle_as_dict(
+        self, processed_documents: List[Tuple[DocumentReference, List[dict]]]
+    ) -> dict:
+        all_resources = []
+        bundle_id = None
+        for document_reference, resources_from_document in processed_documents:
+            composition = self._build_composition_as_dict(
+                document_reference, resources_from_document
+            )
+
+            bundle_id = composition["id"]
+
+            all_resources.extend(resources_from_document)
+            all_resources.append(composition)
+
+            EXTRACTED_RESOURCES_COUNT_SUMMARY.observe(len(all_resources))
 
-        return self.handle_documents(document_references)
+        return self.bundle_builder.build_dict_from_resources(all_resources, bundle_id)
 
     def _build_composition(
         self, document_reference: DocumentReference, all_resources: List[Resource]
-    ):
+    ) -> Composition:
+        return fhir_dicts.construct(
+            Composition,
+            self._build_composition_dict(
+                document_reference,
+                [(resource.resource_type, resource.id) for resource in all_resources],
+            ),
+        )
+
+    def _build_composition_as_dict(
+        self, document_reference: DocumentReference, all_resources: List[dict]
+    ) -> dict:
+        return self._build_composition_dict(
+            document_reference,
+            [(resource["resourceType"], resource["id"]) for resource in all_resources],
+        )
+
+    def _build_composition_dict(
+        self,
+        document_reference: DocumentReference,
+        resource_ids: List[Tuple[str, str]],
+    ) -> dict:
+        """
+        Builds the Composition listing the resources given by their type and id
+        as a dict, without constructing any models
+        """
         composition_type = (
-            document_reference.type
+            document_reference.type.dict()
             if document_reference.type is not None
-            else DISCHARGE_SUMMARY_CONCEPT
+            else DISCHARGE_SUMMARY_CONCEPT_DICT
         )
 
-        composition_subject = document_reference.subject
-        composition_category = document_reference.category
         composition_encounter = None
-
         if document_reference.context is not None:
             if len(document_reference.context.encounter) > 1:
                 log.warning(
                     "DocumentReference contains more than one encounter. "
                     + "Using the first."
                 )
-            composition_encounter = document_reference.context.encounter[0]
+            composition_encounter = document_reference.context.encounter[0].dict()
 
         composition_author = None
-        composition_sections: list[CompositionSection] = []
-        for resource in all_resources:
-            resource_type = resource.resource_type
-
+        # sections in the order their resource type first occurs
+        section_entries: dict[str, list] = {}
+        for resource_type, resource_id in resource_ids:
             if resource_type == "Device":
-                author = Reference.construct()
-                author.reference = f"Device/{resource.id}"
-                author.type = "Device"
-                composition_author = author
+                composition_author = {
+                    "reference": f"Device/{resource_id}",
+                    "type": "Device",
+                }
                 continue
 
-            # Check if no resource specific section exists ands adds it,
-            # otherwise select the correct section
-            if not any(
-                section.title == resource_type for section in composition_sections
-            ):
-                resource_section = CompositionSection.construct()
-                resource_section.title = resource_type
-                resource_section.entry = []
-
-                composition_sections.append(resource_section)
-
-                ind = len(composition_sections) - 1
-            else:
-                ind = [
-                    ind
-                    for ind, section in enumerate(composition_sections)
-                    if section.title == resource_type
-                ][0]
-
-            entry_reference = Reference.construct()
-            entry_reference.reference = resource_type + "/" + resource.id
-
-            composition_sections[ind].entry.append(entry_reference)
+            section_entries.setdefault(resource_type, []).append(
+                {"reference": resource_type + "/" + resource_id}
+            )
 
         if composition_author is None:
-            composition_author = Reference(**{"display": "Averbis Health Discovery"})
+            composition_author = {"display": "Averbis Health Discovery"}
 
-        composition_identifier = (
-            self._build_composition_identifier_from_documentreference(
-                document_reference
-            )
+        composition_identifier = self._build_composition_identifier_dict(
+            document_reference
         )
 
         composition_datetime: datetime = datetime.now(tz=timezone.utc)
         if self.fixed_composition_datetime:
             composition_datetime = self.fixed_composition_datetime
 
-        composition = Composition(
-            **{
-                "title": "AHD2FHIR NLP Processing Results "
-                + composition_datetime.isoformat(),
+        return fhir_dicts.compact(
+            {
+                "resourceType": "Composition",
+                "id": sha256_of_system_and_value(
+                    composition_identifier["system"], composition_identifier["value"]
+                ),
+                "identifier": composition_identifier,
                 "status": "final",
-                "date": DateTime.validate(composition_datetime),
                 "type": composition_type,
-                "identifier": composition_identifier,
-                "id": sha256_of_identifier(composition_identifier),
-                "subject": composition_subject,
-                "category": composition_category,
+                "category": [
+                    category.dict() for category in document_reference.category or []
+                ],
+                "subject": (
+                    document_reference.subject.dict()
+                    if document_reference.subject is not None
+                    else None
+                ),
                 "encounter": composition_encounter,
+                "date": DateTime.validate(composition_datetime),
                 "author": [composition_author],
-                "section": composition_sections,
+                "title": "AHD2FHIR NLP Processing Results "
+                + composition_datetime.isoformat(),
+                "section": [
+                    {"title": resource_type, "entry": entries}
+                    for resource_type, entries in section_entries.items()
+                ],
             }
         )
 
-        return composition
-
     def _process_documentreference(self, document_reference: DocumentReference):
-        log = structlog.get_logger().bind(
-            document_id=f"{document_reference.get_resource_type()}/"
-            + f"{document_reference.id}"
-        )
-
-        # Text extraction and text analysis
         (text, content_type, lang) = self._extract_text_from_resource(
             document_reference
         )
 
-        DOCUMENT_LENGTH_SUMMARY.observe(len(text))
+        with self._raise_analysis_errors_as_transient(document_reference):
+            averbis_result = self._perform_document_analysis(
+                text=text, mime_type=content_type, lang=lang
+            )
 
-        averbis_result = None
+        # only the annotations are needed from now on
+        del text
 
-        try:
-            averbis_result = self._perform_text_analysis(
+        return self._map_document(document_reference, averbis_result)
+
+    async def _aprocess_documentreference(
+        self,
+        document_reference: DocumentReference,
+        map_annotations: Callable[[List[dict], DocumentReference], list] | None = None,
+    ):
+        # decoding large attachments blocks, so keep it from starving other requests
+        (text, content_type, lang) = await asyncio.to_thread(
+            self._extract_text_from_resource, document_reference
+        )
+
+        with self._raise_analysis_errors_as_transient(document_reference):
+            averbis_result = await self._aperform_document_analysis(
                 text=text, mime_type=content_type, lang=lang
             )
+
+        del text
+
+        # archiving and mapping block, so keep them from starving other requests
+        return await asyncio.to_thread(
+            self._map_document, document_reference, averbis_result, map_annotations
+        )
+
+    @contextlib.contextmanager
+    def _raise_analysis_errors_as_transient(
+        self, document_reference: DocumentReference
+    ):
+        try:
+            yield
         except Exception as exc:
+            log = structlog.get_logger().bind(
+                document_id=f"{document_reference.get_resource_type()}/"
+                + f"{document_reference.id}"
+            )
             log.exception(exc)
             log.error("Failed to perform text analysis", error=exc)
             raise TransientError(exc)
 
+    def _map_document(
+        self,
+        document_reference: DocumentReference,
+        averbis_result: List[dict],
+        map_annotations: Callable[[List[dict], DocumentReference], list] | None = None,
+    ) -> list:
+        if self.analysis_archive is not None:
+            self.analysis_archive.append(document_reference, averbis_result)
+
+        return (map_annotations or self._map_annotations)(
+            averbis_result, document_reference
+        )
+
+    def _map_annotations(
+        self, averbis_result: List[dict], document_reference: DocumentReference
+    ) -> List[Resource]:
         total_results = []
 
         # Building FHIR resources as results
 
-        lists = ahd_to_list.get_fhir_list(
-            annotation_results=averbis_result, document_reference=document_reference
-        )
-        if lists is not None:
+        mapped_resources = []
+        # the lists reference the statements mapped from each medication
+        # annotation, so they don't need to be mapped a second time
+        annotation_medication_statements = []
+        medication_statement_list = []
+        for val in averbis_result:
+            for mapper in self.mapper_registry.get(val["type"]):
+                for resource in mapper(val, document_reference):
+                    if resource.resource_type == "MedicationStatement":
+                        annotation_medication_statements.append((val, resource))
+                        medication_statement_list.append(resource)
+                    else:
+                        mapped_resources.append(resource)
+
+        if len(averbis_result) > 0:
+            lists = ahd_to_list.build_medication_lists(
+                annotation_medication_statements, document_reference
+            )
             discharge_list = lists["DISCHARGE"]
             if discharge_list is not None:
                 total_results.append(discharge_list)
@@ -260,44 +557,56 @@ class ResourceHandler:
             if inpatient_list is not None:
                 total_results.append(inpatient_list)
 
-        medication_statement_list = []
-        for val in averbis_result:
-            if val["type"] == AHD_TYPE_DIAGNOSIS:
-                mapped_condition = ahd_to_condition.get_fhir_condition(
-                    val, document_reference
-                )
-                if mapped_condition is not None:
-                    total_results.append(mapped_condition)
-
-            if val["type"] == AHD_TYPE_DOCUMENT_ANNOTATION:
-                device = build_device(val)
-                if device is not None:
-                    total_results.append(device)
-
-            if val["type"] == AHD_TYPE_MEDICATION:
-                statement = ahd_to_medication_statement.get_fhir_medication_statement(
-                    val, document_reference
-                )
-                if statement is not None:
-                    medication_statement_list.append(statement)
-
-            # if custom_mappers_enabled
-            if os.getenv("CUSTOM_MAPPERS_ENABLED", "False").lower() in ["true", "1"]:
-                total_results.extend(custom_mappers(val, document_reference))
-
-        medication_statement_results = []
-        for medication_statement in medication_statement_list:
-            medication_statement_results.append(medication_statement)
+        total_results.extend(mapped_resources)
 
         # de-duplicate any Medication and MedicationStatement resources
         medication_statements_unique = {
-            m.id: m for m in medication_statement_results
+            m.id: m for m in medication_statement_list
         }.values()
 
         total_results.extend(medication_statements_unique)
 
         return total_results
 
+    def _map_annotations_as_dicts(
+        self, averbis_result: List[dict], document_reference: DocumentReference
+    ) -> List[dict]:
+        """
+        Same as _map_annotations, but maps to resources given as dicts using the
+        mappers of the dict_mapper_registry
+        """
+        # converted once, the dict mappers read the document's elements from
+        # the dict. Its attachments are left out, as they are never read.
+        document = fhir_dicts.get_document_elements(document_reference, as_dicts=True)
+        total_results = []
+
+        mapped_resources = []
+        annotation_medication_statements = []
+        medication_statement_list = []
+        for val in averbis_result:
+            for mapper in self.dict_mapper_registry.get(val["type"]):
+                for resource in mapper(val, document):
+                    if resource["resourceType"] == "MedicationStatement":
+                        annotation_medication_statements.append((val, resource))
+                        medication_statement_list.append(resource)
+                    else:
+                        mapped_resources.append(resource)
+
+        if len(averbis_result) > 0:
+            lists = ahd_to_list.build_medication_list_dicts(
+                annotation_medication_statements, document
+            )
+            total_results.extend(
+                [lists["DISCHARGE"], lists["ADMISSION"], lists["INPATIENT"]]
+            )
+
+        total_results.extend(mapped_resources)
+
+        # de-duplicate any Medication and MedicationStatement resources
+        total_results.extend({m["id"]: m for m in medication_statement_list}.values())
+
+        return total_results
+
     def _extract_text_from_resource(
         self,
         document_reference: DocumentReference,
@@ -336,32 +645,182 @@ class ResourceHandler:
         if content.attachment.language:
             language = content.attachment.language.lower().split("-")[0]
 
-        return (
-            base64.b64decode(content.attachment.data).decode("utf8"),
-            str(content.attachment.contentType),
-            str(language),
+        data = content.attachment.data
+        if self.release_attachment_data:
+            content.attachment.data = None
+
+        # decoded piece by piece and joined as the pieces come in, so neither
+        # the decoded bytes of the whole text nor all of its pieces are held
+        # at once. With the data released, the buffer is the only other copy
+        # of the text while it is read.
+        buffer = io.StringIO()
+        for text_piece in iter_decoded_text(data):
+            buffer.write(text_piece)
+        del data
+        text = buffer.getvalue()
+        del buffer
+
+        DOCUMENT_LENGTH_SUMMARY.observe(len(text))
+
+        return (text, str(content.attachment.contentType), str(language))
+
+    def _split_text(self, text: str, mime_type: str) -> List[TextChunk] | None:
+        """
+        The chunks to analyze the text in, or None to analyze it at once.
+        HTML is never split, as its markup might be cut.
+        """
+        if self.text_chunker is None or mime_type == "text/html":
+            return None
+
+        chunks = self.text_chunker.split(text)
+        if len(chunks) == 1:
+            return None
+
+        DOCUMENT_CHUNKS_SUMMARY.observe(len(chunks))
+        return chunks
+
+    def _perform_document_analysis(
+        self, text: str, mime_type: str = "text/plain", lang: str | None = None
+    ):
+        chunks = self._split_text(text, mime_type)
+        if chunks is None:
+            return self._perform_text_analysis(
+                text=text, mime_type=mime_type, lang=lang
+            )
+
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.text_chunker.max_concurrent_chunks
+        ) as executor:
+            chunk_annotations = list(
+                executor.map(
+                    lambda chunk: self._perform_text_analysis(
+                        text=chunk.text, mime_type=mime_type, lang=lang
+                    ),
+                    chunks,
+                )
+            )
+
+        return self.text_chunker.merge(text, chunks, chunk_annotations)
+
+    async def _aperform_document_analysis(
+        self, text: str, mime_type: str = "text/plain", lang: str | None = None
+    ):
+        chunks = self._split_text(text, mime_type)
+        if chunks is None:
+            return await self._aperform_text_analysis(
+                text=text, mime_type=mime_type, lang=lang
+            )
+
+        chunk_semaphore = asyncio.Semaphore(self.text_chunker.max_concurrent_chunks)
+
+        async def analyse(chunk: TextChunk):
+            async with chunk_semaphore:
+                return await self._aperform_text_analysis(
+                    text=chunk.text, mime_type=mime_type, lang=lang
+                )
+
+        chunk_annotations = await gather_or_cancel([analyse(chunk) for chunk in chunks])
+
+        return await asyncio.to_thread(
+            self.text_chunker.merge, text, chunks, chunk_annotations
         )
 
-    @tenacity.retry(
-        stop=tenacity.stop.stop_after_attempt(10),
-        wait=tenacity.wait.wait_fixed(5)
-        + tenacity.wait.wait_random_exponential(multiplier=1, max=30),
-        after=after_log(logging.getLogger(), logging.WARNING),
-        reraise=True,
-    )
     def _perform_text_analysis(
         self, text: str, mime_type: str = "text/plain", lang: str | None = None
     ):
-        types = ",".join(
-            [
-                AHD_TYPE_DIAGNOSIS,
-                AHD_TYPE_MEDICATION,
-                AHD_TYPE_DOCUMENT_ANNOTATION,
-                *mapper_functions.keys(),
-            ]
+        cache_key, cached_result = self._get_cached_analysis(text, mime_type, lang)
+        if cached_result is not None:
+            return cached_result
+
+        result = self._analyse_text_with_retries(
+            text=text, mime_type=mime_type, lang=lang
         )
 
-        analyse_args = {"language": lang, "annotation_types": types}
+        self._cache_analysis(cache_key, result)
+        return result
+
+    async def _aperform_text_analysis(
+        self, text: str, mime_type: str = "text/plain", lang: str | None = None
+    ):
+        # cache backends may block on disk I/O, so access them from a worker thread
+        cache_key, cached_result = None, None
+        if self.analysis_cache is not None:
+            cache_key, cached_result = await asyncio.to_thread(
+                self._get_cached_analysis, text, mime_type, lang
+            )
+        if cached_result is not None:
+            return cached_result
+
+        result = await self._aanalyse_text_with_retries(
+            text=text, mime_type=mime_type, lang=lang
+        )
+
+        if cache_key is not None:
+            await asyncio.to_thread(self._cache_analysis, cache_key, result)
+        return result
+
+    def _get_cached_analysis(
+        self, text: str, mime_type: str, lang: str | None
+    ) -> Tuple[str | None, List[dict] | None]:
+        """
+        The key to cache the analysis of the text by and its cached result, if
+        any. The cache is only an optimization, so if it fails, the text is
+        analyzed as if it wasn't cached.
+        """
+        if self.analysis_cache is None:
+            return None, None
+
+        try:
+            cache_key = build_cache_key(
+                text=text,
+                mime_type=mime_type,
+                lang=lang,
+                annotation_types=get_annotation_types(),
+                pipeline_identity=self.analysis_cache.get_pipeline_identity(),
+            )
+            return cache_key, self.analysis_cache.get(cache_key)
+        except Exception as exc:
+            self._record_cache_error("get", exc)
+            return None, None
+
+    def _cache_analysis(self, cache_key: str | None, result: List[dict]):
+        if cache_key is None:
+            return
+
+        try:
+            self.analysis_cache.set(cache_key, result)
+        except Exception as exc:
+            # the result is returned all the same, only not cached
+            self._record_cache_error("set", exc)
+
+    def _record_cache_error(self, operation: str, exc: Exception):
+        log.exception(exc)
+        log.error("Analysis cache failed", operation=operation, error=exc)
+        CACHE_ERRORS_COUNTER.labels(
+            backend=self.analysis_cache.backend, operation=operation
+        ).inc()
+
+    @tenacity.retry(**AHD_RETRY_POLICY)
+    def _analyse_text_with_retries(
+        self, text: str, mime_type: str = "text/plain", lang: str | None = None
+    ):
+        return self._analyse_text(text=text, mime_type=mime_type, lang=lang)
+
+    @tenacity.retry(**AHD_RETRY_POLICY)
+    async def _aanalyse_text_with_retries(
+        self, text: str, mime_type: str = "text/plain", lang: str | None = None
+    ):
+        # the averbis client is synchronous, so run the request in a worker
+        # thread. tenacity uses asyncio.sleep between retries of coroutines.
+        # Only each attempt counts towards the in-flight AHD requests, so
+        # neither cache hits nor the waits between retries hold the semaphore.
+        async with self.analysis_semaphore or contextlib.nullcontext():
+            return await asyncio.to_thread(
+                self._analyse_text, text=text, mime_type=mime_type, lang=lang
+            )
+
+    def _analyse_text(self, text: str, mime_type: str, lang: str | None):
+        analyse_args = {"language": lang, "annotation_types": get_annotation_types()}
 
         try:
             if mime_type == "text/html":
@@ -373,10 +832,10 @@ class ResourceHandler:
             log.error("Text analysis failed")
             raise exc
 
-    def _build_composition_identifier_from_documentreference(
+    def _build_composition_identifier_dict(
         self,
         doc_ref: DocumentReference,
-    ):
+    ) -> dict:
         """
         construct a hopefully unqiue identifier for the condition from
         the document identifier as well as the offset into the text
@@ -403,9 +862,7 @@ class ResourceHandler:
 
         composition_identifier_value = f"{doc_ref_identifier}_ahd-analysis-result"
 
-        return Identifier(
-            **{
-                "system": composition_identifier_system,
-                "value": composition_identifier_value,
-            }
-        )
+        return {
+            "system": composition_identifier_system,
+            "value": composition_identifier_value,
+        }
@@ -0,0 +1,165 @@
+"""
+Splits long texts into overlapping chunks analyzed by AHD one by one and
+merges their annotations back into the annotations of the whole text.
+"""
+
+import re
+from typing import List, NamedTuple
+
+from ahd2fhir import config
+
+# preferred boundaries to split at, from the best to the last resort:
+# paragraphs, sentences and lines, and any whitespace
+BOUNDARY_PATTERNS = [
+    re.compile(r"\n[ \t]*\n\s*"),
+    re.compile(r"[.!?]\s+|\n\s*"),
+    re.compile(r"\s+"),
+]
+
+
+class TextChunk(NamedTuple):
+    text: str
+    # position of the chunk's first character in the whole text
+    offset: int
+
+    @property
+    def end(self) -> int:
+        return self.offset + len(self.text)
+
+
+def shift_offsets(value, offset: int, suffix: str):
+    """
+    Shift the begin and end offsets of an annotation and all the annotations
+    nested in it, and make their ids unique by appending the suffix
+    """
+    if isinstance(value, list):
+        for item in value:
+            shift_offsets(item, offset, suffix)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            if key in ("begin", "end") and isinstance(item, int):
+                value[key] = item + offset
+            elif key == "id" and item is not None:
+                value[key] = f"{item}{suffix}"
+            else:
+                shift_offsets(item, offset, suffix)
+
+
+class TextChunker:
+    """
+    Splits texts longer than max_chunk_size characters at paragraph or
+    sentence boundaries into chunks overlapping by about overlap characters,
+    so annotations cut at the end of one chunk are found whole in the next.
+    """
+
+    def __init__(self, max_chunk_size: int, overlap: int, max_concurrent_chunks: int):
+        if max_chunk_size <= 0:
+            raise ValueError(
+                f"The maximum chunk size must be positive, got {max_chunk_size}"
+            )
+        if overlap < 0 or overlap >= max_chunk_size // 2:
+            raise ValueError(
+                "The chunk overlap must be at least 0 and less than half of the "
+                + f"maximum chunk size, got {overlap}"
+            )
+        if max_concurrent_chunks <= 0:
+            raise ValueError(
+                "The maximum number of concurrent chunks must be positive, "
+                + f"got {max_concurrent_chunks}"
+            )
+
+        self.max_chunk_size = max_chunk_size
+        self.overlap = overlap
+        self.max_concurrent_chunks = max_concurrent_chunks
+
+    def split(self, text: str) -> List[TextChunk]:
+        chunks = []
+        start = 0
+        while len(text) - start > self.max_chunk_size:
+            end = self._find_boundary(
+                text, start + self.max_chunk_size // 2, start + self.max_chunk_size
+            )
+            chunks.append(TextChunk(text[start:end], start))
+
+            # the next chunk starts at a boundary about overlap characters
+            # before the end of this one
+            if self.overlap == 0:
+                start = end
+            else:
+                start = self._find_boundary(
+                    text,
+                    max(start + 1, end - 2 * self.overlap),
+                    max(start + 1, end - self.overlap),
+                )
+
+        chunks.append(TextChunk(text[start:], start))
+        return chunks
+
+    def merge(
+        self, text: str, chunks: List[TextChunk], chunk_annotations: List[List[dict]]
+    ) -> List[dict]:
+        """
+        Merge the annotations of each chunk into the annotations of the text.
+        The offsets are shifted to the whole text and the ids made unique per
+        chunk. Each overlap is split in the middle and only the annotations
+        beginning before the middle are kept from the first of the two chunks,
+        and those beginning after it from the second one. Annotations covering
+        the whole chunk, like the DocumentAnnotation, are only kept from the
+        first chunk and made to cover the whole text. Modifies the annotations.
+        """
+        merged = []
+        for index, (chunk, annotations) in enumerate(zip(chunks, chunk_annotations)):
+            owned_begin = 0
+            if index > 0:
+                owned_begin = (chunk.offset + chunks[index - 1].end) // 2
+            owned_end = len(text)
+            if index < len(chunks) - 1:
+                owned_end = (chunks[index + 1].offset + chunk.end) // 2
+
+            for annotation in annotations:
+                begin = annotation.get("begin")
+                if begin == 0 and annotation.get("end") == len(chunk.text):
+                    if index == 0:
+                        annotation["end"] = len(text)
+                        if "coveredText" in annotation:
+                            annotation["coveredText"] = text
+                        merged.append(annotation)
+                    continue
+
+                if begin is None:
+                    if index == 0:
+                        merged.append(annotation)
+                    continue
+
+                if not owned_begin <= begin + chunk.offset < owned_end:
+                    continue
+
+                if index > 0:
+                    shift_offsets(annotation, chunk.offset, f"-{index}")
+                merged.append(annotation)
+
+        return merged
+
+    def _find_boundary(self, text: str, lo: int, hi: int) -> int:
+        """
+        The position after the last boundary between lo and hi, preferring
+        paragraphs over sentences over any whitespace, or hi if there is none
+        """
+        for pattern in BOUNDARY_PATTERNS:
+            boundary = None
+            for match in pattern.finditer(text, lo, hi):
+                boundary = match.end()
+            if boundary is not None:
+                return boundary
+        return hi
+
+
+def build_text_chunker(settings: config.TextChunkingSettings) -> TextChunker | None:
+    if not settings.enabled:
+        return None
+
+    return TextChunker(
+        max_chunk_size=settings.max_chunk_size,
+        overlap=settings.overlap,
+        max_concurrent_chunks=settings.max_concurrent_chunks,
+    )
@@ -0,0 +1,109 @@
+"""
+Counts the memory blocks and bytes the mapped resources keep alive per
+annotation, i.e. how many objects each mapped annotation costs once the
+result Bundle is being built, on the scaled AHD test payloads.
+
+    python -m benchmarks.allocations --scale 1 100
+"""
+
+import argparse
+import json
+import logging
+import tracemalloc
+from typing import Dict, List
+
+import structlog
+
+from ahd2fhir.utils.resource_handler import ResourceHandler
+from benchmarks.mappers import (
+    CASES,
+    FIXED_DATETIME,
+    BenchmarkCase,
+    StubPipeline,
+    Workload,
+    load_document_reference,
+    load_payloads,
+)
+
+DEFAULT_CASES = [
+    "get_fhir_condition",
+    "smkstat.get_fhir_resources",
+    "kidney_stone.get_fhir_resources",
+    "ResourceHandler._process_documentreference",
+]
+
+
+def measure_retained(case: BenchmarkCase, workload: Workload) -> Dict[str, float]:
+    if case.annotation_type is None:
+        annotations = workload.annotations
+    else:
+        annotations = [
+            a for a in workload.annotations if a["type"] == case.annotation_type
+        ]
+    if len(annotations) == 0:
+        return None
+
+    state = case.setup(workload, annotations)
+    # create validators and other lazily initialized state outside the trace
+    case.run(workload, state)
+
+    tracemalloc.start()
+    try:
+        result = case.run(workload, state)
+        snapshot = tracemalloc.take_snapshot()
+        retained_bytes, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+
+    retained_blocks = sum(stat.count for stat in snapshot.statistics("filename"))
+    return {
+        "annotations": len(annotations),
+        "retained_blocks_per_annotation": retained_blocks / len(annotations),
+        "retained_bytes_per_annotation": retained_bytes / len(annotations),
+    }
+
+
+def main(argv: List[str] | None = None):
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR)
+    )
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--scale", type=int, nargs="+", default=[1, 100])
+    parser.add_argument("--case", nargs="+", default=DEFAULT_CASES)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    document_reference = load_document_reference()
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for case in CASES:
+        if case.name not in args.case:
+            continue
+        for payload_name, annotations in load_payloads(args.scale).items():
+            workload = Workload(
+                annotations,
+                document_reference,
+                ResourceHandler(
+                    StubPipeline(annotations), fixed_composition_datetime=FIXED_DATETIME
+                ),
+            )
+            result = measure_retained(case, workload)
+            if result is None:
+                continue
+            results.setdefault(case.name, {})[payload_name] = result
+            print(
+                f"{case.name:>45} {payload_name}: "
+                + f"{result['retained_blocks_per_annotation']:8.1f} blocks/annotation "
+                + f"{result['retained_bytes_per_annotation']:10.1f} bytes/annotation"
+            )
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Measures how the time to build the Composition and the result Bundle of a
+document grows with the number of resources mapped from it, using the
+resources mapped from scaled copies of an AHD test payload.
+
+    python -m benchmarks.bundles --resources 100 1000 10000
+"""
+
+import argparse
+import collections
+import gc
+import json
+import logging
+import math
+import time
+from typing import Callable, Dict, List, NamedTuple
+
+import structlog
+from fhir.resources.R4B.documentreference import DocumentReference
+from fhir.resources.R4B.resource import Resource
+
+from ahd2fhir.utils.bundle_builder import BundleBuilder
+from ahd2fhir.utils.resource_handler import ResourceHandler
+from benchmarks.mappers import FIXED_DATETIME, load_document_reference
+from benchmarks.payloads import scale_annotations
+
+PAYLOAD_PATH = "tests/resources/ahd/payload_1.json"
+
+
+class Workload(NamedTuple):
+    document_reference: DocumentReference
+    resources: List[Resource]
+    resource_dicts: List[dict]
+    handler: ResourceHandler
+
+
+class BundleCase(NamedTuple):
+    name: str
+    run: Callable[[Workload], object]
+
+
+def build_composition(workload: Workload):
+    return workload.handler._build_composition(
+        workload.document_reference, workload.resources
+    )
+
+
+CASES = [
+    BundleCase("ResourceHandler._build_composition", build_composition),
+    BundleCase(
+        "BundleBuilder.build_from_resources",
+        lambda workload: BundleBuilder().build_from_resources(
+            workload.resources, "bundle"
+        ),
+    ),
+    BundleCase(
+        "BundleBuilder.iter_entries",
+        # consumes the entries one by one without keeping them
+        lambda workload: collections.deque(
+            BundleBuilder().iter_entries(workload.resources), maxlen=0
+        ),
+    ),
+    BundleCase(
+        "BundleBuilder.build_dict_from_resources",
+        lambda workload: BundleBuilder().build_dict_from_resources(
+            workload.resource_dicts, "bundle"
+        ),
+    ),
+]
+
+
+def map_resources(document_reference: DocumentReference, count: int) -> Workload:
+    """
+    Maps copies of the payload until there are at least count resources
+    """
+    with open(PAYLOAD_PATH) as file:
+        annotations = json.load(file)
+
+    handler = ResourceHandler(None, fixed_composition_datetime=FIXED_DATETIME)
+    resources_per_copy = len(handler._map_annotations(annotations, document_reference))
+    copies = math.ceil(count / resources_per_copy)
+    scaled_annotations = scale_annotations(annotations, copies)
+    resources = handler._map_annotations(scaled_annotations, document_reference)
+    resource_dicts = handler._map_annotations_as_dicts(
+        scaled_annotations, document_reference
+    )
+    return Workload(
+        document_reference, resources[:count], resource_dicts[:count], handler
+    )
+
+
+def measure(case: BundleCase, workload: Workload, repeat: int) -> Dict[str, float]:
+    # warm up caches and lazily created validators
+    case.run(workload)
+
+    best_seconds = float("inf")
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            case.run(workload)
+            best_seconds = min(best_seconds, time.perf_counter() - started)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    return {
+        "resources": len(workload.resources),
+        "seconds": best_seconds,
+        "microseconds_per_resource": best_seconds / len(workload.resources) * 1e6,
+    }
+
+
+def main(argv: List[str] | None = None):
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR)
+    )
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--resources", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--case", help="Only run cases whose name contains this")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    document_reference = load_document_reference()
+
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for count in args.resources:
+        workload = map_resources(document_reference, count)
+        for case in CASES:
+            if args.case is not None and args.case not in case.name:
+                continue
+            result = measure(case, workload, args.repeat)
+            results.setdefault(case.name, {})[str(count)] = result
+            print(
+                f"{case.name:>45} {count:>6} resources: "
+                + f"{result['seconds'] * 1000:9.2f} ms "
+                + f"{result['microseconds_per_resource']:8.2f} us/resource"
+            )
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
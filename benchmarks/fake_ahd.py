@@ -0,0 +1,331 @@
+"""
+A stand-in for Averbis Health Discovery implementing the REST endpoints used by
+averbis.Client to look up projects and pipelines and to analyse texts. Returns
+canned annotations, optionally scaled with the length of the analysed text,
+after a configurable latency and injects errors, 401 blips and slowdowns.
+
+    FAKE_AHD_LATENCY_MS=200 FAKE_AHD_ERROR_RATE=0.01 python -m benchmarks.fake_ahd
+
+Point ahd2fhir at it with AHD_URL=http://localhost:9999/health-discovery.
+All settings are read from FAKE_AHD_* environment variables, see FakeAhdSettings.
+"""
+
+import argparse
+import asyncio
+import fnmatch
+import json
+import math
+import random
+import time
+from collections import Counter
+from functools import lru_cache
+from typing import List
+
+import uvicorn
+from fastapi import APIRouter, FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+from pydantic_settings import BaseSettings
+
+from benchmarks.payloads import scale_annotations
+
+
+class FakeAhdSettings(BaseSettings):
+    # path all endpoints are served under, i.e. the path of AHD_URL
+    path_prefix: str = "/health-discovery"
+    # if set, requests without this api-token header are rejected with a 401
+    api_token: str = ""
+    # AHD response whose annotations are returned for every analysed text
+    payload_path: str = "tests/resources/ahd/payload_1.json"
+    # if set, the annotations are repeated once for every started block of this
+    # many characters of the analysed text. Otherwise, they are returned as-is.
+    characters_per_payload: int = 0
+    # "constant", "uniform" between latency_ms +/- latency_jitter_ms, or
+    # "lognormal" with a median of latency_ms and a long tail growing with
+    # latency_jitter_ms
+    latency_distribution: str = "constant"
+    latency_ms: float = 0.0
+    latency_jitter_ms: float = 0.0
+    # added to the latency for every 1000 characters of the analysed text
+    latency_ms_per_1000_characters: float = 0.0
+    # share of analyses failing with a 500 after their latency passed
+    error_rate: float = 0.0
+    # every unauthorized_every_seconds, all requests are rejected with a 401
+    # for unauthorized_duration_seconds, e.g. like during a token rotation
+    unauthorized_every_seconds: float = 0.0
+    unauthorized_duration_seconds: float = 0.0
+    # every slowdown_every_seconds, the latency is multiplied by
+    # slowdown_factor for slowdown_duration_seconds
+    slowdown_every_seconds: float = 0.0
+    slowdown_duration_seconds: float = 0.0
+    slowdown_factor: float = 10.0
+    # number of analyses processed at the same time, the others queue up like
+    # on a saturated AHD instance. 0 doesn't limit them.
+    max_concurrent_analyses: int = 0
+    # seed of the random number generator used for latencies and errors
+    seed: int | None = None
+
+    class Config:
+        env_prefix = "fake_ahd_"
+
+
+BUILD_INFO = {
+    "specVersion": "6.0.0",
+    "platformVersion": "8.20.0",
+    "buildNumber": "fake",
+}
+
+
+def is_in_window(elapsed_seconds: float, every: float, duration: float) -> bool:
+    """
+    Whether the periodic window opening every `every` seconds for `duration`
+    seconds is open after `elapsed_seconds`
+    """
+    if every <= 0 or duration <= 0:
+        return False
+    return elapsed_seconds % every >= every - duration
+
+
+def matches_annotation_types(annotation_type: str, patterns: List[str]) -> bool:
+    return any(fnmatch.fnmatchcase(annotation_type, pattern) for pattern in patterns)
+
+
+def ahd_response(payload, status_code: int = 200, error_messages=None) -> Response:
+    return JSONResponse(
+        status_code=status_code,
+        content={"payload": payload, "errorMessages": error_messages or []},
+    )
+
+
+class FakeAhd:
+    def __init__(self, settings: FakeAhdSettings, clock=time.monotonic):
+        self.settings = settings
+        self.clock = clock
+        self.started_at = clock()
+        self.random = random.Random(settings.seed)
+        self.stats: Counter = Counter()
+        self.in_flight = 0
+        self.projects: dict[str, dict] = {}
+        self.pipeline_states: dict[tuple[str, str], str] = {}
+        self.analysis_slots = (
+            asyncio.Semaphore(settings.max_concurrent_analyses)
+            if settings.max_concurrent_analyses > 0
+            else None
+        )
+
+        with open(settings.payload_path) as file:
+            annotations = json.load(file)
+        if isinstance(annotations, dict):
+            annotations = annotations["payload"]
+        self.annotations = annotations
+
+        # the same responses are built over and over again, so keep them
+        self.build_analysis_response = lru_cache(maxsize=256)(
+            self._build_analysis_response
+        )
+
+    def elapsed_seconds(self) -> float:
+        return self.clock() - self.started_at
+
+    def check_authorization(self, request: Request) -> Response | None:
+        settings = self.settings
+        unauthorized = is_in_window(
+            self.elapsed_seconds(),
+            settings.unauthorized_every_seconds,
+            settings.unauthorized_duration_seconds,
+        )
+        if settings.api_token != "":
+            unauthorized = (
+                unauthorized or request.headers.get("api-token") != settings.api_token
+            )
+
+        if unauthorized:
+            self.stats["unauthorized"] += 1
+            return ahd_response(None, 401, ["Unauthorized"])
+        return None
+
+    def sample_latency_seconds(self, text_length: int) -> float:
+        settings = self.settings
+        if settings.latency_distribution == "constant":
+            latency_ms = settings.latency_ms
+        elif settings.latency_distribution == "uniform":
+            latency_ms = self.random.uniform(
+                settings.latency_ms - settings.latency_jitter_ms,
+                settings.latency_ms + settings.latency_jitter_ms,
+            )
+        elif settings.latency_distribution == "lognormal":
+            latency_ms = settings.latency_ms * math.exp(
+                self.random.gauss(0, settings.latency_jitter_ms / settings.latency_ms)
+                if settings.latency_ms > 0
+                else 0
+            )
+        else:
+            raise ValueError(
+                f"Unknown latency distribution: {settings.latency_distribution}"
+            )
+
+        latency_ms = latency_ms + (
+            settings.latency_ms_per_1000_characters * text_length / 1000
+        )
+
+        if is_in_window(
+            self.elapsed_seconds(),
+            settings.slowdown_every_seconds,
+            settings.slowdown_duration_seconds,
+        ):
+            self.stats["slowed_down"] += 1
+            latency_ms = latency_ms * settings.slowdown_factor
+
+        return max(latency_ms, 0) / 1000
+
+    def _build_analysis_response(
+        self, copies: int, annotation_types: str | None
+    ) -> bytes:
+        annotations = scale_annotations(self.annotations, copies)
+        if annotation_types:
+            patterns = annotation_types.split(",")
+            annotations = [
+                annotation
+                for annotation in annotations
+                if matches_annotation_types(annotation["type"], patterns)
+            ]
+        return json.dumps({"payload": annotations, "errorMessages": []}).encode("utf8")
+
+    async def analyse(self, request: Request) -> Response:
+        if (response := self.check_authorization(request)) is not None:
+            return response
+
+        text = (await request.body()).decode("utf8")
+        copies = 1
+        if self.settings.characters_per_payload > 0:
+            copies = max(1, math.ceil(len(text) / self.settings.characters_per_payload))
+
+        self.stats["analyses"] += 1
+        slot = self.analysis_slots or _NO_LIMIT
+        async with slot:
+            self.in_flight += 1
+            self.stats["max_in_flight"] = max(
+                self.stats["max_in_flight"], self.in_flight
+            )
+            try:
+                await asyncio.sleep(self.sample_latency_seconds(len(text)))
+            finally:
+                self.in_flight -= 1
+
+        if self.random.random() < self.settings.error_rate:
+            self.stats["errors"] += 1
+            return ahd_response(None, 500, ["Injected analysis failure"])
+
+        return Response(
+            content=self.build_analysis_response(
+                copies, request.query_params.get("annotationTypes")
+            ),
+            media_type="application/json",
+        )
+
+
+class _NoLimit:
+    async def __aenter__(self):
+        return None
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+
+_NO_LIMIT = _NoLimit()
+
+
+def create_app(settings: FakeAhdSettings | None = None) -> FastAPI:
+    fake = FakeAhd(settings or FakeAhdSettings())
+    router = APIRouter(prefix=f"{fake.settings.path_prefix.rstrip('/')}/rest/v1")
+
+    @router.get("/buildInfo")
+    async def build_info():
+        return ahd_response(BUILD_INFO)
+
+    @router.post("/users/{user}/apitoken")
+    async def generate_api_token(user: str):
+        return ahd_response(fake.settings.api_token or "fake-api-token")
+
+    @router.get("/projects")
+    async def list_projects(request: Request):
+        if (response := fake.check_authorization(request)) is not None:
+            return response
+        return ahd_response(list(fake.projects.values()))
+
+    @router.post("/projects")
+    async def create_project(request: Request, name: str, description: str = ""):
+        if (response := fake.check_authorization(request)) is not None:
+            return response
+        fake.projects[name] = {"name": name, "description": description}
+        return ahd_response(fake.projects[name])
+
+    pipeline_path = "/textanalysis/projects/{project}/pipelines/{pipeline}"
+
+    def pipeline_info(project: str, pipeline: str) -> dict:
+        return {
+            "id": 1,
+            "name": pipeline,
+            "description": "",
+            "pipelineState": fake.pipeline_states.get((project, pipeline), "STARTED"),
+            "preconfigured": True,
+            "scaleOuted": False,
+        }
+
+    @router.get(pipeline_path)
+    async def get_pipeline(request: Request, project: str, pipeline: str):
+        if (response := fake.check_authorization(request)) is not None:
+            return response
+        return ahd_response(pipeline_info(project, pipeline))
+
+    @router.put(pipeline_path + "/start")
+    async def start_pipeline(request: Request, project: str, pipeline: str):
+        if (response := fake.check_authorization(request)) is not None:
+            return response
+        fake.pipeline_states[(project, pipeline)] = "STARTED"
+        return ahd_response(None)
+
+    @router.put(pipeline_path + "/stop")
+    async def stop_pipeline(request: Request, project: str, pipeline: str):
+        if (response := fake.check_authorization(request)) is not None:
+            return response
+        fake.pipeline_states[(project, pipeline)] = "STOPPED"
+        return ahd_response(None)
+
+    @router.get(pipeline_path + "/configuration")
+    async def get_pipeline_configuration(request: Request, project: str, pipeline: str):
+        if (response := fake.check_authorization(request)) is not None:
+            return response
+        return ahd_response({"name": pipeline, "analysisEnginePoolSize": 1})
+
+    @router.post(pipeline_path + "/analyseText")
+    async def analyse_text(request: Request, project: str, pipeline: str):
+        return await fake.analyse(request)
+
+    @router.post(pipeline_path + "/analyseHtml")
+    async def analyse_html(request: Request, project: str, pipeline: str):
+        return await fake.analyse(request)
+
+    app = FastAPI(title="Fake Averbis Health Discovery")
+    app.include_router(router)
+    app.state.fake_ahd = fake
+
+    @app.get("/stats")
+    async def stats():
+        return dict(fake.stats, in_flight=fake.in_flight)
+
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    args = parser.parse_args()
+
+    uvicorn.run(create_app(), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+In-memory stand-ins for the aiokafka consumer and producer used to benchmark
+the Kafka processing path without a broker.
+"""
+
+import asyncio
+import time
+from collections import defaultdict
+from typing import Iterable, List, Tuple
+
+from aiokafka.errors import ConsumerStoppedError
+from aiokafka.structs import ConsumerRecord, TopicPartition
+
+
+def make_record(
+    topic: str, partition: int, offset: int, value: bytes, key: bytes | None = None
+) -> ConsumerRecord:
+    return ConsumerRecord(
+        topic=topic,
+        partition=partition,
+        offset=offset,
+        timestamp=0,
+        timestamp_type=0,
+        key=key,
+        value=value,
+        checksum=None,
+        serialized_key_size=len(key) if key is not None else -1,
+        serialized_value_size=len(value),
+        headers=[],
+    )
+
+
+class FakeKafkaConsumer:
+    """
+    Returns the given records once, then raises as if the consumer had been
+    stopped. If `records_per_second` is set, the records arrive at
+    that rate instead of all being available right away. The time each record
+    arrived at is kept in `arrived_at`, keyed by its partition and offset.
+    """
+
+    def __init__(
+        self,
+        records: Iterable[ConsumerRecord],
+        records_per_second: float | None = None,
+    ):
+        self.records = list(records)
+        self.records_per_second = records_per_second
+        self.arrived_at: dict[Tuple[int, int], float] = {}
+        self.committed: dict[TopicPartition, int] = {}
+        self._highwater: dict[TopicPartition, int] = defaultdict(int)
+        for record in self.records:
+            partition = TopicPartition(record.topic, record.partition)
+            self._highwater[partition] = max(
+                self._highwater[partition], record.offset + 1
+            )
+        self.stopped = False
+        self._iterator = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> ConsumerRecord:
+        try:
+            return await self.getone()
+        except ConsumerStoppedError:
+            raise StopAsyncIteration
+
+    async def getone(self) -> ConsumerRecord:
+        if self._iterator is None:
+            self._iterator = enumerate(self.records)
+            self._started_at = time.perf_counter()
+
+        # yield to the event loop like a real fetch would
+        await asyncio.sleep(0)
+        if self.stopped:
+            raise ConsumerStoppedError()
+        try:
+            index, record = next(self._iterator)
+        except StopIteration:
+            raise ConsumerStoppedError()
+
+        arrival = self._started_at
+        if self.records_per_second is not None:
+            arrival = self._started_at + index / self.records_per_second
+            await asyncio.sleep(max(arrival - time.perf_counter(), 0))
+        self.arrived_at[(record.partition, record.offset)] = arrival
+        return record
+
+    async def commit(self, offsets: dict[TopicPartition, int]):
+        self.committed.update(offsets)
+
+    def highwater(self, partition: TopicPartition) -> int | None:
+        return self._highwater.get(partition)
+
+    async def stop(self):
+        self.stopped = True
+
+
+class FakeKafkaProducer:
+    """
+    Mimics the batching of aiokafka.AIOKafkaProducer against a single broker:
+    queued records are collected into a batch which is sent once `linger_ms`
+    passed or `max_batch_size` is reached. Only one request is in flight at a
+    time and each one takes `request_latency_seconds`.
+    """
+
+    def __init__(
+        self,
+        request_latency_seconds: float = 0.005,
+        linger_ms: int = 0,
+        max_batch_size: int = 16384,
+    ):
+        self.request_latency_seconds = request_latency_seconds
+        self.linger_seconds = linger_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.delivered: List[Tuple[str, bytes, bytes | None]] = []
+        self.requests_sent = 0
+        self._batch: list = []
+        self._batch_size = 0
+        self._batch_ready = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._sender: asyncio.Task | None = None
+
+    async def start(self):
+        self._sender = asyncio.create_task(self._send_batches())
+
+    async def stop(self):
+        await self.flush()
+        if self._sender is not None:
+            self._sender.cancel()
+
+    async def send(self, topic, value=None, key=None, partition=None, headers=None):
+        if self._sender is None:
+            await self.start()
+
+        delivery = asyncio.get_running_loop().create_future()
+        self._batch.append((topic, value, key, delivery))
+        self._batch_size = self._batch_size + len(value or b"")
+        self._idle.clear()
+        self._batch_ready.set()
+        if self._batch_size >= self.max_batch_size:
+            self._batch_full.set()
+        return delivery
+
+    async def send_and_wait(self, *args, **kwargs):
+        delivery = await self.send(*args, **kwargs)
+        return await delivery
+
+    async def flush(self):
+        self._batch_full.set()
+        await self._idle.wait()
+
+    async def _send_batches(self):
+        while True:
+            await self._batch_ready.wait()
+            if self.linger_seconds > 0:
+                try:
+                    await asyncio.wait_for(
+                        self._batch_full.wait(), timeout=self.linger_seconds
+                    )
+                except asyncio.TimeoutError:
+                    pass
+
+            batch = self._batch
+            self._batch = []
+            self._batch_size = 0
+            self._batch_ready.clear()
+            self._batch_full.clear()
+
+            await asyncio.sleep(self.request_latency_seconds)
+            self.requests_sent = self.requests_sent + 1
+
+            for topic, value, key, delivery in batch:
+                self.delivered.append((topic, value, key))
+                delivery.set_result(None)
+
+            if len(self._batch) == 0:
+                self._idle.set()
@@ -0,0 +1,153 @@
+"""
+Compares the Kafka processing throughput of sending every result with
+send_and_wait against the pipelined, batched output path of kafka_setup.
+
+    python -m benchmarks.kafka_throughput --messages 500 --request-latency-ms 5
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import logging
+import os
+import time
+
+import structlog
+from fhir.resources.R4B.bundle import Bundle
+from fhir.resources.R4B.documentreference import DocumentReference
+
+from benchmarks.fake_kafka import FakeKafkaConsumer, FakeKafkaProducer, make_record
+
+os.environ.setdefault("AHD_URL", "http://localhost:9999/health-discovery")
+os.environ.setdefault("AHD_API_TOKEN", "benchmark")
+os.environ.setdefault("AHD_PROJECT", "benchmark")
+os.environ.setdefault("AHD_PIPELINE", "benchmark")
+
+from ahd2fhir import config, kafka_setup  # noqa: E402
+from ahd2fhir.utils.resource_handler import ResourceHandler  # noqa: E402
+
+INPUT_TOPIC = "fhir.documents"
+
+
+class StubPipeline:
+    def __init__(self, annotations: list, latency_seconds: float):
+        self.annotations = annotations
+        self.latency_seconds = latency_seconds
+
+    def analyse_text(self, text: str, language: str, annotation_types: str):
+        time.sleep(self.latency_seconds)
+        return self.annotations
+
+    analyse_html = analyse_text
+
+
+class StubResourceHandlerPool:
+    def __init__(self, handler: ResourceHandler):
+        self.handler = handler
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield self.handler
+
+
+def build_records(count: int, partitions: int) -> list:
+    with open("tests/resources/fhir/documentreference.json") as file:
+        document = json.load(file)["entry"][0]["resource"]
+
+    records = []
+    for index in range(count):
+        document["id"] = f"benchmark-{index}"
+        document["content"][0]["attachment"]["data"] = base64.b64encode(
+            f"Document {index}".encode("utf8")
+        ).decode("ascii")
+        partition = index % partitions
+        records.append(
+            make_record(
+                INPUT_TOPIC,
+                partition,
+                index // partitions,
+                json.dumps(document).encode("utf8"),
+                key=document["id"].encode("utf8"),
+            )
+        )
+    return records
+
+
+async def consume_with_send_and_wait(
+    consumer: FakeKafkaConsumer,
+    producer: FakeKafkaProducer,
+    handler: ResourceHandler,
+    output_topic: str,
+):
+    """
+    The previous consumer loop: one message at a time, waiting for the broker
+    to acknowledge every result before reading the next record.
+    """
+    async for msg in consumer:
+        resource = DocumentReference.parse_raw(msg.value)
+        result: Bundle = await handler.ahandle_documents([resource])
+        await producer.send_and_wait(
+            output_topic, result.json().encode("utf8"), result.id.encode("utf8")
+        )
+
+
+async def run(mode: str, args) -> float:
+    with open("tests/resources/ahd/payload_2.json") as file:
+        annotations = json.load(file)
+
+    handler = ResourceHandler(
+        StubPipeline(annotations, latency_seconds=args.ahd_latency_ms / 1000)
+    )
+    consumer = FakeKafkaConsumer(build_records(args.messages, args.partitions))
+    producer = FakeKafkaProducer(
+        request_latency_seconds=args.request_latency_ms / 1000,
+        linger_ms=args.linger_ms if mode == "pipelined" else 0,
+        max_batch_size=args.max_batch_size,
+    )
+
+    started = time.perf_counter()
+    if mode == "send-and-wait":
+        await consume_with_send_and_wait(
+            consumer, producer, handler, config.Settings().kafka.output_topic
+        )
+    else:
+        os.environ["KAFKA_MAX_IN_FLIGHT_MESSAGES"] = str(args.max_in_flight)
+        kafka_setup.producer = producer
+        kafka_setup.resource_handler_pool = StubResourceHandlerPool(handler)
+        await kafka_setup.send_consumer_message(consumer)
+        await kafka_setup.commit_processed_offsets(consumer)
+    await producer.flush()
+    elapsed = time.perf_counter() - started
+
+    assert len(producer.delivered) == args.messages
+    print(
+        f"{mode:>14}: {args.messages / elapsed:8.1f} messages/s "
+        + f"({producer.requests_sent} produce requests)"
+    )
+    return args.messages / elapsed
+
+
+def main():
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR)
+    )
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--partitions", type=int, default=4)
+    parser.add_argument("--request-latency-ms", type=float, default=5.0)
+    parser.add_argument("--ahd-latency-ms", type=float, default=0.0)
+    parser.add_argument("--linger-ms", type=int, default=5)
+    parser.add_argument("--max-batch-size", type=int, default=16384)
+    parser.add_argument("--max-in-flight", type=int, default=8)
+    args = parser.parse_args()
+
+    before = asyncio.run(run("send-and-wait", args))
+    after = asyncio.run(run("pipelined", args))
+    print(f"speedup: {after / before:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,463 @@
+"""
+Drives ahd2fhir with documents at a configurable rate and reports the latency
+percentiles, documents/s, CPU time and resident memory of the service.
+
+The `http` mode starts ahd2fhir with uvicorn and posts every document to
+/fhir/$analyze-document. The `kafka` mode feeds the Kafka consumer loop of
+ahd2fhir in-process from an in-memory stand-in of the input topic. Both call
+a fake AHD server started from benchmarks.fake_ahd, configured by the usual
+FAKE_AHD_* environment variables. All other environment variables, e.g.
+AHD_CLIENT_* or KAFKA_*, are passed on to ahd2fhir to compare configurations.
+
+    python -m benchmarks.load http --documents 500 --rate 50
+    python -m benchmarks.load kafka --documents 500 --output report.json
+"""
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import logging
+import os
+import platform
+import socket
+import statistics
+import subprocess  # nosec B404
+import sys
+import time
+from typing import Callable, Dict, Iterator, List, NamedTuple, Tuple
+
+import httpx
+import structlog
+from prometheus_client import REGISTRY
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmarks.fake_kafka import FakeKafkaConsumer, FakeKafkaProducer, make_record
+
+DOCUMENT_REFERENCE_PATH = "tests/resources/fhir/documentreference.json"
+INPUT_TOPIC = "fhir.documents"
+# environment variables recorded in the report to tell configurations apart
+REPORTED_ENV_PREFIXES = ("AHD_", "KAFKA_", "FAKE_AHD_", "CUSTOM_MAPPERS_")
+
+
+class ResourceUsage(NamedTuple):
+    cpu_seconds: float
+    rss_bytes: float
+
+
+class LoadResult(NamedTuple):
+    # end-to-end latency of each successfully processed document in seconds
+    latencies: List[float]
+    failed: int
+    duration_seconds: float
+    cpu_seconds: float
+    max_rss_bytes: float
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_reachable(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{process.args} exited with {process.returncode}")
+        try:
+            httpx.get(url, timeout=1).raise_for_status()
+            return
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    raise TimeoutError(f"{url} wasn't reachable after {timeout} seconds")
+
+
+@contextlib.contextmanager
+def start_process(
+    args: List[str], ready_url: str, env: Dict[str, str], show_logs: bool = False
+):
+    output = None if show_logs else subprocess.DEVNULL
+    process = subprocess.Popen(  # nosec B603
+        args, env=env, stdout=output, stderr=output
+    )
+    try:
+        wait_until_reachable(ready_url, process)
+        yield process
+    finally:
+        process.terminate()
+        process.wait()
+
+
+@contextlib.contextmanager
+def start_fake_ahd() -> Iterator[str]:
+    """
+    Starts the fake AHD server and yields the AHD_URL to reach it with
+    """
+    port = get_free_port()
+    with start_process(
+        [sys.executable, "-m", "benchmarks.fake_ahd", "--port", str(port)],
+        f"http://127.0.0.1:{port}/stats",
+        dict(os.environ),
+    ):
+        yield f"http://127.0.0.1:{port}/health-discovery"
+
+
+def get_ahd2fhir_env(ahd_url: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env["AHD_URL"] = ahd_url
+    env.setdefault("AHD_API_TOKEN", "benchmark")
+    env.setdefault("AHD_PROJECT", "benchmark")
+    env.setdefault("AHD_PIPELINE", "benchmark")
+    return env
+
+
+def build_documents(count: int, characters: int) -> List[dict]:
+    with open(DOCUMENT_REFERENCE_PATH) as file:
+        template = json.load(file)["entry"][0]["resource"]
+
+    documents = []
+    for index in range(count):
+        document = json.loads(json.dumps(template))
+        document["id"] = f"load-{index}"
+        text = f"Document {index}. "
+        text = text + "x" * max(characters - len(text), 0)
+        document["content"][0]["attachment"]["data"] = base64.b64encode(
+            text.encode("utf8")
+        ).decode("ascii")
+        documents.append(document)
+    return documents
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float | None:
+    if len(sorted_values) == 0:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+class ResourceSampler:
+    """
+    Periodically samples the CPU time and resident memory reported by the
+    Prometheus process collector, as the peak RSS is easily missed otherwise
+    """
+
+    def __init__(self, read_usage: Callable[[], ResourceUsage], interval: float):
+        self.read_usage = read_usage
+        self.interval = interval
+        self.max_rss_bytes = 0.0
+        self._task: asyncio.Task | None = None
+
+    async def __aenter__(self) -> "ResourceSampler":
+        self.started = await self.sample()
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+        self.stopped = await self.sample()
+
+    async def sample(self) -> ResourceUsage:
+        usage = await asyncio.to_thread(self.read_usage)
+        self.max_rss_bytes = max(self.max_rss_bytes, usage.rss_bytes)
+        return usage
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.sample()
+
+    @property
+    def cpu_seconds(self) -> float:
+        return self.stopped.cpu_seconds - self.started.cpu_seconds
+
+
+def parse_resource_usage(metrics: str) -> ResourceUsage:
+    values = {}
+    for family in text_string_to_metric_families(metrics):
+        for sample in family.samples:
+            values[sample.name] = sample.value
+    return ResourceUsage(
+        values.get("process_cpu_seconds_total", 0.0),
+        values.get("process_resident_memory_bytes", 0.0),
+    )
+
+
+def read_own_resource_usage() -> ResourceUsage:
+    return ResourceUsage(
+        REGISTRY.get_sample_value("process_cpu_seconds_total") or 0.0,
+        REGISTRY.get_sample_value("process_resident_memory_bytes") or 0.0,
+    )
+
+
+async def send_at_rate(
+    count: int,
+    rate: float,
+    concurrency: int,
+    send: Callable[[int], "asyncio.Future[Tuple[bool, float]]"],
+) -> Tuple[List[float], int]:
+    """
+    Calls send for each document index. With a rate, the documents are sent
+    at that rate regardless of how long the previous ones took, so latencies
+    include the time spent queueing. Otherwise, `concurrency` documents are
+    kept in flight.
+    """
+    latencies: List[float] = []
+    failed = 0
+    slots = asyncio.Semaphore(concurrency)
+    started = time.perf_counter()
+
+    async def send_one(index: int, scheduled_at: float):
+        nonlocal failed
+        try:
+            succeeded, finished_at = await send(index)
+        finally:
+            slots.release()
+        if succeeded:
+            latencies.append(finished_at - scheduled_at)
+        else:
+            failed = failed + 1
+
+    tasks = []
+    for index in range(count):
+        scheduled_at = time.perf_counter()
+        if rate > 0:
+            scheduled_at = started + index / rate
+            await asyncio.sleep(max(scheduled_at - time.perf_counter(), 0))
+        await slots.acquire()
+        tasks.append(asyncio.create_task(send_one(index, scheduled_at)))
+
+    await asyncio.gather(*tasks)
+    return latencies, failed
+
+
+async def run_http(args, documents: List[dict], ahd_url: str) -> LoadResult:
+    port = get_free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    bodies = [json.dumps(document).encode("utf8") for document in documents]
+    # open-loop load needs a connection for every document that may be in flight
+    concurrency = args.concurrency if args.rate <= 0 else len(documents)
+
+    with start_process(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "ahd2fhir.main:app",
+            "--port",
+            str(port),
+            "--log-level",
+            "warning",
+        ],
+        f"{base_url}/ready",
+        get_ahd2fhir_env(ahd_url),
+        show_logs=args.show_logs,
+    ):
+        async with httpx.AsyncClient(
+            base_url=base_url,
+            timeout=None,
+            limits=httpx.Limits(max_connections=concurrency),
+        ) as client:
+
+            def read_usage() -> ResourceUsage:
+                return parse_resource_usage(httpx.get(f"{base_url}/metrics").text)
+
+            async def send(index: int) -> Tuple[bool, float]:
+                try:
+                    response = await client.post(
+                        "/fhir/$analyze-document",
+                        content=bodies[index],
+                        headers={"Content-Type": "application/fhir+json"},
+                    )
+                    succeeded = response.status_code == 200
+                except httpx.HTTPError:
+                    succeeded = False
+                return succeeded, time.perf_counter()
+
+            async with ResourceSampler(read_usage, args.sample_interval) as sampler:
+                started = time.perf_counter()
+                latencies, failed = await send_at_rate(
+                    len(documents), args.rate, concurrency, send
+                )
+                duration = time.perf_counter() - started
+
+    return LoadResult(
+        latencies, failed, duration, sampler.cpu_seconds, sampler.max_rss_bytes
+    )
+
+
+async def run_kafka(args, documents: List[dict], ahd_url: str) -> LoadResult:
+    os.environ.update(get_ahd2fhir_env(ahd_url))
+
+    # imported late so the settings are read from the updated environment
+    from ahd2fhir import config, kafka_setup
+    from ahd2fhir.utils.ahd_client import ResourceHandlerPool
+
+    settings = config.Settings()
+    records = [
+        make_record(
+            INPUT_TOPIC,
+            index % args.partitions,
+            index // args.partitions,
+            json.dumps(document).encode("utf8"),
+            key=document["id"].encode("utf8"),
+        )
+        for index, document in enumerate(documents)
+    ]
+    consumer = FakeKafkaConsumer(
+        records, records_per_second=args.rate if args.rate > 0 else None
+    )
+    producer = FakeKafkaProducer(
+        request_latency_seconds=args.produce_latency_ms / 1000,
+        linger_ms=settings.kafka.producer.linger_ms,
+    )
+
+    # the latency of a message lasts from its arrival on the input topic
+    # until its result was delivered to the output topic
+    latencies: List[float] = []
+    process_message = kafka_setup.process_message
+
+    async def timed_process_message(msg, *process_args, **process_kwargs):
+        delivery = await process_message(msg, *process_args, **process_kwargs)
+        arrived_at = consumer.arrived_at[(msg.partition, msg.offset)]
+        if delivery is not None:
+            delivery.add_done_callback(
+                lambda _: latencies.append(time.perf_counter() - arrived_at)
+            )
+        return delivery
+
+    pool = ResourceHandlerPool(settings)
+    kafka_setup.resource_handler_pool = pool
+    kafka_setup.producer = producer
+    kafka_setup.process_message = timed_process_message
+    try:
+        async with ResourceSampler(
+            read_own_resource_usage, args.sample_interval
+        ) as sampler:
+            started = time.perf_counter()
+            await kafka_setup.send_consumer_message(consumer)
+            await producer.flush()
+            duration = time.perf_counter() - started
+    finally:
+        kafka_setup.process_message = process_message
+        pool.close()
+
+    # results sent to the error topic count as failed as well
+    return LoadResult(
+        latencies,
+        len(documents) - len(latencies),
+        duration,
+        sampler.cpu_seconds,
+        sampler.max_rss_bytes,
+    )
+
+
+def build_report(args, result: LoadResult) -> dict:
+    latencies = sorted(result.latencies)
+    succeeded = len(latencies)
+    return {
+        "mode": args.mode,
+        "documents": args.documents,
+        "succeeded": succeeded,
+        "failed": result.failed,
+        "duration_seconds": result.duration_seconds,
+        "documents_per_second": succeeded / result.duration_seconds,
+        "latency_seconds": {
+            "p50": percentile(latencies, 0.50),
+            "p95": percentile(latencies, 0.95),
+            "p99": percentile(latencies, 0.99),
+            "max": latencies[-1] if succeeded > 0 else None,
+            "mean": statistics.fmean(latencies) if succeeded > 0 else None,
+        },
+        "cpu_seconds": result.cpu_seconds,
+        "cpu_utilization": result.cpu_seconds / result.duration_seconds,
+        "max_rss_bytes": result.max_rss_bytes,
+        "arguments": {k: v for k, v in vars(args).items() if k != "output"},
+        "environment": {
+            k: v
+            for k, v in sorted(os.environ.items())
+            if k.startswith(REPORTED_ENV_PREFIXES) and "TOKEN" not in k
+        },
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def print_report(report: dict):
+    latency = report["latency_seconds"]
+
+    def ms(value: float | None) -> str:
+        return "n/a" if value is None else f"{value * 1000:.1f} ms"
+
+    print(
+        f"{report['mode']}: {report['succeeded']} succeeded, "
+        + f"{report['failed']} failed in {report['duration_seconds']:.1f} s "
+        + f"({report['documents_per_second']:.1f} documents/s)"
+    )
+    print(
+        f"latency: p50 {ms(latency['p50'])}, p95 {ms(latency['p95'])}, "
+        + f"p99 {ms(latency['p99'])}, max {ms(latency['max'])}"
+    )
+    print(
+        f"cpu: {report['cpu_seconds']:.1f} s ({report['cpu_utilization']:.0%}), "
+        + f"max rss: {report['max_rss_bytes'] / 2**20:.0f} MiB"
+    )
+
+
+def main(argv: List[str] | None = None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("mode", choices=["http", "kafka"])
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Documents sent per second. 0 keeps --concurrency documents in flight.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=8,
+        help="Documents in flight at the same time if no --rate is set (http only)",
+    )
+    parser.add_argument(
+        "--document-characters",
+        type=int,
+        default=1000,
+        help="Length of each document's text",
+    )
+    parser.add_argument("--partitions", type=int, default=4, help="(kafka only)")
+    parser.add_argument(
+        "--produce-latency-ms",
+        type=float,
+        default=5.0,
+        help="Time the fake broker takes per produce request (kafka only)",
+    )
+    parser.add_argument("--sample-interval", type=float, default=0.5)
+    parser.add_argument(
+        "--show-logs", action="store_true", help="Show the logs of ahd2fhir (http only)"
+    )
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args(argv)
+
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR)
+    )
+
+    documents = build_documents(args.documents, args.document_characters)
+    with start_fake_ahd() as ahd_url:
+        run = run_http if args.mode == "http" else run_kafka
+        result = asyncio.run(run(args, documents, ahd_url))
+
+    report = build_report(args, result)
+    print_report(report)
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
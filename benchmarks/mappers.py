@@ -0,0 +1,531 @@
+"""
+Measures the median annotations/s and the memory retained per annotation of
+each mapper and of the end-to-end mapping steps, using the AHD payloads from
+tests/resources/ahd and synthetically scaled copies of them. Compares the
+results against stored baselines and exits with a non-zero status if any of
+them regressed by more than the configured thresholds.
+
+    python -m benchmarks.mappers --scale 1 10
+    python -m benchmarks.mappers --save-baseline
+"""
+
+import argparse
+import gc
+import glob
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, NamedTuple
+
+import structlog
+from fhir.resources.R4B.documentreference import DocumentReference
+
+os.environ.setdefault("AHD_URL", "http://localhost:9999/health-discovery")
+os.environ.setdefault("AHD_API_TOKEN", "benchmark")
+os.environ.setdefault("AHD_PROJECT", "benchmark")
+os.environ.setdefault("AHD_PIPELINE", "benchmark")
+# include the custom mappers in the end-to-end measurements
+os.environ.setdefault("CUSTOM_MAPPERS_ENABLED", "true")
+
+from ahd2fhir.mappers import ahd_to_condition  # noqa: E402
+from ahd2fhir.mappers import ahd_to_list  # noqa: E402
+from ahd2fhir.mappers import ahd_to_medication_statement  # noqa: E402
+from ahd2fhir.mappers import ahd_to_observation_kidney_stone as ks  # noqa: E402
+from ahd2fhir.mappers import ahd_to_observation_smkstat as smk  # noqa: E402
+from ahd2fhir.utils.bundle_builder import BundleBuilder  # noqa: E402
+from ahd2fhir.utils.const import (  # noqa: E402
+    AHD_TYPE_DIAGNOSIS,
+    AHD_TYPE_DOCUMENT_ANNOTATION,
+    AHD_TYPE_MEDICATION,
+)
+from ahd2fhir.utils.device_builder import build_device  # noqa: E402
+from ahd2fhir.utils.fhir_response import (  # noqa: E402
+    serialize_dict,
+    serialize_resource,
+)
+from ahd2fhir.utils.resource_handler import ResourceHandler  # noqa: E402
+from benchmarks.payloads import scale_annotations  # noqa: E402
+
+PAYLOAD_GLOB = "tests/resources/ahd/payload_*.json"
+DOCUMENT_REFERENCE_PATH = "tests/resources/fhir/documentreference.json"
+DEFAULT_BASELINE_PATH = os.path.join(
+    os.path.dirname(__file__), "baselines", "mappers.json"
+)
+FIXED_DATETIME = datetime(2022, 1, 1, tzinfo=timezone.utc)
+# how many median absolute deviations of the samples a result may be slower
+# than its baseline on top of the throughput threshold
+NOISE_FACTOR = 3
+# retained bytes per annotation a result may exceed its baseline by on top of
+# the allocation threshold, for cases retaining next to nothing
+ALLOCATION_SLACK_BYTES = 64
+
+
+class StubPipeline:
+    def __init__(self, annotations: list):
+        self.annotations = annotations
+
+    def analyse_text(self, text: str, language: str, annotation_types: str):
+        return self.annotations
+
+    analyse_html = analyse_text
+
+
+class Workload(NamedTuple):
+    """
+    Everything a benchmark case needs, prepared outside of the measurements
+    """
+
+    annotations: List[dict]
+    document_reference: DocumentReference
+    handler: ResourceHandler
+
+
+class BenchmarkCase(NamedTuple):
+    name: str
+    # the AHD type of the annotations the case is run on, None for all of them
+    annotation_type: str | None
+    # prepares the state passed to run, e.g. already mapped resources
+    setup: Callable[[Workload, List[dict]], object]
+    run: Callable[[Workload, object], object]
+
+
+def map_each(mapper: Callable) -> Callable[[Workload, object], object]:
+    def run(workload: Workload, annotations: List[dict]):
+        return [
+            mapper(annotation, workload.document_reference)
+            for annotation in annotations
+        ]
+
+    return run
+
+
+def select_annotations(workload: Workload, annotations: List[dict]) -> List[dict]:
+    return annotations
+
+
+def map_medication_statements(workload: Workload, annotations: List[dict]):
+    return [
+        (
+            annotation,
+            ahd_to_medication_statement.get_medication_statement_from_annotation(
+                annotation, workload.document_reference
+            ),
+        )
+        for annotation in annotations
+    ]
+
+
+def map_resources(workload: Workload, annotations: List[dict]):
+    return workload.handler._map_annotations(annotations, workload.document_reference)
+
+
+def map_resources_and_composition(workload: Workload, annotations: List[dict]):
+    resources = map_resources(workload, annotations)
+    composition = workload.handler._build_composition(
+        workload.document_reference, resources
+    )
+    return resources + [composition]
+
+
+CASES = [
+    BenchmarkCase(
+        "get_fhir_condition",
+        AHD_TYPE_DIAGNOSIS,
+        select_annotations,
+        map_each(ahd_to_condition.get_fhir_condition),
+    ),
+    BenchmarkCase(
+        "get_fhir_medication_statement",
+        AHD_TYPE_MEDICATION,
+        select_annotations,
+        map_each(ahd_to_medication_statement.get_fhir_medication_statement),
+    ),
+    BenchmarkCase(
+        "build_medication_lists",
+        AHD_TYPE_MEDICATION,
+        map_medication_statements,
+        lambda workload, medication_statements: ahd_to_list.build_medication_lists(
+            medication_statements, workload.document_reference
+        ),
+    ),
+    BenchmarkCase(
+        "build_device",
+        AHD_TYPE_DOCUMENT_ANNOTATION,
+        select_annotations,
+        lambda workload, annotations: [build_device(a) for a in annotations],
+    ),
+    BenchmarkCase(
+        "smkstat.get_fhir_resources",
+        smk.AHD_TYPE,
+        select_annotations,
+        map_each(smk.get_fhir_resources),
+    ),
+    BenchmarkCase(
+        "kidney_stone.get_fhir_resources",
+        ks.AHD_TYPE,
+        select_annotations,
+        map_each(ks.get_fhir_resources),
+    ),
+    BenchmarkCase(
+        "ResourceHandler._process_documentreference",
+        None,
+        lambda workload, annotations: None,
+        lambda workload, state: workload.handler._process_documentreference(
+            workload.document_reference
+        ),
+    ),
+    BenchmarkCase(
+        "ResourceHandler._build_composition",
+        None,
+        map_resources,
+        lambda workload, resources: workload.handler._build_composition(
+            workload.document_reference, resources
+        ),
+    ),
+    BenchmarkCase(
+        "BundleBuilder.build_from_resources",
+        None,
+        map_resources_and_composition,
+        lambda workload, resources: BundleBuilder().build_from_resources(
+            resources, resources[-1].id
+        ),
+    ),
+    BenchmarkCase(
+        "ResourceHandler.map_documents+serialize_resource",
+        None,
+        select_annotations,
+        lambda workload, annotations: serialize_resource(
+            workload.handler.map_documents([(workload.document_reference, annotations)])
+        ),
+    ),
+    BenchmarkCase(
+        "ResourceHandler.map_documents_as_dict+serialize_dict",
+        None,
+        select_annotations,
+        lambda workload, annotations: serialize_dict(
+            workload.handler.map_documents_as_dict(
+                [(workload.document_reference, annotations)]
+            )
+        ),
+    ),
+]
+
+
+def load_document_reference() -> DocumentReference:
+    with open(DOCUMENT_REFERENCE_PATH) as file:
+        return DocumentReference.parse_obj(json.load(file)["entry"][0]["resource"])
+
+
+def load_payloads(scale_factors: List[int]) -> Dict[str, List[dict]]:
+    payloads = {}
+    for path in sorted(glob.glob(PAYLOAD_GLOB)):
+        with open(path) as file:
+            annotations = json.load(file)
+        name = os.path.splitext(os.path.basename(path))[0]
+        for factor in scale_factors:
+            payloads[f"{name}-x{factor}"] = scale_annotations(annotations, factor)
+    return payloads
+
+
+def calibrate():
+    """
+    A fixed amount of plain Python work, timed alongside the cases so their
+    throughput is compared relative to how fast the machine currently is,
+    which easily varies by more than the threshold on shared machines
+    """
+    items = [{"index": i, "text": str(i) * 4} for i in range(2000)]
+    return json.loads(json.dumps(items))
+
+
+class Measurement(NamedTuple):
+    name: str
+    payload_name: str
+    annotations: int
+    run: Callable[[], object]
+    runs_per_sample: int
+    # the seconds per run of each sample
+    samples: List[float]
+    # the seconds per calibration run timed right before each sample
+    calibration_samples: List[float]
+
+
+def count_runs_per_sample(run: Callable[[], object], min_sample_seconds: float):
+    # also warms up caches and lazily created validators
+    started = time.perf_counter()
+    run()
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    return max(1, int(min_sample_seconds / elapsed))
+
+
+def prepare(
+    case: BenchmarkCase,
+    payload_name: str,
+    workload: Workload,
+    min_sample_seconds: float,
+) -> Measurement | None:
+    if case.annotation_type is None:
+        annotations = workload.annotations
+    else:
+        annotations = [
+            a for a in workload.annotations if a["type"] == case.annotation_type
+        ]
+    if len(annotations) == 0:
+        return None
+
+    state = case.setup(workload, annotations)
+
+    def run():
+        return case.run(workload, state)
+
+    return Measurement(
+        case.name,
+        payload_name,
+        len(annotations),
+        run,
+        count_runs_per_sample(run, min_sample_seconds),
+        [],
+        [],
+    )
+
+
+def time_runs(run: Callable[[], object], runs: int) -> float:
+    """
+    The seconds per run of the given number of runs
+    """
+    # like timeit, keep the garbage collector from adding noise to the sample
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        started = time.perf_counter()
+        for _ in range(runs):
+            run()
+        return (time.perf_counter() - started) / runs
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+
+def measure_retained_bytes(run: Callable[[], object]) -> int:
+    """
+    The bytes still allocated after a run while its result is alive. Garbage
+    is collected before both snapshots, so unlike the peak, the result does not
+    depend on when the garbage collector happens to run.
+    """
+    # tracemalloc's own allocations, e.g. of the first snapshot
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot().filter_traces(filters)
+        result = run()
+        gc.collect()
+        after = tracemalloc.take_snapshot().filter_traces(filters)
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+
+def summarize(measurement: Measurement) -> Dict[str, float]:
+    # the number of calibration runs taking as long as one run of the case
+    ratios = [
+        calibration_seconds / seconds
+        for seconds, calibration_seconds in zip(
+            measurement.samples, measurement.calibration_samples
+        )
+    ]
+    median_ratio = statistics.median(ratios)
+    # median absolute deviation, robust against single outlying samples
+    deviation = statistics.median(abs(ratio - median_ratio) for ratio in ratios)
+    # measured separately as tracing slows down the code considerably
+    retained_bytes = measure_retained_bytes(measurement.run)
+
+    return {
+        "annotations": measurement.annotations,
+        "annotations_per_second": measurement.annotations
+        / statistics.median(measurement.samples),
+        "annotations_per_calibration": measurement.annotations * median_ratio,
+        "relative_deviation": deviation / median_ratio,
+        "retained_bytes_per_annotation": retained_bytes / measurement.annotations,
+    }
+
+
+def run_benchmarks(
+    payloads: Dict[str, List[dict]],
+    case_filter: str | None,
+    repeat: int,
+    min_sample_seconds: float,
+) -> Dict[str, Dict[str, Dict[str, float]]]:
+    document_reference = load_document_reference()
+    measurements: List[Measurement] = []
+    for case in CASES:
+        if case_filter is not None and case_filter not in case.name:
+            continue
+        for payload_name, annotations in payloads.items():
+            workload = Workload(
+                annotations,
+                document_reference,
+                ResourceHandler(
+                    StubPipeline(annotations), fixed_composition_datetime=FIXED_DATETIME
+                ),
+            )
+            measurement = prepare(case, payload_name, workload, min_sample_seconds)
+            if measurement is not None:
+                measurements.append(measurement)
+
+    calibration_runs = count_runs_per_sample(calibrate, min_sample_seconds)
+    # the samples of each case are spread over the whole run and each is
+    # paired with a calibration sample, so the machine slowing down for a while
+    # slows down both instead of failing the cases measured at that time
+    for _ in range(repeat):
+        for measurement in measurements:
+            measurement.calibration_samples.append(
+                time_runs(calibrate, calibration_runs)
+            )
+            measurement.samples.append(
+                time_runs(measurement.run, measurement.runs_per_sample)
+            )
+
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for measurement in measurements:
+        result = summarize(measurement)
+        results.setdefault(measurement.name, {})[measurement.payload_name] = result
+        print(
+            f"{measurement.name:>45} {measurement.payload_name}: "
+            + f"{result['annotations_per_second']:10.1f} annotations/s "
+            + f"(±{result['relative_deviation']:5.1%}) "
+            + f"{result['retained_bytes_per_annotation']:10.1f} bytes/annotation"
+        )
+    return results
+
+
+def find_regressions(
+    results: Dict[str, Dict[str, Dict[str, float]]],
+    baselines: Dict[str, Dict[str, Dict[str, float]]],
+    throughput_threshold: float,
+    allocation_threshold: float,
+) -> List[str]:
+    """
+    Returns a description of every result that is slower or retains more
+    memory than its baseline by more than the given relative thresholds. The
+    throughput is compared relative to the calibration, and its threshold
+    widened by the deviation of the samples of the result and the baseline.
+    """
+    regressions = []
+    for case_name, payload_results in results.items():
+        for payload_name, result in payload_results.items():
+            baseline = baselines.get(case_name, {}).get(payload_name)
+            if baseline is None:
+                continue
+
+            expected = baseline["annotations_per_calibration"]
+            actual = result["annotations_per_calibration"]
+            noise = NOISE_FACTOR * (
+                baseline["relative_deviation"] + result["relative_deviation"]
+            )
+            if actual < expected * (1 - throughput_threshold - noise):
+                regressions.append(
+                    f"{case_name} {payload_name}: {actual:.2f} annotations "
+                    + f"per calibration run, baseline {expected:.2f}"
+                )
+
+            expected = baseline["retained_bytes_per_annotation"]
+            actual = result["retained_bytes_per_annotation"]
+            allowed = expected * (1 + allocation_threshold) + ALLOCATION_SLACK_BYTES
+            if actual > allowed:
+                regressions.append(
+                    f"{case_name} {payload_name}: {actual:.0f} bytes/annotation, "
+                    + f"baseline {expected:.0f}"
+                )
+    return regressions
+
+
+def main(argv: List[str] | None = None) -> int:
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR)
+    )
+
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--scale",
+        type=int,
+        nargs="+",
+        default=[1, 10],
+        help="Number of copies of each payload's annotations to map at once",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=7,
+        help="Number of samples of each case, of which the median is compared",
+    )
+    parser.add_argument(
+        "--min-sample-seconds",
+        type=float,
+        default=0.05,
+        help="Repeat each case within a sample until it took at least this long",
+    )
+    parser.add_argument("--case", help="Only run cases whose name contains this")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="Store the results as the new baseline instead of comparing them",
+    )
+    parser.add_argument(
+        "--throughput-threshold",
+        type=float,
+        default=0.3,
+        help="Maximum allowed relative decrease of annotations/s",
+    )
+    parser.add_argument(
+        "--allocation-threshold",
+        type=float,
+        default=0.10,
+        help="Maximum allowed relative increase of the retained bytes per annotation",
+    )
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(
+        load_payloads(args.scale), args.case, args.repeat, args.min_sample_seconds
+    )
+
+    if args.output is not None:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+            file.write("\n")
+        print(f"saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f"no baseline found at {args.baseline}, run with --save-baseline")
+        return 0
+
+    with open(args.baseline) as file:
+        baselines = json.load(file)
+
+    regressions = find_regressions(
+        results, baselines, args.throughput_threshold, args.allocation_threshold
+    )
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    return 1 if len(regressions) > 0 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,20 @@
+"""
+Helpers to derive larger synthetic AHD payloads from the canned test payloads.
+"""
+
+import copy
+from typing import List
+
+from ahd2fhir.utils.text_chunking import shift_offsets
+
+
+def scale_annotations(annotations: List[dict], factor: int) -> List[dict]:
+    document_length = max((a.get("end", 0) for a in annotations), default=0) + 1
+    scaled = []
+    # each copy reads like another occurrence further down the same document
+    for copy_index in range(factor):
+        copied = copy.deepcopy(annotations)
+        if copy_index > 0:
+            shift_offsets(copied, document_length * copy_index, f"-{copy_index}")
+        scaled.extend(copied)
+    return scaled
@@ -18,8 +18,9 @@ setup(
     url="https://github.com/miracum/ahd2fhir",
     # packages=["ahd2fhir", "."],
     package_dir={"ahd2fhir": "ahd2fhir"},
-    packages=find_packages(exclude=["test*"]),
+    packages=find_packages(exclude=["test*", "benchmarks*"]),
     include_package_data=True,
     install_requires=install_requires,
+    entry_points={"console_scripts": ["ahd2fhir=ahd2fhir.cli:main"]},
     python_requires=">=3.9",
 )
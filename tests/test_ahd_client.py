@@ -0,0 +1,99 @@
+import asyncio
+
+import pytest
+import requests
+from averbis import Client
+
+from ahd2fhir.config import AhdClientSettings, Settings
+from ahd2fhir.utils.ahd_client import (
+    RESOURCE_HANDLER_POOL_IN_USE_GAUGE,
+    PooledClient,
+    ResourceHandlerPool,
+    ResourceHandlerPoolTimeoutError,
+    build_session,
+)
+
+
+def get_settings(**ahd_client_settings) -> Settings:
+    return Settings(
+        ahd_url="http://localhost:9999/health-discovery",
+        # nosec
+        ahd_api_token="test",
+        ahd_project="test",
+        ahd_pipeline="test",
+        ahd_client=AhdClientSettings(**ahd_client_settings),
+    )
+
+
+def test_pooled_client_sends_requests_through_shared_session(mocker):
+    session = build_session(AhdClientSettings())
+    request = mocker.patch.object(session, "request")
+    client = PooledClient(
+        url_or_id="http://localhost:9999/health-discovery",
+        api_token="test",
+        timeout=(1.0, 2.0),
+        session=session,
+    )
+
+    client._run_request("get", "/v1/projects", params={"exists": True})
+
+    request.assert_called_once()
+    args, kwargs = request.call_args
+    assert args == ("get", "http://localhost:9999/health-discovery/rest/v1/projects")
+    assert kwargs["headers"]["api-token"] == "test"
+    assert kwargs["params"] == {"exists": "true"}
+    assert kwargs["timeout"] == (1.0, 2.0)
+
+
+def test_plain_client_does_not_send_requests_through_the_session(mocker):
+    session = build_session(AhdClientSettings())
+    session_request = mocker.patch.object(session, "request")
+    request = mocker.patch("requests.request")
+    client = Client(
+        url_or_id="http://localhost:9999/health-discovery", api_token="test"
+    )
+
+    client._run_request("get", "/v1/projects")
+
+    request.assert_called_once()
+    session_request.assert_not_called()
+
+
+def test_build_session_keeps_max_in_flight_connections_alive():
+    session = build_session(AhdClientSettings(max_in_flight_analyses=7))
+
+    adapter = session.get_adapter("https://example.com")
+
+    assert isinstance(session, requests.Session)
+    assert adapter._pool_maxsize == 7
+
+
+def test_resource_handler_pool_shares_one_pipeline():
+    pool = ResourceHandlerPool(get_settings(pool_size=3))
+
+    async def acquire_all():
+        async with pool.acquire() as a, pool.acquire() as b, pool.acquire() as c:
+            return [a, b, c]
+
+    handlers = asyncio.run(acquire_all())
+
+    assert len({id(handler) for handler in handlers}) == 3
+    assert all(handler.pipeline is pool.pipeline for handler in handlers)
+    assert all(
+        handler.analysis_semaphore is pool.analysis_semaphore for handler in handlers
+    )
+
+
+def test_resource_handler_pool_acquire_waits_for_a_free_handler():
+    pool = ResourceHandlerPool(get_settings(pool_size=1, pool_timeout_seconds=0.05))
+
+    async def acquire_twice():
+        async with pool.acquire():
+            assert RESOURCE_HANDLER_POOL_IN_USE_GAUGE._value.get() == 1
+            async with pool.acquire():
+                pass
+
+    with pytest.raises(ResourceHandlerPoolTimeoutError):
+        asyncio.run(acquire_twice())
+
+    assert RESOURCE_HANDLER_POOL_IN_USE_GAUGE._value.get() == 0
@@ -3,7 +3,10 @@ import json
 import pytest
 from fhir.resources.R4B.documentreference import DocumentReferenceContext
 
-from ahd2fhir.mappers.ahd_to_condition import get_fhir_condition
+from ahd2fhir.mappers.ahd_to_condition import (
+    build_identifier_from_annotation,
+    get_fhir_condition,
+)
 from ahd2fhir.utils.resource_handler import AHD_TYPE_DIAGNOSIS
 from tests.utils import get_empty_document_reference
 
@@ -59,6 +62,29 @@ def test_annotations_belonging_to_family_history_are_ignored():
     assert condition is None
 
 
+def test_builds_the_same_identifier_as_the_mapped_condition():
+    ahd_response = {
+        "type": "de.averbis.types.health.Diagnosis",
+        "begin": 10,
+        "end": 20,
+        "uniqueID": "de.averbis:123",
+        "dictCanon": "Test",
+        "matchedTerm": "Test",
+        "source": "ICD10GM_2020",
+        "verificationStatus": None,
+        "clinicalStatus": None,
+        "side": None,
+        "confidence": None,
+    }
+    document_reference = get_empty_document_reference()
+
+    identifier = build_identifier_from_annotation(ahd_response, document_reference)
+
+    assert identifier.value == "empty-document_10-20_de.averbis-123"
+    condition = get_fhir_condition(ahd_response, document_reference)
+    assert condition.identifier[0] == identifier
+
+
 def test_sets_the_condition_encounter_to_the_context_from_the_documentreference():
     ahd_response = {
         "type": "de.averbis.types.health.Diagnosis",
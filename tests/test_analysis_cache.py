@@ -0,0 +1,309 @@
+import asyncio
+import base64
+import json
+import sqlite3
+import zlib
+
+import pytest
+
+from ahd2fhir.config import AnalysisCacheSettings, Settings
+from ahd2fhir.utils.ahd_client import build_pipeline_analysis_cache
+from ahd2fhir.utils.analysis_cache import (
+    CACHE_ERRORS_COUNTER,
+    CACHE_HITS_COUNTER,
+    DiskAnalysisCache,
+    InMemoryAnalysisCache,
+    build_analysis_cache,
+    build_cache_key,
+    get_pipeline_identity,
+)
+from ahd2fhir.utils.resource_handler import ResourceHandler
+from tests.utils import get_empty_document_reference
+
+ANNOTATIONS = [{"type": "de.averbis.types.health.Diagnosis", "begin": 0, "end": 8}]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CountingMockPipeline:
+    def __init__(self):
+        self.calls = 0
+
+    def analyse_text(self, text: str, language: str, annotation_types: str):
+        self.calls = self.calls + 1
+        return []
+
+    def analyse_html(self, text: str, language: str, annotation_types: str):
+        return self.analyse_text(text, language, annotation_types)
+
+
+@pytest.fixture(params=["memory", "disk"])
+def make_cache(request, tmp_path):
+    def make(**kwargs):
+        if request.param == "memory":
+            return InMemoryAnalysisCache(**kwargs)
+        return DiskAnalysisCache(path=str(tmp_path / "cache.db"), **kwargs)
+
+    return make
+
+
+@pytest.fixture
+def entry_size_bytes(make_cache):
+    value = json.dumps(ANNOTATIONS).encode("utf-8")
+    if isinstance(make_cache(max_size_bytes=0), DiskAnalysisCache):
+        return len(zlib.compress(value))
+    return len(value)
+
+
+def get_document_reference(text: str):
+    doc = get_empty_document_reference()
+    doc.content[0].attachment.data = base64.b64encode(text.encode("utf-8"))
+    doc.content[0].attachment.contentType = "text/plain"
+    return doc
+
+
+def test_build_cache_key_should_depend_on_all_inputs():
+    key_args = {
+        "text": "Diabetes",
+        "mime_type": "text/plain",
+        "lang": "de",
+        "annotation_types": "a,b",
+        "pipeline_identity": "test|discharge|",
+    }
+    key = build_cache_key(**key_args)
+
+    assert key == build_cache_key(**key_args)
+    for name, value in [
+        ("text", "Diabetes mellitus"),
+        ("mime_type", "text/html"),
+        ("lang", "en"),
+        ("annotation_types", "a"),
+        ("pipeline_identity", "test|discharge|2"),
+    ]:
+        assert key != build_cache_key(**{**key_args, name: value})
+
+
+def test_get_pipeline_identity_should_include_the_configuration_hash(mocker):
+    pipeline = mocker.MagicMock()
+    pipeline.name = "discharge"
+    pipeline.project.name = "test"
+    pipeline.get_configuration.return_value = {"analysisEngines": []}
+
+    identity = get_pipeline_identity(pipeline, "1")
+
+    assert identity == "test|discharge|1"
+    assert get_pipeline_identity(pipeline, "1", include_configuration=True) != identity
+
+
+def test_get_pipeline_identity_should_raise_without_the_configuration(mocker):
+    pipeline = mocker.MagicMock()
+    pipeline.get_configuration.side_effect = ConnectionError("AHD is down")
+
+    with pytest.raises(ConnectionError):
+        get_pipeline_identity(pipeline, include_configuration=True)
+
+
+def test_cache_should_identify_the_pipeline_once_needed_and_refresh_it(mocker):
+    pipeline = mocker.MagicMock()
+    pipeline.name = "discharge"
+    pipeline.project.name = "test"
+    pipeline.get_configuration.return_value = {"analysisEngines": []}
+    settings = Settings(
+        ahd_url="http://localhost:9999/health-discovery",
+        ahd_api_token="test",
+        ahd_project="test",
+        ahd_pipeline="discharge",
+        ahd_cache=AnalysisCacheSettings(
+            backend="memory", pipeline_configuration_refresh_seconds=0
+        ),
+    )
+
+    cache = build_pipeline_analysis_cache(settings, pipeline)
+    assert pipeline.get_configuration.call_count == 0
+
+    identity = cache.get_pipeline_identity()
+    cache.set("key", ANNOTATIONS)
+    assert cache.get_pipeline_identity() == identity
+    assert cache.get("key") == ANNOTATIONS
+    assert pipeline.get_configuration.call_count == 2
+
+    pipeline.get_configuration.return_value = {"analysisEngines": ["changed"]}
+    assert cache.get_pipeline_identity() != identity
+    assert cache.get("key") is None
+
+
+def test_cache_should_return_copies_of_stored_results(make_cache):
+    cache = make_cache(max_size_bytes=1024)
+    hits_before = CACHE_HITS_COUNTER.labels(backend=cache.backend)._value.get()
+
+    assert cache.get("key") is None
+
+    cache.set("key", ANNOTATIONS)
+    result = cache.get("key")
+    result[0]["type"] = "changed"
+
+    assert cache.get("key") == ANNOTATIONS
+    assert CACHE_HITS_COUNTER.labels(backend=cache.backend)._value.get() == (
+        hits_before + 2
+    )
+
+
+def test_cache_should_expire_results_after_ttl(make_cache):
+    clock = FakeClock()
+    cache = make_cache(max_size_bytes=1024, ttl_seconds=10, clock=clock)
+    cache.set("key", ANNOTATIONS)
+
+    clock.now = clock.now + 9
+    assert cache.get("key") == ANNOTATIONS
+
+    clock.now = clock.now + 1
+    assert cache.get("key") is None
+
+
+def test_cache_should_evict_least_recently_used_results(make_cache, entry_size_bytes):
+    clock = FakeClock()
+    # large enough for two entries, but not for three
+    cache = make_cache(max_size_bytes=entry_size_bytes * 2, clock=clock)
+    for key in ["a", "b"]:
+        clock.now = clock.now + 1
+        cache.set(key, ANNOTATIONS)
+
+    clock.now = clock.now + 1
+    cache.get("a")
+    clock.now = clock.now + 1
+    cache.set("c", ANNOTATIONS)
+
+    assert cache.get("a") is not None
+    assert cache.get("b") is None
+    assert cache.get("c") is not None
+
+
+def test_cache_should_be_cleared_when_the_pipeline_changes(make_cache):
+    cache = make_cache(max_size_bytes=1024)
+    cache.bind_pipeline("test|discharge|1")
+    cache.set("key", ANNOTATIONS)
+
+    cache.bind_pipeline("test|discharge|1")
+    assert cache.get("key") == ANNOTATIONS
+
+    cache.bind_pipeline("test|discharge|2")
+    assert cache.get("key") is None
+    assert cache.pipeline_identity == "test|discharge|2"
+
+
+def test_disk_cache_should_persist_results_across_instances(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = DiskAnalysisCache(path=path, max_size_bytes=1024)
+    cache.bind_pipeline("test|discharge|1")
+    cache.set("key", ANNOTATIONS)
+    cache.close()
+
+    reopened = DiskAnalysisCache(path=path, max_size_bytes=1024)
+    reopened.bind_pipeline("test|discharge|1")
+
+    assert reopened.get("key") == ANNOTATIONS
+
+
+def test_disk_cache_should_keep_track_of_its_size(tmp_path):
+    entry_size_bytes = len(zlib.compress(json.dumps(ANNOTATIONS).encode("utf-8")))
+    clock = FakeClock()
+    path = str(tmp_path / "cache.db")
+    cache = DiskAnalysisCache(
+        path=path, max_size_bytes=entry_size_bytes * 2, ttl_seconds=10, clock=clock
+    )
+
+    def summed_size_bytes() -> int:
+        return cache._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM analysis_results"
+        ).fetchone()[0]
+
+    for key in ["a", "a", "b", "c"]:
+        cache.set(key, ANNOTATIONS)
+        clock.now = clock.now + 1
+    assert cache._get_size_bytes() == summed_size_bytes() == entry_size_bytes * 2
+
+    clock.now = clock.now + 8
+    assert cache.get("b") is None
+    assert cache._get_size_bytes() == summed_size_bytes() == entry_size_bytes
+
+    cache.close()
+    reopened = DiskAnalysisCache(path=path, max_size_bytes=entry_size_bytes * 2)
+    assert reopened._get_size_bytes() == entry_size_bytes
+
+
+def test_disk_cache_should_reset_its_size_if_cleared_from_outside(tmp_path):
+    entry_size_bytes = len(zlib.compress(json.dumps(ANNOTATIONS).encode("utf-8")))
+    cache = DiskAnalysisCache(
+        path=str(tmp_path / "cache.db"), max_size_bytes=entry_size_bytes * 2
+    )
+    cache.set("a", ANNOTATIONS)
+    with cache._connection:
+        cache._connection.execute("DELETE FROM analysis_results")
+    cache._connection.execute(
+        "UPDATE cache_size SET size_bytes = ?", (entry_size_bytes * 3,)
+    )
+
+    cache.set("b", ANNOTATIONS)
+
+    assert cache._get_size_bytes() == 0
+    assert cache.get("b") is None
+
+
+def test_build_analysis_cache_should_be_disabled_by_default():
+    assert build_analysis_cache(AnalysisCacheSettings()) is None
+    assert isinstance(
+        build_analysis_cache(AnalysisCacheSettings(backend="memory")),
+        InMemoryAnalysisCache,
+    )
+    with pytest.raises(ValueError):
+        build_analysis_cache(AnalysisCacheSettings(backend="redis"))
+
+
+def test_resource_handler_should_skip_ahd_on_cache_hit():
+    pipeline = CountingMockPipeline()
+    resource_handler = ResourceHandler(
+        averbis_pipeline=pipeline,
+        analysis_cache=InMemoryAnalysisCache(max_size_bytes=1024),
+    )
+
+    resource_handler.handle_documents([get_document_reference("Diabetes")])
+    resource_handler.handle_documents([get_document_reference("Diabetes")])
+    asyncio.run(
+        resource_handler.ahandle_documents([get_document_reference("Diabetes")])
+    )
+
+    assert pipeline.calls == 1
+
+    resource_handler.handle_documents([get_document_reference("Hypertension")])
+
+    assert pipeline.calls == 2
+
+
+class FailingAnalysisCache(InMemoryAnalysisCache):
+    def get(self, key: str):
+        raise sqlite3.OperationalError("database is locked")
+
+    def set(self, key: str, annotations):
+        raise sqlite3.OperationalError("database is locked")
+
+
+def test_resource_handler_should_analyze_the_text_if_the_cache_fails():
+    pipeline = CountingMockPipeline()
+    cache = FailingAnalysisCache(max_size_bytes=1024)
+    resource_handler = ResourceHandler(averbis_pipeline=pipeline, analysis_cache=cache)
+    errors = CACHE_ERRORS_COUNTER.labels(backend=cache.backend, operation="get")
+    errors_before = errors._value.get()
+
+    resource_handler.handle_documents([get_document_reference("Diabetes")])
+    asyncio.run(
+        resource_handler.ahandle_documents([get_document_reference("Diabetes")])
+    )
+
+    assert pipeline.calls == 2
+    assert errors._value.get() == errors_before + 2
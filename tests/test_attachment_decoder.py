@@ -0,0 +1,152 @@
+import base64
+import binascii
+import sys
+import tracemalloc
+from typing import Callable
+
+import pytest
+from fhir.resources.R4B.documentreference import DocumentReference
+
+from ahd2fhir.utils.attachment_decoder import decode_text
+from ahd2fhir.utils.resource_handler import ResourceHandler
+
+TEXT = "Röntgen-Thorax: kein Infiltrat. Verdacht auf Pneumonie 😷 ausgeräumt.\n"
+# only contains Latin-1 characters, so Python stores one byte per character
+LARGE_DOCUMENT_LINE = (
+    "Röntgen-Thorax: kein Infiltrat. Verdacht auf Pneumonie ausgeräumt.\n"
+)
+
+
+@pytest.mark.parametrize("chunk_size", [4, 8, 12, 1024])
+def test_decode_text_should_decode_across_chunk_boundaries(chunk_size):
+    data = base64.b64encode(TEXT.encode("utf-8"))
+
+    assert decode_text(data, chunk_size) == TEXT
+    assert decode_text(data.decode("ascii"), chunk_size) == TEXT
+
+
+def test_decode_text_should_ignore_line_breaks():
+    data = base64.encodebytes(TEXT.encode("utf-8") * 10)
+
+    assert b"\n" in data
+    assert decode_text(data, 8) == TEXT * 10
+
+
+@pytest.mark.parametrize(
+    "data,error",
+    [
+        (b"SGFsbG", binascii.Error),
+        (base64.b64encode("Hallo".encode("utf-16")), UnicodeDecodeError),
+    ],
+)
+def test_decode_text_of_invalid_data_should_raise(data, error):
+    with pytest.raises(error):
+        decode_text(data)
+
+
+def get_document_reference_with_size(size_mb: int) -> DocumentReference:
+    text = LARGE_DOCUMENT_LINE * (size_mb * 1024 * 1024 // len(LARGE_DOCUMENT_LINE))
+    return DocumentReference.parse_obj(
+        {
+            "resourceType": "DocumentReference",
+            "status": "current",
+            "content": [
+                {
+                    "attachment": {
+                        "contentType": "text/plain",
+                        "data": base64.b64encode(text.encode("utf-8")).decode(),
+                    }
+                }
+            ],
+        }
+    )
+
+
+def trace_peak_memory_of_decoding(
+    decode: Callable[[DocumentReference], str], size_mb: int
+):
+    """
+    Returns the decoded text and the memory allocated at peak while
+    decoding it, including the document's data if it's released
+    """
+    tracemalloc.start()
+    try:
+        document_reference = get_document_reference_with_size(size_mb)
+        tracemalloc.reset_peak()
+        allocated_before, _ = tracemalloc.get_traced_memory()
+
+        text = decode(document_reference)
+
+        _, peak = tracemalloc.get_traced_memory()
+        return text, peak - allocated_before
+    finally:
+        tracemalloc.stop()
+
+
+def trace_peak_memory_of_text_extraction(
+    resource_handler: ResourceHandler, size_mb: int
+):
+    return trace_peak_memory_of_decoding(
+        lambda document_reference: resource_handler._extract_text_from_resource(
+            document_reference
+        )[0],
+        size_mb,
+    )
+
+
+def decode_all_at_once(document_reference: DocumentReference) -> str:
+    """
+    How the text was extracted before it was decoded piece by piece
+    """
+    return base64.b64decode(document_reference.content[0].attachment.data).decode(
+        "utf8"
+    )
+
+
+@pytest.mark.parametrize("size_mb", [10, 50])
+def test_extracting_large_texts_should_hold_at_most_two_copies_of_the_text(size_mb):
+    text, peak = trace_peak_memory_of_text_extraction(ResourceHandler(None), size_mb)
+
+    # the buffer and the text read from it. Decoding all at once also holds
+    # the decoded bytes and a temporary copy of them.
+    assert peak < 2.2 * sys.getsizeof(text)
+
+
+@pytest.mark.parametrize("size_mb", [10, 50])
+def test_releasing_attachment_data_should_free_it_while_extracting(size_mb):
+    resource_handler = ResourceHandler(None, release_attachment_data=True)
+
+    text, peak = trace_peak_memory_of_text_extraction(resource_handler, size_mb)
+
+    # the released data outweighs the second copy of the text
+    assert peak < 1.3 * sys.getsizeof(text)
+
+
+@pytest.mark.parametrize("release_attachment_data", [False, True])
+def test_extracting_large_texts_should_allocate_less_than_decoding_all_at_once(
+    release_attachment_data,
+):
+    resource_handler = ResourceHandler(
+        None, release_attachment_data=release_attachment_data
+    )
+
+    text, peak = trace_peak_memory_of_text_extraction(resource_handler, 10)
+    previous_text, previous_peak = trace_peak_memory_of_decoding(decode_all_at_once, 10)
+
+    assert text == previous_text
+    # the base64 data converted to bytes, the decoded bytes and the text
+    # against the buffer and the text
+    assert peak < 0.75 * previous_peak
+
+
+def test_releasing_attachment_data_should_keep_the_metadata():
+    document_reference = get_document_reference_with_size(1)
+    resource_handler = ResourceHandler(None, release_attachment_data=True)
+
+    _, content_type, _ = resource_handler._extract_text_from_resource(
+        document_reference
+    )
+
+    assert content_type == "text/plain"
+    assert document_reference.content[0].attachment.data is None
+    assert document_reference.content[0].attachment.contentType == "text/plain"
@@ -0,0 +1,124 @@
+import asyncio
+import json
+import time
+
+from fhir.resources.R4B.bundle import Bundle
+
+from ahd2fhir.utils.bulk_analysis import (
+    LineTooLongError,
+    aiter_ndjson_lines,
+    analyze_ndjson_lines,
+)
+
+with open("tests/resources/fhir/documentreference.json") as file:
+    DOCUMENT_REFERENCE = json.load(file)["entry"][0]["resource"]
+
+
+def get_document_line(document_id: str) -> bytes:
+    return json.dumps({**DOCUMENT_REFERENCE, "id": document_id}).encode("utf8")
+
+
+class DelayingResourceHandler:
+    """
+    Returns an empty Bundle with the id of the document after a delay
+    encoded in that id, tracking the number of concurrent calls.
+    """
+
+    def __init__(self):
+        self.running = 0
+        self.max_running = 0
+
+    async def ahandle_documents(self, document_references) -> Bundle:
+        self.running = self.running + 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            document_id = document_references[0].id
+            await asyncio.sleep(int(document_id.split("-")[-1]) / 1000)
+            return Bundle(**{"id": document_id, "type": "transaction", "entry": []})
+        finally:
+            self.running = self.running - 1
+
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+
+async def collect(async_iterator):
+    return [item async for item in async_iterator]
+
+
+def test_aiter_ndjson_lines_should_join_lines_split_across_chunks():
+    chunks = [b'{"a":', b' 1}\n{"b": 2}\n\n{"c"', b": 3}"]
+
+    lines = asyncio.run(collect(aiter_ndjson_lines(iterate(chunks))))
+
+    assert lines == [b'{"a": 1}', b'{"b": 2}', b"", b'{"c": 3}']
+
+
+def test_aiter_ndjson_lines_should_reject_lines_longer_than_the_maximum():
+    chunks = [b'{"a": 1}\n{"b": ', b"2" * 10, b"2" * 10, b"}\n{}\n", b"3" * 11]
+
+    lines = asyncio.run(collect(aiter_ndjson_lines(iterate(chunks), max_line_bytes=10)))
+
+    assert len(lines) == 4
+    assert lines[0] == b'{"a": 1}'
+    assert isinstance(lines[1], LineTooLongError)
+    assert lines[2] == b"{}"
+    assert isinstance(lines[3], LineTooLongError)
+
+
+def test_aiter_ndjson_lines_should_not_copy_long_lines_for_each_chunk():
+    chunks = [b"x"] * 50_000 + [b"\n"]
+
+    started = time.perf_counter()
+    lines = asyncio.run(collect(aiter_ndjson_lines(iterate(chunks))))
+
+    assert lines == [b"x" * 50_000]
+    # takes seconds if the whole buffer is searched and copied per chunk
+    assert time.perf_counter() - started < 0.5
+
+
+def test_analyze_ndjson_lines_should_yield_results_as_they_finish():
+    lines = [get_document_line("doc-50"), get_document_line("doc-1")]
+
+    results = asyncio.run(
+        collect(analyze_ndjson_lines(iterate(lines), DelayingResourceHandler(), 2))
+    )
+
+    assert [json.loads(result)["id"] for result in results] == ["doc-1", "doc-50"]
+    assert all(result.endswith(b"\n") for result in results)
+
+
+def test_analyze_ndjson_lines_should_bound_concurrency():
+    handler = DelayingResourceHandler()
+    lines = [get_document_line(f"doc-{i}") for i in range(10)]
+
+    results = asyncio.run(collect(analyze_ndjson_lines(iterate(lines), handler, 3)))
+
+    assert len(results) == 10
+    assert handler.max_running == 3
+
+
+def test_analyze_ndjson_lines_should_report_errors_per_line():
+    lines = [
+        get_document_line("doc-1"),
+        b"",
+        b"not json",
+        b'{"resourceType": "Patient"}',
+        LineTooLongError("too long"),
+    ]
+
+    results = asyncio.run(
+        collect(analyze_ndjson_lines(iterate(lines), DelayingResourceHandler(), 4))
+    )
+    outcomes = {
+        result["id"]: result
+        for result in map(json.loads, results)
+        if result["resourceType"] == "OperationOutcome"
+    }
+
+    assert len(results) == 4
+    assert set(outcomes.keys()) == {"line-3", "line-4", "line-5"}
+    assert outcomes["line-4"]["issue"][0]["code"] == "not-supported"
+    assert outcomes["line-5"]["issue"][0]["code"] == "too-long"
@@ -18,3 +18,34 @@ def test_build_without_given_id_should_generate_random_bundle_id():
     bundle_b = bundle_builder.build_from_resources([], None)
 
     assert bundle_a.id != bundle_b.id
+
+
+def test_iter_entries_should_yield_the_entries_of_the_bundle():
+    bundle_builder = BundleBuilder()
+    resources = [Resource(id="a"), Resource(id="b")]
+
+    bundle = bundle_builder.build_from_resources(resources, id="fixed")
+    entries = list(bundle_builder.iter_entries(iter(resources)))
+
+    assert entries == bundle.entry
+    assert [entry.fullUrl for entry in entries] == ["Resource/a", "Resource/b"]
+    assert entries[0].resource is resources[0]
+    assert entries[0].request.method == "PUT"
+    assert entries[0].request.url == "Resource/a"
+
+
+def test_iter_entry_dicts_should_yield_the_entries_of_the_bundle_dict():
+    bundle_builder = BundleBuilder()
+    resources = [{"resourceType": "Resource", "id": "a"}]
+
+    bundle = bundle_builder.build_dict_from_resources(resources, id="fixed")
+    entries = list(bundle_builder.iter_entry_dicts(iter(resources)))
+
+    assert entries == bundle["entry"]
+    assert entries == [
+        {
+            "fullUrl": "Resource/a",
+            "resource": resources[0],
+            "request": {"method": "PUT", "url": "Resource/a"},
+        }
+    ]
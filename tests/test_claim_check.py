@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import io
+import json
+
+import pytest
+from aiokafka.structs import ConsumerRecord
+
+from ahd2fhir import config, kafka_setup
+from ahd2fhir.utils.claim_check import (
+    CLAIM_CHECK_HEADER,
+    BlobNotFoundError,
+    ClaimCheck,
+    FileSystemBlobStore,
+    S3BlobStore,
+    build_claim_check,
+)
+from ahd2fhir.utils.resource_handler import TransientError
+
+LARGE_PAYLOAD = json.dumps({"resourceType": "Bundle", "id": "x" * 2048}).encode()
+
+
+class FakeS3ClientError(Exception):
+    def __init__(self, code: str):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+class FakeS3Client:
+    """
+    In-memory stand-in for the parts of a boto3 S3 client used by S3BlobStore
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.available = True
+
+    def put_object(self, Bucket: str, Key: str, Body: bytes):
+        self._check_available()
+        self.objects[(Bucket, Key)] = Body
+
+    def get_object(self, Bucket: str, Key: str):
+        self._check_available()
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3ClientError("NoSuchKey")
+        return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def _check_available(self):
+        if not self.available:
+            raise FakeS3ClientError("ServiceUnavailable")
+
+
+def make_record(value: bytes, headers: list) -> ConsumerRecord:
+    return ConsumerRecord(
+        topic="fhir.documents",
+        partition=0,
+        offset=0,
+        timestamp=0,
+        timestamp_type=0,
+        key=None,
+        value=value,
+        checksum=None,
+        serialized_key_size=-1,
+        serialized_value_size=len(value),
+        headers=headers,
+    )
+
+
+@pytest.fixture(params=["filesystem", "s3"])
+def store(request, tmp_path):
+    if request.param == "filesystem":
+        return FileSystemBlobStore(str(tmp_path))
+    return S3BlobStore("bucket", prefix="ahd2fhir/", client=FakeS3Client())
+
+
+def test_check_in_should_only_store_payloads_above_the_threshold(store):
+    check = ClaimCheck(store, threshold_bytes=1024)
+
+    small_value, small_is_reference = check.check_in(b"{}")
+    reference, is_reference = check.check_in(LARGE_PAYLOAD)
+
+    assert (small_value, small_is_reference) == (b"{}", False)
+    assert is_reference
+    assert json.loads(reference) == {
+        "store": store.backend,
+        "sha256": hashlib.sha256(LARGE_PAYLOAD).hexdigest(),
+        "size": len(LARGE_PAYLOAD),
+    }
+    assert check.check_out(reference) == LARGE_PAYLOAD
+
+
+def test_check_out_of_a_modified_payload_should_raise(store):
+    check = ClaimCheck(store, threshold_bytes=1024)
+    reference, _ = check.check_in(LARGE_PAYLOAD)
+    store.put(json.loads(reference)["sha256"], LARGE_PAYLOAD.replace(b"x", b"y"))
+
+    with pytest.raises(ValueError, match="match its hash"):
+        check.check_out(reference)
+
+
+@pytest.mark.parametrize(
+    "reference,error",
+    [
+        (json.dumps({"sha256": "0" * 64, "size": 1}), BlobNotFoundError),
+        (json.dumps({"sha256": "../../etc/passwd", "size": 1}), ValueError),
+        (json.dumps({"size": 1}), ValueError),
+        ("not json", ValueError),
+    ],
+)
+def test_check_out_of_an_invalid_reference_should_raise(store, reference, error):
+    check = ClaimCheck(store, threshold_bytes=1024)
+
+    with pytest.raises(error):
+        check.check_out(reference.encode())
+
+
+def test_build_claim_check_should_select_the_backend(tmp_path):
+    assert build_claim_check(config.ClaimCheckSettings()) is None
+
+    filesystem_check = build_claim_check(
+        config.ClaimCheckSettings(
+            backend="filesystem", directory=str(tmp_path), threshold_bytes=10
+        )
+    )
+    assert isinstance(filesystem_check.store, FileSystemBlobStore)
+    assert filesystem_check.threshold_bytes == 10
+
+    with pytest.raises(ValueError):
+        build_claim_check(config.ClaimCheckSettings(backend="ftp"))
+
+    s3_check = build_claim_check(
+        config.ClaimCheckSettings(backend="s3", s3_bucket="b", s3_prefix="p/")
+    )
+    assert isinstance(s3_check.store, S3BlobStore)
+    assert (s3_check.store.bucket, s3_check.store.prefix) == ("b", "p/")
+
+
+def test_large_results_should_be_sent_and_resolved_as_references(monkeypatch):
+    check = ClaimCheck(
+        S3BlobStore("bucket", client=FakeS3Client()), threshold_bytes=1024
+    )
+    monkeypatch.setattr(kafka_setup, "claim_check", check)
+
+    value, headers = asyncio.run(kafka_setup.check_in_result(LARGE_PAYLOAD))
+    resolved = asyncio.run(kafka_setup.resolve_claim_check(make_record(value, headers)))
+
+    assert len(value) < 200
+    assert headers == [(CLAIM_CHECK_HEADER, b"s3")]
+    assert resolved == LARGE_PAYLOAD
+    assert asyncio.run(kafka_setup.check_in_result(b"{}")) == (b"{}", None)
+    assert asyncio.run(kafka_setup.resolve_claim_check(make_record(b"{}", []))) == (
+        b"{}"
+    )
+
+
+def test_unavailable_blob_store_should_raise_transient_errors(monkeypatch):
+    client = FakeS3Client()
+    check = ClaimCheck(S3BlobStore("bucket", client=client), threshold_bytes=1024)
+    monkeypatch.setattr(kafka_setup, "claim_check", check)
+    value, headers = asyncio.run(kafka_setup.check_in_result(LARGE_PAYLOAD))
+
+    client.available = False
+
+    with pytest.raises(TransientError):
+        asyncio.run(kafka_setup.check_in_result(LARGE_PAYLOAD))
+    with pytest.raises(TransientError):
+        asyncio.run(kafka_setup.resolve_claim_check(make_record(value, headers)))
+
+
+def test_references_without_a_claim_check_backend_should_raise(monkeypatch):
+    monkeypatch.setattr(kafka_setup, "claim_check", None)
+    record = make_record(b"{}", [(CLAIM_CHECK_HEADER, b"filesystem")])
+
+    with pytest.raises(ValueError):
+        asyncio.run(kafka_setup.resolve_claim_check(record))
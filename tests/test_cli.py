@@ -0,0 +1,218 @@
+import json
+
+import pytest
+
+from ahd2fhir import cli
+from ahd2fhir.config import AnalysisArchiveSettings, OutputValidationSettings, Settings
+from ahd2fhir.utils.resource_handler import ResourceHandler, TransientError
+from tests.test_resource_handler import MockPipeline
+
+with open("tests/resources/fhir/documentreference.json") as file:
+    DOCUMENT_REFERENCE = json.load(file)["entry"][0]["resource"]
+
+with open("tests/resources/ahd/payload_1.json") as file:
+    AHD_RESPONSE = json.load(file)
+
+
+def write_input(path, document_ids):
+    lines = [
+        json.dumps({**DOCUMENT_REFERENCE, "id": document_id})
+        for document_id in document_ids
+    ]
+    path.write_text("\n".join(lines) + "\n")
+
+
+def read_output(output_dir):
+    return [
+        json.loads(line)
+        for path in sorted(output_dir.glob("*.ndjson"))
+        for line in path.read_text().splitlines()
+    ]
+
+
+@pytest.fixture
+def pipeline(mocker):
+    pipeline = MockPipeline(response=AHD_RESPONSE)
+    mocker.patch.object(
+        cli,
+        "build_resource_handler",
+        lambda settings: ResourceHandler(averbis_pipeline=pipeline),
+    )
+    mocker.patch.object(cli.config, "Settings")
+    return pipeline
+
+
+def test_split_into_chunks_should_split_at_line_boundaries(tmp_path):
+    write_input(tmp_path / "documents.ndjson", ["a", "b", "c"])
+
+    chunks = list(cli.split_into_chunks(tmp_path / "documents.ndjson", 2))
+
+    assert [chunk.line_count for chunk in chunks] == [2, 1]
+    assert [chunk.first_line for chunk in chunks] == [1, 3]
+    assert json.loads(cli.read_chunk(chunks[1])[0])["id"] == "c"
+
+
+def test_run_analysis_should_write_one_bundle_per_document(pipeline, tmp_path):
+    input_dir = tmp_path / "input"
+    input_dir.mkdir()
+    write_input(input_dir / "a.ndjson", ["a-1", "a-2", "a-3"])
+    write_input(input_dir / "b.ndjson", ["b-1"])
+    (input_dir / "b.ndjson").open("a").write("not json\n")
+
+    failed_chunks = cli.run_analysis(
+        [str(input_dir)],
+        str(tmp_path / "output"),
+        processes=1,
+        threads=2,
+        chunk_size=2,
+        output_format="bundles",
+    )
+    results = read_output(tmp_path / "output")
+
+    assert failed_chunks == 0
+    assert len(list((tmp_path / "output").glob("*.ndjson"))) == 3
+    assert [result["resourceType"] for result in results] == [
+        "Bundle",
+        "Bundle",
+        "Bundle",
+        "Bundle",
+        "OperationOutcome",
+    ]
+    assert results[-1]["id"] == "line-2"
+
+
+def test_run_analysis_should_flatten_resources(pipeline, tmp_path):
+    write_input(tmp_path / "documents.ndjson", ["a"])
+
+    cli.run_analysis(
+        [str(tmp_path / "documents.ndjson")],
+        str(tmp_path / "output"),
+        processes=1,
+        threads=1,
+        chunk_size=10,
+        output_format="resources",
+    )
+    results = read_output(tmp_path / "output")
+
+    assert len(results) > 1
+    assert "Bundle" not in {result["resourceType"] for result in results}
+    assert "Composition" in {result["resourceType"] for result in results}
+
+
+def test_run_analysis_should_resume_from_checkpoint(pipeline, mocker, tmp_path):
+    write_input(tmp_path / "documents.ndjson", ["a", "b", "c", "d"])
+    run_args = dict(
+        inputs=[str(tmp_path / "documents.ndjson")],
+        output_dir=str(tmp_path / "output"),
+        processes=1,
+        threads=1,
+        chunk_size=2,
+        output_format="bundles",
+    )
+    analyze_line = cli.analyze_line
+
+    def fail_second_chunk(line_number, line, output_format):
+        if line_number > 2:
+            raise TransientError("AHD is down")
+        return analyze_line(line_number, line, output_format)
+
+    mocker.patch.object(cli, "analyze_line", fail_second_chunk)
+    assert cli.run_analysis(**run_args) == 1
+    assert len(read_output(tmp_path / "output")) == 2
+
+    analyze_chunk = mocker.spy(cli, "analyze_chunk")
+    mocker.patch.object(cli, "analyze_line", analyze_line)
+    assert cli.run_analysis(**run_args) == 0
+
+    assert analyze_chunk.call_count == 1
+    assert len(read_output(tmp_path / "output")) == 4
+
+
+def test_run_analysis_should_refuse_to_resume_with_another_chunk_size(
+    pipeline, tmp_path
+):
+    write_input(tmp_path / "documents.ndjson", ["a", "b", "c", "d"])
+    run_args = dict(
+        inputs=[str(tmp_path / "documents.ndjson")],
+        output_dir=str(tmp_path / "output"),
+        processes=1,
+        threads=1,
+        output_format="bundles",
+    )
+    assert cli.run_analysis(chunk_size=2, **run_args) == 0
+
+    with pytest.raises(cli.CheckpointMismatchError):
+        cli.run_analysis(chunk_size=3, **run_args)
+
+    # the outputs of the first run are left as they are
+    assert len(read_output(tmp_path / "output")) == 4
+    assert cli.run_analysis(chunk_size=2, **run_args) == 0
+
+
+def test_build_resource_handler_should_use_the_service_settings(mocker, tmp_path):
+    mocker.patch.object(cli, "get_pooled_averbis_client")
+    mocker.patch.object(cli, "get_pipeline", return_value=MockPipeline())
+    settings = Settings(
+        ahd_url="http://localhost:9999/health-discovery",
+        # nosec
+        ahd_api_token="test",
+        ahd_project="test",
+        ahd_pipeline="test",
+        ahd_archive=AnalysisArchiveSettings(directory=str(tmp_path / "archive")),
+        output_validation=OutputValidationSettings(policy="always"),
+    )
+
+    resource_handler = cli.build_resource_handler(settings)
+
+    assert resource_handler.analysis_archive.directory == str(tmp_path / "archive")
+    assert resource_handler.output_validator.policy == "always"
+
+
+def test_replay_responses_should_map_each_response_with_the_document(tmp_path):
+    output_path = tmp_path / "results.ndjson"
+
+    exit_code = cli.main(
+        [
+            "replay-responses",
+            "tests/resources/ahd/payload_1.json",
+            "tests/resources/ahd/v6",
+            "--document-reference",
+            "tests/resources/fhir/documentreference.json",
+            "--output",
+            str(output_path),
+        ]
+    )
+
+    bundles = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert exit_code == 0
+    # the v6 directory holds two responses
+    assert len(bundles) == 3
+    assert all(bundle["resourceType"] == "Bundle" for bundle in bundles)
+    subjects = {
+        entry["resource"]["subject"]["reference"]
+        for bundle in bundles
+        for entry in bundle["entry"]
+        if "subject" in entry["resource"]
+    }
+    assert subjects == {DOCUMENT_REFERENCE["subject"]["reference"]}
+
+
+def test_replay_responses_should_write_an_outcome_for_invalid_responses(tmp_path):
+    invalid_response_path = tmp_path / "invalid.json"
+    invalid_response_path.write_text('{"unexpected": []}')
+    output_path = tmp_path / "results.ndjson"
+
+    failed_responses = cli.run_response_replay(
+        inputs=["tests/resources/ahd/payload_1.json", str(invalid_response_path)],
+        document_reference_path="tests/resources/fhir/documentreference.json",
+        output_path=str(output_path),
+        output_format="bundles",
+    )
+
+    results = [json.loads(line) for line in output_path.read_text().splitlines()]
+    assert failed_responses == 1
+    assert [result["resourceType"] for result in results] == [
+        "Bundle",
+        "OperationOutcome",
+    ]
+    assert results[1]["id"] == "line-2"
@@ -0,0 +1,30 @@
+import pytest
+
+from ahd2fhir.config import ClaimCheckSettings, KafkaProducerSettings, KafkaSettings
+
+
+@pytest.mark.parametrize(
+    "env_value,expected_acks", [("0", 0), ("1", 1), ("-1", -1), ("all", "all")]
+)
+def test_kafka_producer_acks_should_be_parsed_from_env(
+    monkeypatch, env_value, expected_acks
+):
+    monkeypatch.setenv("KAFKA_PRODUCER_ACKS", env_value)
+
+    assert KafkaProducerSettings().acks == expected_acks
+
+
+def test_claim_check_threshold_should_be_below_the_max_message_size():
+    with pytest.raises(ValueError, match="kafka_claim_check_threshold_bytes"):
+        KafkaSettings(
+            max_message_size_bytes=1024,
+            claim_check=ClaimCheckSettings(backend="filesystem", threshold_bytes=1024),
+        )
+
+    assert KafkaSettings().claim_check.threshold_bytes == 4194304
+
+
+def test_claim_check_threshold_should_be_ignored_without_a_backend(monkeypatch):
+    monkeypatch.setenv("KAFKA_MAX_MESSAGE_SIZE_BYTES", "1048576")
+
+    assert KafkaSettings().max_message_size_bytes == 1048576
@@ -1,6 +1,6 @@
 import json
 
-from ahd2fhir.utils.device_builder import build_device
+from ahd2fhir.utils.device_builder import build_device, get_device, get_device_dict
 from ahd2fhir.utils.resource_handler import AHD_TYPE_DOCUMENT_ANNOTATION
 
 
@@ -21,3 +21,14 @@ def test_build_sets_version_identifier_and_id():
 
     assert len(device.identifier) == 1
     assert device.id is not None
+
+
+def test_get_device_should_share_the_device_of_each_version():
+    first = get_device({"version": "7.4.0"})
+    second = get_device({"version": "7.4.0"})
+    other = get_device({"version": "7.5.0"})
+
+    assert first is second
+    assert first is not other
+    assert first.json() == build_device({"version": "7.4.0"}).json()
+    assert get_device_dict({"version": "7.4.0"})["id"] == first.id
@@ -0,0 +1,150 @@
+import datetime
+import glob
+import itertools
+import json
+import uuid
+
+import pytest
+from fhir.resources.R4B.codeableconcept import CodeableConcept
+from fhir.resources.R4B.coding import Coding
+from fhir.resources.R4B.documentreference import DocumentReference
+
+from ahd2fhir.mappers.ahd_to_condition import get_fhir_condition
+from ahd2fhir.utils.fhir_response import serialize_dict, serialize_resource
+from ahd2fhir.utils.mapper_registry import (
+    build_dict_mapper_registry,
+    build_mapper_registry,
+)
+from ahd2fhir.utils.resource_handler import ResourceHandler
+from tests.utils import get_empty_document_reference
+
+FIXED_DATETIME = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+
+AHD_PAYLOAD_PATHS = sorted(glob.glob("tests/resources/ahd/**/*.json", recursive=True))
+
+with open("tests/resources/fhir/documentreference.json") as file:
+    DOCUMENT_REFERENCE = json.load(file)["entry"][0]["resource"]
+
+
+def get_document_references() -> dict[str, DocumentReference]:
+    without_optional_elements = {
+        key: value
+        for key, value in DOCUMENT_REFERENCE.items()
+        if key not in ["date", "identifier", "context", "type", "category"]
+    }
+    with_identifiers = {
+        **DOCUMENT_REFERENCE,
+        "identifier": [
+            {"system": "https://fhir.example.com/identifiers/document", "value": "1"},
+            {"system": "https://fhir.example.com/identifiers/document", "value": "2"},
+        ],
+    }
+    return {
+        "complete": DocumentReference.parse_obj(DOCUMENT_REFERENCE),
+        "with-identifiers": DocumentReference.parse_obj(with_identifiers),
+        "without-optional-elements": DocumentReference.parse_obj(
+            without_optional_elements
+        ),
+        "empty": get_empty_document_reference(),
+    }
+
+
+def get_annotations(path: str) -> list:
+    with open(path) as file:
+        annotations = json.load(file)
+    if isinstance(annotations, dict):
+        return annotations["payload"]
+    return annotations
+
+
+class FixedDatetime(datetime.datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return FIXED_DATETIME
+
+
+@pytest.fixture
+def deterministic(mocker):
+    """
+    Makes the random ids and the current time reproducible. Returns a function
+    restarting the generated ids, to be called before each mapping.
+    """
+    mocker.patch.object(datetime, "datetime", FixedDatetime)
+    counter = itertools.count()
+    mocker.patch("uuid.uuid4", side_effect=lambda: uuid.UUID(int=next(counter)))
+
+    def restart():
+        nonlocal counter
+        counter = itertools.count()
+
+    return restart
+
+
+@pytest.mark.parametrize("smkstat_as_value_string", [False, True])
+@pytest.mark.parametrize("document_name", list(get_document_references().keys()))
+@pytest.mark.parametrize("ahd_payload_path", AHD_PAYLOAD_PATHS)
+def test_dict_mapping_should_serialize_the_same_as_model_mapping(
+    deterministic, ahd_payload_path, document_name, smkstat_as_value_string
+):
+    document_reference = get_document_references()[document_name]
+    analyzed_documents = [(document_reference, get_annotations(ahd_payload_path))]
+    handler = ResourceHandler(
+        None,
+        fixed_composition_datetime=FIXED_DATETIME,
+        mapper_registry=build_mapper_registry(True, smkstat_as_value_string),
+        dict_mapper_registry=build_dict_mapper_registry(True, smkstat_as_value_string),
+    )
+
+    deterministic()
+    expected = serialize_resource(handler.map_documents(analyzed_documents))
+    deterministic()
+    actual = serialize_dict(handler.map_documents_as_dict(analyzed_documents))
+
+    assert actual == expected
+
+
+def test_dict_mapping_of_empty_annotations_should_serialize_the_same(deterministic):
+    document_reference = get_document_references()["complete"]
+    handler = ResourceHandler(None, fixed_composition_datetime=FIXED_DATETIME)
+
+    deterministic()
+    expected = serialize_resource(handler.map_documents([(document_reference, [])]))
+    deterministic()
+    actual = serialize_dict(handler.map_documents_as_dict([(document_reference, [])]))
+
+    assert actual == expected
+
+
+def test_models_should_be_constructed_from_the_mapped_dicts():
+    document_reference = get_document_references()["complete"]
+    annotation = {
+        "type": "de.averbis.types.health.Diagnosis",
+        "begin": 0,
+        "end": 4,
+        "uniqueID": "id:1",
+        "source": "ICD10GM_2020",
+        "conceptID": "N20.0",
+        "dictCanon": "Nierenstein",
+        "side": "LEFT",
+    }
+
+    condition = get_fhir_condition(annotation, document_reference)
+    other_condition = get_fhir_condition(annotation, document_reference)
+
+    assert isinstance(condition.code, CodeableConcept)
+    assert isinstance(condition.code.coding[0], Coding)
+    assert condition.code.coding[0].code == "N20.0"
+    # the document's elements and the fragments are shared, not copied
+    assert condition.subject is document_reference.subject
+    assert condition.bodySite[0] is other_condition.bodySite[0]
+    assert condition.code is not other_condition.code
+
+
+def test_dict_mapping_should_not_convert_the_attachments(mocker):
+    document_reference = get_document_references()["complete"]
+    handler = ResourceHandler(None, fixed_composition_datetime=FIXED_DATETIME)
+    to_dict = mocker.spy(type(document_reference.content[0].attachment), "dict")
+
+    handler.map_documents_as_dict([(document_reference, [])])
+
+    to_dict.assert_not_called()
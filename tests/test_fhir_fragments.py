@@ -0,0 +1,110 @@
+import pickle
+
+import pytest
+
+from ahd2fhir.mappers import ahd_to_condition
+from ahd2fhir.mappers import ahd_to_observation_kidney_stone as ks
+from ahd2fhir.mappers import ahd_to_observation_smkstat as smk
+from ahd2fhir.utils import fhir_dicts
+from ahd2fhir.utils import fhir_fragments as fragments
+from tests.utils import get_empty_document_reference
+
+
+def test_codeable_concept_with_the_same_content_should_be_shared():
+    first = fragments.codeable_concept(
+        fragments.coding("http://snomed.info/sct", "7771000", display="Left")
+    )
+    second = fragments.codeable_concept(
+        fragments.coding("http://snomed.info/sct", "7771000", display="Left")
+    )
+    other = fragments.codeable_concept(
+        fragments.coding("http://snomed.info/sct", "7771000", display="Right")
+    )
+
+    assert first is second
+    assert first is not other
+    assert first.coding[0].display == "Left"
+
+
+@pytest.mark.parametrize(
+    "modify",
+    [
+        lambda fragment: setattr(fragment, "text", "Right"),
+        lambda fragment: setattr(fragment.coding[0], "code", "24028007"),
+        lambda fragment: fragment.coding.append(fragment.coding[0]),
+    ],
+)
+def test_modifying_a_shared_fragment_should_raise(modify):
+    fragment = fragments.codeable_concept(
+        fragments.coding("http://snomed.info/sct", "7771000", display="Left"),
+        text="Left",
+    )
+
+    with pytest.raises((TypeError, AttributeError)):
+        modify(fragment)
+
+    assert fragment.json() == (
+        '{"coding":[{"system":"http://snomed.info/sct",'
+        + '"code":"7771000","display":"Left"}],"text":"Left"}'
+    )
+
+
+def test_codes_from_annotations_should_not_be_cached():
+    annotation = {"smokingStatus": "NEVER-SMOKER", "sctid": "266919005"}
+    cached_fragments = len(fragments._fragments)
+
+    [observation] = smk.get_fhir_resources(
+        annotation, get_empty_document_reference(), as_value_string=False
+    )
+
+    assert observation.valueCodeableConcept.coding[1].code == "266919005"
+    assert len(fragments._fragments) == cached_fragments
+
+
+def test_mapped_observations_should_share_their_codings():
+    annotation = {"size": None}
+    doc_ref = get_empty_document_reference()
+
+    [first] = ks.get_fhir_resources(annotation, doc_ref)
+    [second] = ks.get_fhir_resources(annotation, doc_ref)
+
+    assert first.id != second.id
+    assert first.code is second.code
+    assert first.meta is second.meta
+    assert first.category[0] is second.category[0]
+
+
+@pytest.mark.parametrize(
+    "modify",
+    [
+        lambda condition: condition["meta"].update(versionId="2"),
+        lambda condition: condition["meta"]["profile"].append("changed"),
+        lambda condition: condition["bodySite"][0]["coding"][0].pop("code"),
+        lambda condition: condition["bodySite"][0].__setitem__("text", "changed"),
+    ],
+)
+def test_modifying_a_shared_dict_should_raise(modify):
+    annotation = {
+        "type": "de.averbis.types.health.Diagnosis",
+        "begin": 0,
+        "end": 4,
+        "uniqueID": "id:1",
+        "source": "ICD10GM_2020",
+        "conceptID": "N20.0",
+        "dictCanon": "Nierenstein",
+        "side": "LEFT",
+    }
+    document = fhir_dicts.get_document_elements(
+        get_empty_document_reference(), as_dicts=True
+    )
+    condition = ahd_to_condition.get_fhir_condition_dict(annotation, document)
+
+    with pytest.raises((TypeError, AttributeError)):
+        modify(condition)
+
+    other_condition = ahd_to_condition.get_fhir_condition_dict(annotation, document)
+    assert other_condition["meta"] == {
+        "profile": (ahd_to_condition.FHIR_SYSTEMS.condition_profile,)
+    }
+    assert other_condition["bodySite"][0]["coding"][0]["code"] == "7771000"
+    assert pickle.loads(pickle.dumps(condition)) == condition
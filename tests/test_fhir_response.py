@@ -0,0 +1,80 @@
+import base64
+import json
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from fhir.resources.R4B.attachment import Attachment
+from fhir.resources.R4B.documentreference import DocumentReferenceContent
+from fhir.resources.R4B.fhirtypes import DateTime
+from starlette.responses import JSONResponse
+
+from ahd2fhir.utils.fhir_response import FHIRJSONResponse, serialize_resource
+from ahd2fhir.utils.resource_handler import ResourceHandler
+from tests.test_resource_handler import MockPipeline
+from tests.utils import get_empty_document_reference
+
+SNAPSHOTS_DIR = "tests/__snapshots__/test_resource_handler"
+
+
+def get_result_bundle(ahd_payload_filename: str):
+    doc = get_empty_document_reference()
+    doc.content[0] = DocumentReferenceContent(
+        **{
+            "attachment": Attachment(
+                **{
+                    "data": base64.b64encode(
+                        "empty because a mocked AHD response is used".encode("utf-8")
+                    ),
+                    "contentType": "text/plain",
+                    "language": "en",
+                }
+            )
+        }
+    )
+    doc.date = DateTime.validate("2000-01-01T00:00:00+00:00")
+
+    with open(f"tests/resources/ahd/v6/{ahd_payload_filename}") as file:
+        payload = json.load(file)["payload"]
+
+    resource_handler = ResourceHandler(
+        averbis_pipeline=MockPipeline(response=payload),
+        fixed_composition_datetime=doc.date,
+    )
+    return resource_handler.handle_documents([doc])
+
+
+@pytest.mark.parametrize(
+    "ahd_payload_filename", ["complex-payload.json", "simple-payload.json"]
+)
+def test_serialize_resource_should_match_snapshots(ahd_payload_filename):
+    snapshot_path = (
+        f"{SNAPSHOTS_DIR}/test_handle_documents_from_ahd_payloads_snapshots"
+        + f"[{ahd_payload_filename}].fhir.json"
+    )
+    with open(snapshot_path, "rb") as file:
+        snapshot = file.read()
+
+    result_bundle = get_result_bundle(ahd_payload_filename)
+
+    assert serialize_resource(result_bundle, indent=True) == snapshot
+
+
+@pytest.mark.parametrize(
+    "ahd_payload_filename", ["complex-payload.json", "simple-payload.json"]
+)
+def test_fhir_json_response_should_match_jsonable_encoder_response(
+    ahd_payload_filename,
+):
+    result_bundle = get_result_bundle(ahd_payload_filename)
+
+    expected = JSONResponse(content=jsonable_encoder(result_bundle.dict()))
+    response = FHIRJSONResponse(content=result_bundle)
+
+    assert response.body == expected.body
+    assert response.media_type == "application/fhir+json"
+
+
+def test_fhir_json_response_should_render_plain_content():
+    response = FHIRJSONResponse(content={"resourceType": "OperationOutcome"})
+
+    assert response.body == b'{"resourceType":"OperationOutcome"}'
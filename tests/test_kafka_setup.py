@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+from aiokafka.structs import ConsumerRecord, TopicPartition
+
+from ahd2fhir import kafka_setup
+from ahd2fhir.utils.offset_tracker import OffsetTracker
+from ahd2fhir.utils.resource_handler import TransientError
+
+
+def make_record(offset: int) -> ConsumerRecord:
+    return ConsumerRecord(
+        topic="fhir.documents",
+        partition=0,
+        offset=offset,
+        timestamp=0,
+        timestamp_type=0,
+        key=None,
+        value=b"{}",
+        checksum=None,
+        serialized_key_size=-1,
+        serialized_value_size=2,
+        headers=[],
+    )
+
+
+class IdleConsumer:
+    """
+    Returns the given records, then waits for more forever like a consumer
+    of an idle topic
+    """
+
+    def __init__(self, records):
+        self.records = list(records)
+        self.committed = {}
+        self.stopped = False
+
+    async def getone(self) -> ConsumerRecord:
+        if len(self.records) > 0:
+            return self.records.pop(0)
+        await asyncio.Event().wait()
+
+    async def commit(self, offsets):
+        self.committed.update(offsets)
+
+    def highwater(self, partition):
+        return None
+
+    async def stop(self):
+        self.stopped = True
+
+
+class SlowAckProducer:
+    """
+    Acknowledges the records sent only once they are flushed
+    """
+
+    def __init__(self):
+        self.unacknowledged = []
+
+    async def send(self, topic, value=None, key=None, headers=None):
+        delivery = asyncio.get_running_loop().create_future()
+        self.unacknowledged.append(delivery)
+        return delivery
+
+    async def flush(self):
+        for delivery in self.unacknowledged:
+            delivery.set_result(None)
+        self.unacknowledged = []
+
+
+@pytest.fixture
+def kafka(monkeypatch):
+    monkeypatch.setenv("AHD_URL", "http://localhost:9999/health-discovery")
+    monkeypatch.setenv("AHD_API_TOKEN", "test")
+    monkeypatch.setenv("AHD_PROJECT", "test")
+    monkeypatch.setenv("AHD_PIPELINE", "test")
+    monkeypatch.setenv("KAFKA_MAX_IN_FLIGHT_MESSAGES", "4")
+    monkeypatch.setattr(kafka_setup, "resource_handler_pool", object())
+    monkeypatch.setattr(kafka_setup, "offset_tracker", OffsetTracker())
+    producer = SlowAckProducer()
+    monkeypatch.setattr(kafka_setup, "producer", producer)
+    return producer
+
+
+def test_transient_error_should_stop_consuming_an_idle_topic(kafka, monkeypatch):
+    async def fail_with_transient_error(msg, settings, failed_topic):
+        raise TransientError("AHD is down")
+
+    monkeypatch.setattr(kafka_setup, "process_message", fail_with_transient_error)
+    consumer = IdleConsumer([make_record(0)])
+
+    asyncio.run(
+        asyncio.wait_for(kafka_setup.send_consumer_message(consumer), timeout=5)
+    )
+
+    assert consumer.stopped
+    assert consumer.committed == {}
+
+
+def test_commit_should_wait_for_the_flushed_deliveries(kafka, monkeypatch):
+    async def send_result(msg, settings, failed_topic):
+        return await kafka_setup.producer.send("fhir.nlp-results", msg.value)
+
+    monkeypatch.setattr(kafka_setup, "process_message", send_result)
+    consumer = IdleConsumer([make_record(offset) for offset in range(3)])
+
+    async def consume_and_commit():
+        consuming = asyncio.create_task(kafka_setup.send_consumer_message(consumer))
+        while len(kafka.unacknowledged) < 3:
+            await asyncio.sleep(0)
+
+        await kafka_setup.commit_processed_offsets(consumer)
+        consuming.cancel()
+
+    asyncio.run(consume_and_commit())
+
+    assert consumer.committed == {TopicPartition("fhir.documents", 0): 3}
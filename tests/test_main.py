@@ -1,3 +1,5 @@
+import contextlib
+import json
 from http import HTTPStatus
 
 import pytest
@@ -5,7 +7,8 @@ from fastapi.testclient import TestClient
 from fhir.resources.R4B.bundle import Bundle
 
 from ahd2fhir import main
-from ahd2fhir.config import Settings
+from ahd2fhir.config import AhdClientSettings, Settings
+from ahd2fhir.utils.ahd_client import ResourceHandlerPoolTimeoutError
 from tests.utils import get_empty_document_reference
 
 
@@ -23,7 +26,7 @@ class MockResourceHandler:
     def __init__(self, averbis_pipeline):
         self.pipeline = averbis_pipeline
 
-    def handle_documents(self, document_references) -> Bundle:
+    async def ahandle_documents(self, document_references) -> Bundle:
         bundle = Bundle.construct()
         bundle.type = "transaction"
         bundle.id = "test"
@@ -53,3 +56,68 @@ def test_analyze_empty_document_should_return_unprocessable_entity_status():
     response = client.post("/fhir/$analyze-document", json=doc.dict())
 
     assert response.status_code == HTTPStatus.UNPROCESSABLE_ENTITY
+
+
+class MockResourceHandlerPool:
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        yield MockResourceHandler(None)
+
+
+class BusyResourceHandlerPool:
+    settings = Settings(
+        ahd_url="localhost",
+        # nosec
+        ahd_api_token="test",
+        ahd_project="test",
+        ahd_pipeline="test",
+        ahd_client=AhdClientSettings(pool_timeout_seconds=2.5),
+    )
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        raise ResourceHandlerPoolTimeoutError()
+        yield
+
+
+def test_analyze_document_should_return_service_unavailable_if_pool_is_busy(
+    monkeypatch,
+):
+    monkeypatch.delitem(main.app.dependency_overrides, main.get_resource_handler)
+    monkeypatch.setattr(
+        main.app.state,
+        "resource_handler_pool",
+        BusyResourceHandlerPool(),
+        raising=False,
+    )
+    doc = get_empty_document_reference()
+
+    response = client.post("/fhir/$analyze-document", json=doc.dict())
+
+    assert response.status_code == HTTPStatus.SERVICE_UNAVAILABLE
+    assert response.headers["Retry-After"] == "3"
+
+
+def test_analyze_document_bulk_should_stream_one_result_per_line():
+    main.app.dependency_overrides[main.get_resource_handler_pool] = (
+        MockResourceHandlerPool
+    )
+    with open("tests/resources/fhir/documentreference.json") as file:
+        doc = json.dumps(json.load(file)["entry"][0]["resource"])
+    body = "\n".join([doc, "{}", doc])
+
+    response = client.post(
+        "/fhir/$analyze-document-bulk",
+        content=body,
+        headers={"Content-Type": "application/fhir+ndjson"},
+    )
+    results = [json.loads(line) for line in response.text.splitlines()]
+
+    assert response.status_code == HTTPStatus.OK
+    assert response.headers["content-type"] == "application/fhir+ndjson"
+    assert len(results) == 3
+    assert sorted(result["resourceType"] for result in results) == [
+        "Bundle",
+        "Bundle",
+        "OperationOutcome",
+    ]
@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+from ahd2fhir.mappers import ahd_to_observation_kidney_stone as ks
+from ahd2fhir.mappers import ahd_to_observation_smkstat as smk
+from ahd2fhir.utils.const import AHD_TYPE_DIAGNOSIS, AHD_TYPE_MEDICATION
+from ahd2fhir.utils.mapper_registry import build_mapper_registry
+from ahd2fhir.utils.resource_handler import ResourceHandler
+from tests.utils import get_empty_document_reference
+
+
+def get_payload(path: str) -> list:
+    with open(f"tests/resources/ahd/{path}") as file:
+        return json.load(file)
+
+
+def test_unmapped_annotation_type_should_have_no_mappers():
+    registry = build_mapper_registry(custom_mappers_enabled=True)
+
+    assert registry.get("de.averbis.types.health.Anatomy") == ()
+
+
+def test_custom_mappers_should_only_be_registered_if_enabled():
+    disabled = build_mapper_registry(custom_mappers_enabled=False)
+    enabled = build_mapper_registry(custom_mappers_enabled=True)
+
+    assert disabled.get(smk.AHD_TYPE) == ()
+    assert disabled.get(ks.AHD_TYPE) == ()
+    assert len(enabled.get(smk.AHD_TYPE)) == 1
+    assert len(enabled.get(ks.AHD_TYPE)) == 1
+    for registry in [disabled, enabled]:
+        assert len(registry.get(AHD_TYPE_DIAGNOSIS)) == 1
+        assert len(registry.get(AHD_TYPE_MEDICATION)) == 1
+
+
+def test_flags_should_be_read_from_the_environment_when_built(monkeypatch):
+    monkeypatch.setenv("CUSTOM_MAPPERS_ENABLED", "true")
+    registry = build_mapper_registry()
+    monkeypatch.delenv("CUSTOM_MAPPERS_ENABLED")
+
+    assert len(registry.get(smk.AHD_TYPE)) == 1
+
+
+def get_smkstat_annotation() -> dict:
+    return [a for a in get_payload("payload_1.json") if a["type"] == smk.AHD_TYPE][0]
+
+
+@pytest.mark.parametrize("value", ["true", "1", "yes"])
+def test_smkstat_value_string_flag_should_be_read_from_the_environment_when_built(
+    monkeypatch, value
+):
+    monkeypatch.setenv("SMKSTAT_AS_VALUESTRING", value)
+    registry = build_mapper_registry(custom_mappers_enabled=True)
+    monkeypatch.delenv("SMKSTAT_AS_VALUESTRING")
+
+    [observation] = registry.get(smk.AHD_TYPE)[0](
+        get_smkstat_annotation(), get_empty_document_reference()
+    )
+    assert observation.valueString is not None
+
+
+def test_smkstat_mapper_should_use_value_string_flag_of_registry():
+    annotation = get_smkstat_annotation()
+    document_reference = get_empty_document_reference()
+
+    as_string = build_mapper_registry(
+        custom_mappers_enabled=True, smkstat_as_value_string=True
+    )
+    as_concept = build_mapper_registry(
+        custom_mappers_enabled=True, smkstat_as_value_string=False
+    )
+
+    [observation] = as_string.get(smk.AHD_TYPE)[0](annotation, document_reference)
+    assert observation.valueString is not None
+    assert observation.valueCodeableConcept is None
+
+    [observation] = as_concept.get(smk.AHD_TYPE)[0](annotation, document_reference)
+    assert observation.valueString is None
+    assert observation.valueCodeableConcept is not None
+
+
+def test_resource_handler_should_map_custom_annotations_if_enabled():
+    annotations = get_payload("payload_1.json")
+    document_reference = get_empty_document_reference()
+
+    def count_observations(registry) -> int:
+        handler = ResourceHandler(averbis_pipeline=None, mapper_registry=registry)
+        resources = handler._map_annotations(annotations, document_reference)
+        return len([r for r in resources if r.resource_type == "Observation"])
+
+    assert count_observations(build_mapper_registry(custom_mappers_enabled=False)) == 0
+    assert count_observations(build_mapper_registry(custom_mappers_enabled=True)) > 0
@@ -0,0 +1,39 @@
+from ahd2fhir.utils.metadata_registry import (
+    METADATA_REGISTRY_HIT_RATE_GAUGE,
+    MetadataResourceRegistry,
+)
+
+
+def test_get_should_build_each_resource_once():
+    built_keys = []
+
+    def build(key):
+        built_keys.append(key)
+        return {"id": key}
+
+    registry = MetadataResourceRegistry("test-build-once", build)
+
+    first = registry.get("a")
+    second = registry.get("a")
+
+    assert first is second
+    assert built_keys == ["a"]
+    assert registry.hit_rate == 0.5
+    assert (
+        METADATA_REGISTRY_HIT_RATE_GAUGE.labels(registry="test-build-once")._value.get()
+        == 0.5
+    )
+
+
+def test_get_should_evict_the_least_recently_used_resource():
+    registry = MetadataResourceRegistry("test-evict", lambda key: {"id": key}, 2)
+
+    a = registry.get("a")
+    registry.get("b")
+    registry.get("a")
+    registry.get("c")
+
+    assert registry.get("a") is a
+    assert registry.misses == 3
+    registry.get("b")
+    assert registry.misses == 4
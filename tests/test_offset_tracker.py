@@ -0,0 +1,63 @@
+from aiokafka.structs import TopicPartition
+
+from ahd2fhir.utils.offset_tracker import OffsetTracker
+
+PARTITION_0 = TopicPartition("fhir.documents", 0)
+PARTITION_1 = TopicPartition("fhir.documents", 1)
+
+
+def test_committable_should_stop_at_the_lowest_unfinished_offset():
+    tracker = OffsetTracker()
+    for offset in [10, 11, 12]:
+        tracker.start(PARTITION_0, offset)
+
+    tracker.complete(PARTITION_0, 10)
+    tracker.complete(PARTITION_0, 12)
+
+    assert tracker.committable() == {PARTITION_0: 11}
+    assert tracker.in_flight() == 1
+
+
+def test_committable_should_advance_once_gaps_are_filled():
+    tracker = OffsetTracker()
+    for offset in [10, 11, 12]:
+        tracker.start(PARTITION_0, offset)
+    tracker.complete(PARTITION_0, 12)
+    tracker.complete(PARTITION_0, 11)
+
+    assert tracker.committable() == {}
+
+    tracker.complete(PARTITION_0, 10)
+
+    assert tracker.committable() == {PARTITION_0: 13}
+    assert tracker.in_flight() == 0
+
+
+def test_committable_should_only_return_partitions_that_advanced():
+    tracker = OffsetTracker()
+    tracker.start(PARTITION_0, 0)
+    tracker.start(PARTITION_1, 5)
+    tracker.complete(PARTITION_0, 0)
+    tracker.complete(PARTITION_1, 5)
+
+    offsets = tracker.committable()
+    tracker.mark_committed(offsets)
+
+    assert offsets == {PARTITION_0: 1, PARTITION_1: 6}
+    assert tracker.committable() == {}
+
+    tracker.start(PARTITION_1, 6)
+    tracker.complete(PARTITION_1, 6)
+
+    assert tracker.committable() == {PARTITION_1: 7}
+
+
+def test_completing_a_message_of_a_forgotten_partition_is_ignored():
+    tracker = OffsetTracker()
+    tracker.start(PARTITION_0, 0)
+    tracker.forget(PARTITION_0)
+
+    tracker.complete(PARTITION_0, 0)
+
+    assert tracker.committable() == {}
+    assert tracker.in_flight() == 0
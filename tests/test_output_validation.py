@@ -0,0 +1,78 @@
+import json
+
+import pytest
+from fhir.resources.R4B.documentreference import DocumentReference
+
+from ahd2fhir.utils.output_validation import (
+    OUTPUT_VALIDATION_FAILURES_COUNTER,
+    OutputValidator,
+)
+from ahd2fhir.utils.resource_handler import ResourceHandler
+
+with open("tests/resources/fhir/documentreference.json") as file:
+    DOCUMENT_REFERENCE = DocumentReference.parse_obj(
+        json.load(file)["entry"][0]["resource"]
+    )
+
+with open("tests/resources/ahd/payload_1.json") as file:
+    ANNOTATIONS = json.load(file)
+
+
+def test_valid_bundle_should_pass_validation():
+    handler = ResourceHandler(None)
+    bundle = handler.map_documents([(DOCUMENT_REFERENCE, ANNOTATIONS)])
+    failures_before = OUTPUT_VALIDATION_FAILURES_COUNTER._value.get()
+
+    assert OutputValidator("always").validate(bundle)
+    assert OutputValidator("always").validate(bundle.dict())
+    assert OUTPUT_VALIDATION_FAILURES_COUNTER._value.get() == failures_before
+
+
+def test_invalid_bundle_should_be_counted_as_failure():
+    invalid_bundle = {
+        "resourceType": "Bundle",
+        "id": "invalid",
+        "type": "transaction",
+        "entry": [{"resource": {"resourceType": "Condition", "id": "no-subject"}}],
+    }
+    failures_before = OUTPUT_VALIDATION_FAILURES_COUNTER._value.get()
+
+    assert not OutputValidator("always").validate(invalid_bundle)
+    assert OUTPUT_VALIDATION_FAILURES_COUNTER._value.get() == failures_before + 1
+
+
+@pytest.mark.parametrize(
+    "policy,sample_rate,random_number,expected",
+    [
+        ("always", 0.0, 0.99, True),
+        ("never", 1.0, 0.0, False),
+        ("sampled", 0.1, 0.05, True),
+        ("sampled", 0.1, 0.15, False),
+    ],
+)
+def test_should_validate_should_follow_the_policy(
+    policy, sample_rate, random_number, expected
+):
+    validator = OutputValidator(policy, sample_rate, lambda: random_number)
+
+    assert validator.should_validate() == expected
+
+
+@pytest.mark.parametrize("policy,sample_rate", [("sometimes", 0.1), ("sampled", 2)])
+def test_invalid_policy_should_raise(policy, sample_rate):
+    with pytest.raises(ValueError):
+        OutputValidator(policy, sample_rate)
+
+
+def test_resource_handler_should_validate_its_result_bundles(mocker):
+    validator = OutputValidator("always")
+    validate = mocker.spy(validator, "validate")
+    handler = ResourceHandler(None, output_validator=validator)
+
+    bundle = handler.map_documents([(DOCUMENT_REFERENCE, ANNOTATIONS)])
+    bundle_dict = handler.map_documents_as_dict([(DOCUMENT_REFERENCE, ANNOTATIONS)])
+
+    assert validate.call_count == 2
+    assert validate.spy_return_list == [True, True]
+    assert validate.call_args_list[0].args == (bundle,)
+    assert validate.call_args_list[1].args == (bundle_dict,)
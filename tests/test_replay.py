@@ -0,0 +1,114 @@
+import json
+
+from fhir.resources.R4B.documentreference import DocumentReference
+from fhir.resources.R4B.identifier import Identifier
+
+from ahd2fhir import cli
+from ahd2fhir.utils.analysis_archive import AnalysisArchive, parse_archive_record
+from ahd2fhir.utils.replay import (
+    replay_archive_record,
+    replay_document,
+    replay_documents,
+)
+from ahd2fhir.utils.resource_handler import ResourceHandler
+from tests.test_resource_handler import MockPipeline
+
+with open("tests/resources/fhir/documentreference.json") as file:
+    DOCUMENT_REFERENCE = DocumentReference.parse_obj(
+        json.load(file)["entry"][0]["resource"]
+    )
+
+with open("tests/resources/ahd/payload_1.json") as file:
+    AHD_RESPONSE = json.load(file)
+
+
+def get_mapped_resources(bundle) -> dict:
+    # the composition contains the time of the mapping
+    return {
+        entry.fullUrl: entry.resource.json()
+        for entry in bundle.entry
+        if entry.resource.resource_type != "Composition"
+    }
+
+
+def analyze_and_archive(tmp_path):
+    archive = AnalysisArchive(str(tmp_path / "archive"))
+    resource_handler = ResourceHandler(
+        averbis_pipeline=MockPipeline(response=AHD_RESPONSE),
+        analysis_archive=archive,
+    )
+    bundle = resource_handler.handle_documents([DOCUMENT_REFERENCE])
+    archive.close()
+    return bundle
+
+
+def test_archive_should_store_annotations_without_attachment_data(tmp_path):
+    analyze_and_archive(tmp_path)
+
+    archive_files = list((tmp_path / "archive").glob("*.ndjson"))
+    records = archive_files[0].read_bytes().splitlines()
+    document_reference, annotations = parse_archive_record(records[0])
+
+    assert len(archive_files) == 1
+    assert len(records) == 1
+    assert annotations == AHD_RESPONSE
+    assert document_reference.id == DOCUMENT_REFERENCE.id
+    assert document_reference.content[0].attachment.data is None
+
+
+def test_replay_archive_record_should_reproduce_the_original_mapping(tmp_path):
+    bundle = analyze_and_archive(tmp_path)
+    archive_file = next((tmp_path / "archive").glob("*.ndjson"))
+
+    replayed = replay_archive_record(archive_file.read_bytes().splitlines()[0])
+
+    assert len(replayed.entry) == len(bundle.entry)
+    assert get_mapped_resources(replayed) == get_mapped_resources(bundle)
+
+
+def test_replay_document_should_accept_wrapped_payloads():
+    with open("tests/resources/ahd/v6/simple-payload.json") as file:
+        ahd_response = json.load(file)
+
+    bundle = replay_document(DOCUMENT_REFERENCE, ahd_response)
+
+    assert get_mapped_resources(bundle) == get_mapped_resources(
+        replay_document(DOCUMENT_REFERENCE, ahd_response["payload"])
+    )
+
+
+def test_replay_documents_should_keep_the_input_order():
+    documents = [
+        DOCUMENT_REFERENCE.copy(
+            update={"identifier": [Identifier(**{"value": f"document-{i}"})]}
+        )
+        for i in range(5)
+    ]
+
+    bundles = list(
+        replay_documents(
+            [(document, AHD_RESPONSE) for document in documents], processes=2
+        )
+    )
+
+    assert len({bundle.id for bundle in bundles}) == 5
+    assert [bundle.id for bundle in bundles] == [
+        replay_document(document, AHD_RESPONSE).id for document in documents
+    ]
+
+
+def test_run_replay_should_map_archive_files(tmp_path):
+    analyze_and_archive(tmp_path)
+    analyze_and_archive(tmp_path)
+
+    failed_chunks = cli.run_replay(
+        [str(tmp_path / "archive")],
+        str(tmp_path / "output"),
+        processes=1,
+        chunk_size=10,
+        output_format="bundles",
+    )
+    output_file = next((tmp_path / "output").glob("*.ndjson"))
+
+    assert failed_chunks == 0
+    assert len(output_file.read_text().splitlines()) == 2
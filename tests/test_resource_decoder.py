@@ -0,0 +1,70 @@
+import json
+
+import pytest
+from fhir.resources.R4B.bundle import Bundle
+from fhir.resources.R4B.documentreference import DocumentReference
+
+from ahd2fhir.utils.resource_decoder import (
+    DECODE_DURATION_HISTOGRAM,
+    UnsupportedResourceTypeError,
+    decode_resource,
+    get_header,
+)
+
+with open("tests/resources/fhir/documentreference.json", "rb") as file:
+    BUNDLE_BYTES = file.read()
+
+DOCUMENT_REFERENCE_BYTES = json.dumps(
+    json.loads(BUNDLE_BYTES)["entry"][0]["resource"]
+).encode("utf8")
+
+
+def get_decode_count() -> float:
+    samples = DECODE_DURATION_HISTOGRAM.collect()[0].samples
+    return [s.value for s in samples if s.name.endswith("_count")][0]
+
+
+@pytest.mark.parametrize(
+    "value,expected_type",
+    [(BUNDLE_BYTES, Bundle), (DOCUMENT_REFERENCE_BYTES, DocumentReference)],
+)
+def test_decode_resource_should_route_on_resource_type(value, expected_type):
+    resource = decode_resource(value)
+
+    assert isinstance(resource, expected_type)
+    assert resource == expected_type.parse_raw(value)
+
+
+def test_decode_resource_should_track_decode_duration():
+    count_before = get_decode_count()
+
+    decode_resource(BUNDLE_BYTES)
+
+    assert get_decode_count() == count_before + 1
+
+
+def test_decode_resource_should_reject_unsupported_header_without_parsing(mocker):
+    loads = mocker.patch("ahd2fhir.utils.resource_decoder.loads")
+
+    with pytest.raises(UnsupportedResourceTypeError):
+        decode_resource(b"{}", resource_type="Patient")
+
+    loads.assert_not_called()
+
+
+def test_decode_resource_should_reject_unsupported_body():
+    with pytest.raises(UnsupportedResourceTypeError):
+        decode_resource(b'{"resourceType": "Patient"}')
+
+
+def test_decode_resource_should_fail_if_header_and_body_disagree():
+    with pytest.raises(ValueError):
+        decode_resource(BUNDLE_BYTES, resource_type="DocumentReference")
+
+
+def test_get_header_should_return_the_decoded_value():
+    headers = [("error", b"x"), ("resourceType", b"Bundle")]
+
+    assert get_header(headers, "resourceType") == "Bundle"
+    assert get_header(headers, "missing") is None
+    assert get_header(None, "resourceType") is None
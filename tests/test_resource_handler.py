@@ -1,7 +1,11 @@
+import asyncio
 import base64
 import json
+import threading
+import time
 
 import pytest
+import tenacity
 from fhir.resources.R4B.attachment import Attachment
 from fhir.resources.R4B.bundle import Bundle, BundleEntry
 from fhir.resources.R4B.composition import Composition
@@ -9,6 +13,8 @@ from fhir.resources.R4B.documentreference import DocumentReferenceContent
 from fhir.resources.R4B.fhirtypes import DateTime
 from syrupy.extensions.single_file import SingleFileSnapshotExtension, WriteMode
 
+from ahd2fhir.mappers import ahd_to_medication_statement
+from ahd2fhir.utils.const import AHD_TYPE_MEDICATION
 from ahd2fhir.utils.resource_handler import ResourceHandler
 from tests.utils import get_empty_document_reference
 
@@ -119,6 +125,38 @@ def test_get_fhir_medication_should_only_create_unique_bundle_entries():
     assert len(full_urls) == len(unique_full_urls)
 
 
+def test_map_annotations_should_map_each_medication_annotation_once(mocker):
+    with open("tests/resources/ahd/payload_3.json") as file:
+        ahd_response = json.load(file)
+
+    spy = mocker.spy(
+        ahd_to_medication_statement, "get_medication_statement_from_annotation"
+    )
+    resource_handler = ResourceHandler(averbis_pipeline=MockPipeline())
+
+    resources = resource_handler._map_annotations(
+        ahd_response, get_empty_document_reference()
+    )
+
+    medication_annotations = [
+        a for a in ahd_response if a["type"] == AHD_TYPE_MEDICATION
+    ]
+    assert spy.call_count == len(medication_annotations)
+    list_entries = [
+        entry.item.reference
+        for resource in resources
+        if resource.resource_type == "List"
+        for entry in resource.entry or []
+    ]
+    statements = [
+        f"MedicationStatement/{resource.id}"
+        for resource in resources
+        if resource.resource_type == "MedicationStatement"
+    ]
+    assert len(list_entries) > 0
+    assert set(list_entries) <= set(statements)
+
+
 @pytest.mark.parametrize(
     "ahd_payload_filename", ["complex-payload.json", "simple-payload.json"]
 )
@@ -155,3 +193,174 @@ def test_handle_documents_from_ahd_payloads_snapshots(
     result_bundle = resource_handler.handle_documents([doc])
 
     assert result_bundle.json(indent=2, ensure_ascii=False) == snapshot_fhir
+
+
+class SlowMockPipeline(MockPipeline):
+    def __init__(self, delay_seconds: float, response=None) -> None:
+        super().__init__(response)
+        self.delay_seconds = delay_seconds
+
+    def analyse_text(self, text: str, language: str, annotation_types: str):
+        time.sleep(self.delay_seconds)
+        return self.response
+
+
+def get_document_reference_with_text(text: str):
+    doc = get_empty_document_reference()
+    doc.content[0] = DocumentReferenceContent(
+        **{
+            "attachment": Attachment(
+                **{
+                    "data": base64.b64encode(text.encode("utf-8")),
+                    "contentType": "text/plain",
+                    "language": "en",
+                }
+            )
+        }
+    )
+    doc.date = DateTime.validate("2000-01-01T00:00:00+00:00")
+    return doc
+
+
+@pytest.mark.parametrize(
+    "ahd_payload_filename", ["complex-payload.json", "simple-payload.json"]
+)
+def test_ahandle_documents_should_return_the_same_bundle_as_handle_documents(
+    ahd_payload_filename,
+):
+    doc = get_document_reference_with_text("mocked")
+
+    with open(f"tests/resources/ahd/v6/{ahd_payload_filename}") as file:
+        payload = json.load(file)["payload"]
+
+    resource_handler = ResourceHandler(
+        averbis_pipeline=MockPipeline(response=payload),
+        fixed_composition_datetime=doc.date,
+    )
+
+    expected = resource_handler.handle_documents([doc])
+    actual = asyncio.run(resource_handler.ahandle_documents([doc]))
+
+    assert actual.json() == expected.json()
+
+
+def test_ahandle_bundle_should_not_block_the_event_loop():
+    entry = BundleEntry(**{"resource": get_document_reference_with_text("slow")})
+    bundle = Bundle(**{"id": "test", "type": "transaction", "entry": [entry]})
+    resource_handler = ResourceHandler(
+        averbis_pipeline=SlowMockPipeline(delay_seconds=0.5)
+    )
+
+    async def count_ticks_while_analyzing():
+        ticks = 0
+        analysis = asyncio.create_task(resource_handler.ahandle_bundle(bundle))
+        while not analysis.done():
+            await asyncio.sleep(0.01)
+            ticks = ticks + 1
+        return ticks, analysis.result()
+
+    ticks, result = asyncio.run(count_ticks_while_analyzing())
+
+    assert ticks > 10
+    assert any(isinstance(e.resource, Composition) for e in result.entry)
+
+
+class ConcurrencyTrackingMockPipeline(SlowMockPipeline):
+    def __init__(self, delay_seconds: float) -> None:
+        super().__init__(delay_seconds)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def analyse_text(self, text: str, language: str, annotation_types: str):
+        with self.lock:
+            self.in_flight = self.in_flight + 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return super().analyse_text(text, language, annotation_types)
+        finally:
+            with self.lock:
+                self.in_flight = self.in_flight - 1
+
+
+def get_documents_with_distinct_identifiers(count: int):
+    documents = []
+    for index in range(count):
+        doc = get_document_reference_with_text(f"document {index}")
+        doc.id = f"doc-{index}"
+        documents.append(doc)
+    return documents
+
+
+def test_ahandle_documents_should_analyze_documents_concurrently_in_input_order():
+    documents = get_documents_with_distinct_identifiers(6)
+    pipeline = ConcurrencyTrackingMockPipeline(delay_seconds=0.1)
+    resource_handler = ResourceHandler(
+        averbis_pipeline=pipeline, max_concurrent_documents=3
+    )
+
+    bundle = asyncio.run(resource_handler.ahandle_documents(documents))
+
+    assert pipeline.max_in_flight == 3
+    assert [e.resource.identifier.value for e in bundle.entry] == [
+        f"doc-{index}_ahd-analysis-result" for index in range(6)
+    ]
+
+
+def test_ahandle_documents_should_respect_shared_analysis_semaphore():
+    pipeline = ConcurrencyTrackingMockPipeline(delay_seconds=0.05)
+    semaphore = asyncio.Semaphore(2)
+    handlers = [
+        ResourceHandler(
+            averbis_pipeline=pipeline,
+            max_concurrent_documents=4,
+            analysis_semaphore=semaphore,
+        )
+        for _ in range(2)
+    ]
+
+    async def handle_concurrently():
+        return await asyncio.gather(
+            *(
+                handler.ahandle_documents(get_documents_with_distinct_identifiers(4))
+                for handler in handlers
+            )
+        )
+
+    asyncio.run(handle_concurrently())
+
+    assert pipeline.max_in_flight == 2
+
+
+class FailingOnceMockPipeline(MockPipeline):
+    def __init__(self, failing_text: str) -> None:
+        super().__init__()
+        self.failing_text = failing_text
+        self.analyzed_texts = []
+
+    def analyse_text(self, text: str, language: str, annotation_types: str):
+        self.analyzed_texts.append(text)
+        if text == self.failing_text and self.analyzed_texts.count(text) == 1:
+            raise ConnectionError("AHD is unavailable")
+        return super().analyse_text(text, language, annotation_types)
+
+
+def test_ahandle_documents_should_release_the_semaphore_between_retries(mocker):
+    mocker.patch.object(
+        ResourceHandler._aanalyse_text_with_retries.retry,
+        "wait",
+        tenacity.wait_fixed(0.2),
+    )
+    pipeline = FailingOnceMockPipeline(failing_text="document 0")
+    resource_handler = ResourceHandler(
+        averbis_pipeline=pipeline,
+        max_concurrent_documents=2,
+        analysis_semaphore=asyncio.Semaphore(1),
+    )
+
+    asyncio.run(
+        resource_handler.ahandle_documents(get_documents_with_distinct_identifiers(2))
+    )
+
+    # the second document is analyzed while the first one waits to be retried
+    assert pipeline.analyzed_texts == ["document 0", "document 1", "document 0"]
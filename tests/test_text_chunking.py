@@ -0,0 +1,160 @@
+import asyncio
+import itertools
+import re
+
+import pytest
+
+from ahd2fhir.utils.resource_handler import ResourceHandler
+from ahd2fhir.utils.text_chunking import TextChunker
+from tests.test_resource_handler import get_document_reference_with_text
+
+PARAGRAPH = (
+    "Die Patientin stellte sich mit Fieber vor. Es zeigte sich eine Pneumonie.\n"
+    + "Die Pneumonie wurde antibiotisch behandelt.\n\n"
+)
+
+
+class KeywordMockPipeline:
+    """
+    Annotates each occurrence of a keyword as a Diagnosis and the whole
+    text with a DocumentAnnotation, numbering the annotations like AHD does
+    """
+
+    def __init__(self, keyword: str = "Pneumonie") -> None:
+        self.keyword = keyword
+        self.analysed_texts = []
+
+    def analyse_text(self, text: str, language: str, annotation_types: str):
+        self.analysed_texts.append(text)
+        ids = itertools.count(1000)
+        annotations = [
+            {
+                "begin": 0,
+                "end": len(text),
+                "type": "de.averbis.types.health.DocumentAnnotation",
+                "coveredText": text,
+                "id": next(ids),
+                "language": "de",
+                "version": "7.4.0",
+            }
+        ]
+        for match in re.finditer(self.keyword, text):
+            annotations.append(
+                {
+                    "begin": match.start(),
+                    "end": match.end(),
+                    "type": "de.averbis.types.health.Diagnosis",
+                    "coveredText": match.group(),
+                    "id": next(ids),
+                    "negatedBy": None,
+                    "matchedTerm": "Pneumonie",
+                    "verificationStatus": None,
+                    "kind": None,
+                    "confidence": 0.9,
+                    "onsetDate": None,
+                    "source": "ICD10GM_2024",
+                    "clinicalStatus": None,
+                    "approach": "DictionaryLookup",
+                    "laterality": None,
+                    "dictCanon": "Pneumonie, nicht naeher bezeichnet",
+                    "conceptID": "J18.9",
+                    "belongsTo": None,
+                    "uniqueID": "ICD10GM_2024:J18.9",
+                }
+            )
+        return annotations
+
+
+def test_split_should_not_split_short_texts():
+    chunker = TextChunker(max_chunk_size=1000, overlap=100, max_concurrent_chunks=2)
+
+    chunks = chunker.split(PARAGRAPH)
+
+    assert len(chunks) == 1
+    assert chunks[0].text == PARAGRAPH
+    assert chunks[0].offset == 0
+
+
+def test_split_should_split_at_paragraphs_with_overlap():
+    text = PARAGRAPH * 50
+    chunker = TextChunker(max_chunk_size=1000, overlap=200, max_concurrent_chunks=2)
+
+    chunks = chunker.split(text)
+
+    assert len(chunks) > 1
+    assert chunks[0].offset == 0
+    assert chunks[-1].end == len(text)
+    for chunk in chunks:
+        assert len(chunk.text) <= 1000
+        assert chunk.text == text[chunk.offset : chunk.end]
+        assert chunk.text.startswith("Die Patientin")
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert previous.offset < chunk.offset < previous.end
+
+
+def test_split_should_fall_back_to_whitespace_and_hard_cuts():
+    chunker = TextChunker(max_chunk_size=10, overlap=2, max_concurrent_chunks=2)
+
+    assert [chunk.text for chunk in chunker.split("abcdefghij klmnop")] == [
+        "abcdefghij",
+        "ij klmnop",
+    ]
+    chunks = chunker.split("x" * 25)
+    assert all(len(chunk.text) <= 10 for chunk in chunks)
+    assert chunks[-1].end == 25
+
+
+@pytest.mark.parametrize(
+    "max_chunk_size,overlap,max_concurrent_chunks",
+    [(0, 0, 1), (100, 50, 1), (100, 0, 0)],
+)
+def test_invalid_chunking_settings_should_raise(
+    max_chunk_size, overlap, max_concurrent_chunks
+):
+    with pytest.raises(ValueError):
+        TextChunker(max_chunk_size, overlap, max_concurrent_chunks)
+
+
+def test_chunked_analysis_should_merge_to_the_annotations_of_the_whole_text():
+    text = PARAGRAPH * 50
+    pipeline = KeywordMockPipeline()
+    chunker = TextChunker(max_chunk_size=1000, overlap=200, max_concurrent_chunks=4)
+    handler = ResourceHandler(averbis_pipeline=pipeline, text_chunker=chunker)
+
+    expected = pipeline.analyse_text(text, "de", "")
+    actual = handler._perform_document_analysis(text)
+
+    assert len(pipeline.analysed_texts) > 2
+    assert [(a["type"], a["begin"], a["end"]) for a in actual] == [
+        (a["type"], a["begin"], a["end"]) for a in expected
+    ]
+    assert all(text[a["begin"] : a["end"]] == a["coveredText"] for a in actual)
+    assert len({a["id"] for a in actual}) == len(actual)
+
+
+def test_chunked_documents_should_map_to_the_same_resources():
+    doc = get_document_reference_with_text(PARAGRAPH * 50)
+    chunker = TextChunker(max_chunk_size=1000, overlap=200, max_concurrent_chunks=4)
+    whole_handler = ResourceHandler(
+        averbis_pipeline=KeywordMockPipeline(), fixed_composition_datetime=doc.date
+    )
+    chunked_handler = ResourceHandler(
+        averbis_pipeline=KeywordMockPipeline(),
+        fixed_composition_datetime=doc.date,
+        text_chunker=chunker,
+    )
+
+    expected = whole_handler.handle_documents([doc])
+    actual = asyncio.run(chunked_handler.ahandle_documents([doc]))
+
+    assert [entry.json() for entry in actual.entry] == [
+        entry.json() for entry in expected.entry
+    ]
+
+
+def test_html_documents_should_not_be_split():
+    chunker = TextChunker(max_chunk_size=1000, overlap=200, max_concurrent_chunks=4)
+    handler = ResourceHandler(averbis_pipeline=None, text_chunker=chunker)
+
+    assert handler._split_text(PARAGRAPH * 50, "text/html") is None
+    assert len(handler._split_text(PARAGRAPH * 50, "text/plain")) > 1